@@ -1,3 +1,5 @@
 from .extension import FlaskPancake, GroupFunc  # noqa
 from .flags import Flag, Sample, Switch  # noqa
+from .snapshot import Snapshot  # noqa
+from .storage import MemoryStorage, Storage  # noqa
 from .views import bp as blueprint  # noqa
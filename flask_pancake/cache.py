@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set, Tuple
+
+from redis.exceptions import RedisError
+
+from .utils import load_key
+
+if TYPE_CHECKING:
+    from flask_redis import FlaskRedis
+
+    from .utils import KeyType
+
+__all__ = ["LocalCache"]
+
+logger = logging.getLogger(__name__)
+
+
+def _load_keys(data: bytes) -> Optional[List[KeyType]]:
+    keys = json.loads(data)
+    if keys is None:
+        return None
+    return [load_key(key) for key in keys]
+
+
+class LocalCache:
+    """
+    A process-local cache for the raw values stored in Redis.
+
+    Every write through a flag's API publishes the changed keys on a Redis
+    channel. A daemon thread in each process listens on that channel and evicts
+    the affected keys. The TTL bounds how long a value can be stale if an
+    invalidation message gets lost.
+
+    Each TTL is shortened by a random fraction of up to `jitter`, so processes
+    started at the same time don't all refresh at the same time. For `stale_ttl`
+    seconds after a value expired, only one thread refreshes it while all other
+    threads keep using the stale value.
+    """
+
+    def __init__(self, ttl: float, stale_ttl: float = 0, jitter: float = 0.1) -> None:
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.jitter = jitter
+        # key -> (fresh until, stale until, value)
+        self._data: Dict[KeyType, Tuple[float, float, Optional[bytes]]] = {}
+        # Keys with expired values that one thread is currently refreshing
+        self._refreshing: Set[KeyType] = set()
+        self._lock = threading.Lock()
+        # Incremented on every invalidation. Values fetched before an
+        # invalidation must not end up in the cache afterwards.
+        self._generation = 0
+        self._pid: Optional[int] = None
+        self._stop = threading.Event()
+        self._subscribed = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get_many(
+        self, keys: Iterable[KeyType]
+    ) -> Tuple[Dict[KeyType, Optional[bytes]], List[KeyType]]:
+        """
+        Return the cached values for the given keys and a list of all keys that
+        need to be fetched from Redis.
+
+        The caller must pass the fetched values to `set_many()`, or call
+        `release()` if fetching them failed.
+        """
+        now = time.monotonic()
+        hits: Dict[KeyType, Optional[bytes]] = {}
+        misses: List[KeyType] = []
+        stale: Dict[KeyType, Optional[bytes]] = {}
+        for key in keys:
+            entry = self._data.get(key)
+            if entry is None or entry[1] <= now:
+                misses.append(key)
+            elif entry[0] > now:
+                hits[key] = entry[2]
+            else:
+                stale[key] = entry[2]
+
+        if stale:
+            with self._lock:
+                for key, value in stale.items():
+                    if key in self._refreshing:
+                        hits[key] = value
+                    else:
+                        self._refreshing.add(key)
+                        misses.append(key)
+        return hits, misses
+
+    def set_many(self, values: Dict[KeyType, Optional[bytes]], generation: int) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._refreshing.difference_update(values)
+            if generation != self._generation:
+                return
+            for key, value in values.items():
+                fresh = now + self.ttl * (1 - random.uniform(0, self.jitter))
+                self._data[key] = (fresh, fresh + self.stale_ttl, value)
+
+    def release(self, keys: Iterable[KeyType]) -> None:
+        """
+        Let other threads refresh the given keys.
+        """
+        with self._lock:
+            self._refreshing.difference_update(keys)
+
+    def invalidate(self, keys: Optional[Iterable[KeyType]] = None) -> None:
+        """
+        Evict the given keys, or everything if no keys are given.
+        """
+        with self._lock:
+            self._generation += 1
+            if keys is None:
+                self._data.clear()
+            else:
+                for key in keys:
+                    self._data.pop(key, None)
+
+    def listen(self, client: FlaskRedis, channel: str) -> None:
+        """
+        Start the invalidation listener thread for the current process, unless it
+        is already running.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return  # pragma: no cover
+            # Anything cached before a fork might be outdated already.
+            self._data.clear()
+            self._generation += 1
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._listen,
+                args=(client, channel),
+                name="flask-pancake-invalidation",
+                daemon=True,
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _listen(self, client: FlaskRedis, channel: str) -> None:
+        while not self._stop.is_set():
+            try:
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                try:
+                    pubsub.subscribe(channel)
+                    # Changes may have been missed while not subscribed.
+                    self.invalidate()
+                    self._subscribed.set()
+                    while not self._stop.is_set():
+                        message = pubsub.get_message(timeout=0.1)
+                        if message is not None:
+                            self.invalidate(_load_keys(message["data"]))
+                finally:
+                    self._subscribed.clear()
+                    pubsub.close()
+            except RedisError:
+                logger.exception("Lost connection to the invalidation channel.")
+                self.invalidate()
+                self._stop.wait(1)
+
+    def close(self) -> None:
+        """
+        Stop the invalidation listener thread and clear the cache.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._pid = None
+        self.invalidate()
@@ -41,6 +41,29 @@ def flag_clear_group(extension, name, group, id):
     )
 
 
+@flags_cli.command("clear-all-group")
+@click.option("--extension", default=EXTENSION_NAME)
+@click.option("--batch-size", default=1000, type=click.IntRange(min=1))
+@click.argument("name")
+@click.argument("group")
+def flag_clear_all_group(extension, batch_size, name, group):
+    cleared = 0
+
+    def progress(count):
+        nonlocal cleared
+        cleared += count
+        click.echo(f"Cleared {cleared} objects ...")
+
+    current_app.extensions[extension].flags[name].clear_all_group(
+        group_id=group, batch_size=batch_size, progress=progress
+    )
+    click.echo(
+        f"All objects in group '{group}' for flag '{name}' "
+        + click.style("cleared", fg="yellow")
+        + "."
+    )
+
+
 @flags_cli.command("disable")
 @click.option("--extension", default=EXTENSION_NAME)
 @click.argument("name")
@@ -110,6 +133,21 @@ def flag_list_group(extension, group, id):
         click.echo(f"{name}: {for_group} (default: {default})")
 
 
+@flags_cli.command("migrate-storage")
+@click.option("--extension", default=EXTENSION_NAME)
+@click.option("--batch-size", default=1000, type=click.IntRange(min=1))
+def flag_migrate_storage(extension, batch_size):
+    ext = current_app.extensions[extension]
+    for name, instance in sorted(ext.flags.items()):
+        for group in ext.group_funcs or {}:
+            count = instance.migrate_group_storage(group, batch_size=batch_size)
+            click.echo(
+                f"Migrated {count} objects in group '{group}' for flag '{name}' to "
+                + click.style(ext.get_group_storage(group), fg="blue")
+                + " storage."
+            )
+
+
 # SAMPLES
 
 
@@ -1,6 +1,18 @@
 EXTENSION_NAME = "pancake"
 
+MGET_CHUNK_SIZE = 1000
+
+GROUP_STORAGE_BITMAP = "bitmap"
+GROUP_STORAGE_HASH = "hash"
+GROUP_STORAGE_KEYS = "keys"
+GROUP_STORAGES = (GROUP_STORAGE_KEYS, GROUP_STORAGE_HASH, GROUP_STORAGE_BITMAP)
+
+KEY_SCHEME_CLUSTER = "cluster"
+KEY_SCHEME_DEFAULT = "default"
+KEY_SCHEMES = (KEY_SCHEME_DEFAULT, KEY_SCHEME_CLUSTER)
+
 RAW_FALSE = b"0"
 RAW_TRUE = b"1"
 
 COOKIE_SALT = b"flask_pancake.cookie"
+COOKIE_VERSION = 2
@@ -1,21 +1,71 @@
 from __future__ import annotations
 
 import abc
-from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Type, Union
+import asyncio
+import contextvars
+import functools
+import json
+from contextlib import contextmanager
+from itertools import chain
+from types import MappingProxyType
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
 
 from cached_property import cached_property
+from flask import current_app, g, has_request_context
+from redis.exceptions import RedisClusterException
 
-from .constants import EXTENSION_NAME
+from .cache import LocalCache
+from .constants import (
+    EXTENSION_NAME,
+    GROUP_STORAGE_BITMAP,
+    GROUP_STORAGE_HASH,
+    GROUP_STORAGE_KEYS,
+    GROUP_STORAGES,
+    KEY_SCHEME_CLUSTER,
+    KEY_SCHEME_DEFAULT,
+    KEY_SCHEMES,
+    MGET_CHUNK_SIZE,
+    RAW_FALSE,
+    RAW_TRUE,
+)
+from .refresher import SharedSnapshotRefresher, SnapshotRefresher
 from .registry import registry
-from .utils import GroupFuncType, import_from_string, load_cookies, store_cookies
+from .snapshot import Snapshot
+from .storage import MemoryStorage, Storage
+from .utils import (
+    BitmapField,
+    GroupFuncType,
+    HashField,
+    KeyType,
+    get_key_slot,
+    import_from_string,
+    iter_bits,
+    store_cookies,
+)
 
 if TYPE_CHECKING:
     from flask import Flask
+    from redis.client import Pipeline
 
-    from .flags import Flag, Sample, Switch
+    from .flags import AbstractFlag, Flag, Sample, Switch
 
 __all__ = ["FlaskPancake"]
 
+T = TypeVar("T")
+
 
 class FlaskPancake:
     def __init__(
@@ -24,17 +74,75 @@ class FlaskPancake:
         *,
         name: str = EXTENSION_NAME,
         redis_extension_name: str = "redis",
+        read_redis_extension_name: Optional[str] = None,
         group_funcs: Optional[
             Dict[str, Union[str, Type[GroupFunc], GroupFunc, GroupFuncType]]
         ] = None,
         cookie_name=None,
         cookie_options: Dict[str, Any] = None,
+        cache_ttl: Optional[float] = None,
+        cache_stale_ttl: float = 0,
+        cache_jitter: float = 0.1,
+        refresh_interval: Optional[float] = None,
+        group_storage: Union[str, Dict[str, str]] = GROUP_STORAGE_KEYS,
+        key_scheme: str = KEY_SCHEME_DEFAULT,
+        storage: Optional[Storage] = None,
+        snapshot_path: Optional[str] = None,
     ) -> None:
+        if cache_ttl is not None and refresh_interval is not None:
+            raise ValueError(
+                "The arguments `cache_ttl` and `refresh_interval` are mutually "
+                "exclusive."
+            )
+        if snapshot_path is not None and refresh_interval is None:
+            raise ValueError(
+                "The argument `snapshot_path` requires `refresh_interval`."
+            )
+        if storage is not None and read_redis_extension_name is not None:
+            raise ValueError(
+                "The arguments `storage` and `read_redis_extension_name` are mutually "
+                "exclusive."
+            )
+        if cache_ttl is not None and isinstance(storage, MemoryStorage):
+            raise ValueError(
+                "The argument `cache_ttl` cannot be used with the in-memory storage."
+            )
+        layouts = (
+            [group_storage]
+            if isinstance(group_storage, str)
+            else list(group_storage.values())
+        )
+        for layout in layouts:
+            if layout not in GROUP_STORAGES:
+                raise ValueError(
+                    f"Invalid group storage '{layout}'. Must be one of "
+                    + ", ".join(f"'{layout}'" for layout in GROUP_STORAGES)
+                    + "."
+                )
+        if key_scheme not in KEY_SCHEMES:
+            raise ValueError(
+                f"Invalid key scheme '{key_scheme}'. Must be one of "
+                + ", ".join(f"'{scheme}'" for scheme in KEY_SCHEMES)
+                + "."
+            )
+        self.group_storage = group_storage
+        self.key_scheme = key_scheme
         self.redis_extension_name = redis_extension_name
+        self.read_redis_extension_name = read_redis_extension_name
+        # Defaults to the Flask-Redis extension of the current app.
+        self.storage = storage
         self._group_funcs = group_funcs
         self.name = name
         self.cookie_name = cookie_name or self.name
         self.cookie_options = cookie_options or {"httponly": True, "samesite": "Lax"}
+        self._local_cache = (
+            LocalCache(cache_ttl, stale_ttl=cache_stale_ttl, jitter=cache_jitter)
+            if cache_ttl is not None
+            else None
+        )
+        self.refresh_interval = refresh_interval
+        self.snapshot_path = snapshot_path
+        self._refresher: Optional[SnapshotRefresher] = None
 
         self.app = app
         if app is not None:
@@ -42,8 +150,15 @@ class FlaskPancake:
 
     def init_app(self, app: Flask) -> None:
         app.extensions[self.name] = self
-        app.before_request(load_cookies(self))
         app.after_request(store_cookies(self))
+        if self.refresh_interval is not None:
+            if self.snapshot_path is not None:
+                self._refresher = SharedSnapshotRefresher(
+                    self, app, self.refresh_interval, self.snapshot_path
+                )
+            else:
+                self._refresher = SnapshotRefresher(self, app, self.refresh_interval)
+            self._refresher.start()
 
     @cached_property
     def group_funcs(self) -> Optional[Dict[str, GroupFunc]]:
@@ -76,6 +191,492 @@ class FlaskPancake:
     def samples(self) -> Dict[str, Sample]:
         return registry.samples(self.name)
 
+    @property
+    def _redis_client(self) -> Storage:
+        # An extension can be initialized with several apps, each with their own
+        # Redis extension.
+        if self.storage is not None:
+            return self.storage
+        return current_app.extensions[self.redis_extension_name]
+
+    @property
+    def _redis_read_client(self) -> Storage:
+        """
+        The client evaluating flags, samples, and switches with read-only
+        commands, e.g. against a replica. Defaults to the client used for writes.
+        """
+        if self.read_redis_extension_name is None:
+            return self._redis_client
+        return current_app.extensions[self.read_redis_extension_name]
+
+    async def _run_sync(self, func: Callable[..., T], *args: Any) -> T:
+        """
+        Run the given function, which sends commands with the Redis client, in
+        a thread of the event loop's default executor.
+
+        Flask runs every `async` view in a new event loop. Running the
+        synchronous client in a thread shares its connection pool across all of
+        them, instead of opening new connections for every request.
+        """
+        if isinstance(self.storage, MemoryStorage):
+            # Reading from memory doesn't block the event loop
+            return func(*args)
+        # Keep the app and request context in the executor's thread
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(context.run, func, *args)
+        )
+
+    @cached_property
+    def _version_key(self) -> str:
+        if self.key_scheme == KEY_SCHEME_CLUSTER:
+            # Same slot as the extension's flags, samples, and switches
+            return f"PANCAKE:{{{self.name}}}:version"
+        return f"PANCAKE:{self.name}:version"
+
+    @cached_property
+    def _invalidation_channel(self) -> str:
+        return f"PANCAKE:{self.name}:invalidate"
+
+    def get_group_storage(self, group_id: str) -> str:
+        """
+        Return the storage layout of the overrides for the given group.
+        """
+        if isinstance(self.group_storage, str):
+            return self.group_storage
+        return self.group_storage.get(group_id, GROUP_STORAGE_KEYS)
+
+    def _get(self, key: KeyType) -> Optional[bytes]:
+        if self._local_cache is None and self._refresher is None:
+            if isinstance(key, str):
+                return self._redis_read_client.get(key)
+            return self._fetch([key])[key]
+        return self._mget([key])[key]
+
+    def _mget(self, keys: Iterable[KeyType]) -> Dict[KeyType, Optional[bytes]]:
+        values, misses = self._get_cached(keys)
+        if misses:
+            values.update(self._fetch_cached(misses))
+        return values
+
+    async def _mget_async(
+        self, keys: Iterable[KeyType]
+    ) -> Dict[KeyType, Optional[bytes]]:
+        values, misses = self._get_cached(keys)
+        if misses:
+            values.update(await self._run_sync(self._fetch_cached, misses))
+        return values
+
+    def _get_cached(
+        self, keys: Iterable[KeyType]
+    ) -> Tuple[Dict[KeyType, Optional[bytes]], List[KeyType]]:
+        """
+        Return the values of the given keys from the snapshot or the local cache,
+        and a list of all keys that must be passed to `_fetch_cached()`.
+        """
+        keys = list(dict.fromkeys(keys))
+        if self._refresher is not None:
+            snapshot = self._refresher.get_many(keys)
+            if snapshot is not None:
+                return snapshot, []
+        if self._local_cache is None:
+            return {}, keys
+
+        self._local_cache.listen(self._redis_client, self._invalidation_channel)
+        return self._local_cache.get_many(keys)
+
+    def _fetch_cached(self, keys: List[KeyType]) -> Dict[KeyType, Optional[bytes]]:
+        """
+        Fetch the given keys from Redis and add them to the local cache, if any.
+        """
+        if self._local_cache is None:
+            return self._fetch(keys)
+
+        generation = self._local_cache.generation
+        try:
+            values = self._fetch(keys)
+        except Exception:
+            self._local_cache.release(keys)
+            raise
+        self._local_cache.set_many(values, generation)
+        return values
+
+    def _fetch(self, keys: List[KeyType]) -> Dict[KeyType, Optional[bytes]]:
+        plain_keys = self._get_single_mget_keys(keys)
+        if plain_keys is not None:
+            values = self._redis_read_client.mget(plain_keys) if plain_keys else []
+            return dict(zip(plain_keys, values))
+
+        with self._redis_read_client.pipeline(transaction=False) as pipe:
+            parse = self._queue_fetch(pipe, keys)
+            return parse(pipe.execute())
+
+    def _get_single_mget_keys(self, keys: List[KeyType]) -> Optional[List[str]]:
+        """
+        Return the given keys if they can be read with a single MGET, otherwise
+        `None`.
+        """
+        plain_keys = [key for key in keys if isinstance(key, str)]
+        if len(keys) > MGET_CHUNK_SIZE or len(plain_keys) < len(keys):
+            return None
+        if self.key_scheme == KEY_SCHEME_CLUSTER:
+            if len({get_key_slot(key) for key in plain_keys}) > 1:
+                return None
+        return plain_keys
+
+    def _chunk_keys(self, keys: List[str]) -> List[List[str]]:
+        """
+        Split the given keys into chunks that are read with one MGET each. With
+        the cluster key scheme, all keys of a chunk belong to the same slot.
+        """
+        groups = [keys]
+        if self.key_scheme == KEY_SCHEME_CLUSTER:
+            slots: Dict[int, List[str]] = {}
+            for key in keys:
+                slots.setdefault(get_key_slot(key), []).append(key)
+            groups = list(slots.values())
+        return [
+            group[i : i + MGET_CHUNK_SIZE]
+            for group in groups
+            for i in range(0, len(group), MGET_CHUNK_SIZE)
+        ]
+
+    def _queue_fetch(
+        self, pipe: Any, keys: List[KeyType]
+    ) -> Callable[[List[Any]], Dict[KeyType, Optional[bytes]]]:
+        """
+        Queue the commands to read the given keys on the given pipeline.
+        Returns a function that turns the pipeline's results into the values.
+        """
+        hashes: Dict[str, List[HashField]] = {}
+        bits: List[BitmapField] = []
+        plain_keys: List[str] = []
+        for key in keys:
+            if isinstance(key, HashField):
+                hashes.setdefault(key.key, []).append(key)
+            elif isinstance(key, BitmapField):
+                bits.append(key)
+            else:
+                plain_keys.append(key)
+
+        # Split very large reads into multiple MGETs that are sent at once, to
+        # not block Redis for too long with a single command. Fields of hashes
+        # are fetched with one HMGET per hash, and bits with two GETBITs each, in
+        # the same pipeline.
+        chunks = self._chunk_keys(plain_keys)
+        for chunk in chunks:
+            pipe.mget(chunk)
+        for key, fields in hashes.items():
+            pipe.hmget(key, [field.field for field in fields])
+        for bit in bits:
+            pipe.getbit(bit.enabled, bit.offset)
+            pipe.getbit(bit.disabled, bit.offset)
+
+        def parse(results: List[Any]) -> Dict[KeyType, Optional[bytes]]:
+            results_iter = iter(results)
+            values: Dict[KeyType, Optional[bytes]] = {}
+            for chunk in chunks:
+                values.update(zip(chunk, next(results_iter)))
+            for fields in hashes.values():
+                values.update(zip(fields, next(results_iter)))
+            for bit in bits:
+                enabled, disabled = next(results_iter), next(results_iter)
+                values[bit] = RAW_TRUE if enabled else RAW_FALSE if disabled else None
+            return values
+
+        return parse
+
+    def _seed(self, key: str, default: Any) -> bytes:
+        generation = self._local_cache.generation if self._local_cache else 0
+        # Only the very first read of a flag persists its default value. Reading
+        # it back from the same client avoids any replication lag.
+        self._redis_client.setnx(key, default)
+        value = self._redis_client.get(key)
+        if self._local_cache is not None:
+            self._local_cache.set_many({key: value}, generation)
+        return value
+
+    def _seed_many(self, defaults: Dict[str, Any]) -> Dict[KeyType, Optional[bytes]]:
+        """
+        Same as `_seed()`, but for many keys in a single round trip.
+        """
+        generation = self._local_cache.generation if self._local_cache else 0
+        with self._redis_client.pipeline(transaction=False) as pipe:
+            for key, default in defaults.items():
+                pipe.setnx(key, default)
+                pipe.get(key)
+            results = pipe.execute()
+        values: Dict[KeyType, Optional[bytes]] = dict(zip(defaults, results[1::2]))
+        if self._local_cache is not None:
+            self._local_cache.set_many(values, generation)
+        return values
+
+    def _load_state(self) -> Dict[KeyType, Optional[bytes]]:
+        """
+        Load the values of all flags, samples, and switches, including all group
+        overrides, as well as the extension's version from Redis.
+        """
+        flags: List[AbstractFlag] = [
+            *self.flags.values(),
+            *self.samples.values(),
+            *self.switches.values(),
+        ]
+        group_keys = {
+            group_id: [
+                flag._get_group_keys(self, group_id) for flag in self.flags.values()
+            ]
+            for group_id in self.group_funcs or {}
+        }
+        rollout_keys: List[KeyType] = [
+            keys.rollout for all_keys in group_keys.values() for keys in all_keys
+        ]
+        object_keys: List[KeyType] = []
+        overrides: Dict[KeyType, Optional[bytes]] = {}
+        with self._redis_read_client.pipeline(transaction=False) as pipe:
+            # Read before the state, so the version is never newer than it
+            pipe.get(self._version_key)
+            for group_id, all_keys in group_keys.items():
+                group_storage = self.get_group_storage(group_id)
+                for keys in all_keys:
+                    if group_storage == GROUP_STORAGE_HASH:
+                        pipe.hgetall(keys.hash)
+                    elif group_storage == GROUP_STORAGE_BITMAP:
+                        pipe.mget([keys.enabled, keys.disabled])
+                    else:
+                        pipe.smembers(keys.tracking)
+            results = iter(pipe.execute())
+        version = next(results)
+
+        for group_id, all_keys in group_keys.items():
+            group_storage = self.get_group_storage(group_id)
+            for keys, result in zip(all_keys, results):
+                if group_storage == GROUP_STORAGE_HASH:
+                    overrides.update(
+                        (HashField(keys.hash, field.decode()), value)
+                        for field, value in result.items()
+                    )
+                elif group_storage == GROUP_STORAGE_BITMAP:
+                    enabled, disabled = result
+                    # Enabled wins over disabled, same as in `_fetch()`
+                    for data, value in ((disabled, RAW_FALSE), (enabled, RAW_TRUE)):
+                        overrides.update(
+                            (BitmapField(keys.enabled, keys.disabled, offset), value)
+                            for offset in iter_bits(data)
+                        )
+                else:
+                    object_keys.extend(object_key.decode() for object_key in result)
+
+        flag_keys = [flag._get_key(self) for flag in flags]
+        values = self._fetch(flag_keys + rollout_keys + object_keys)
+        values.update(overrides)
+        values[self._version_key] = version
+        for flag, key in zip(flags, flag_keys):
+            if values[key] is None:
+                values[key] = flag._seed_default(self)
+        return values
+
+    @contextmanager
+    def _transaction(self, keys: Optional[List[KeyType]]) -> Iterator[Pipeline]:
+        """
+        Write changes to the given keys atomically, along with bumping the
+        extension's version and publishing an invalidation message. If `keys` is
+        `None`, all cached values are invalidated.
+
+        With the cluster key scheme, the transaction only contains the changes,
+        which are all to keys of one flag's slot. The version is bumped in a
+        separate round trip right after it, as its key can be in another slot.
+        Cluster clients of redis-py before 6.1 don't support transactions, so the
+        changes are then written in a plain pipeline instead.
+        """
+        cluster = self.key_scheme == KEY_SCHEME_CLUSTER
+        try:
+            pipeline = self._redis_client.pipeline(transaction=True)
+        except RedisClusterException:
+            pipeline = self._redis_client.pipeline(transaction=False)
+        with pipeline as pipe:
+            yield pipe
+            if not cluster:
+                self._bump_version(pipe, keys)
+            pipe.execute()
+        if cluster:
+            with self._redis_client.pipeline(transaction=False) as pipe:
+                self._bump_version(pipe, keys)
+                pipe.execute()
+
+        if self._local_cache is not None:
+            self._local_cache.invalidate(self._get_invalidated_keys(keys))
+        if self._refresher is not None:
+            self._refresher.update(self._get_invalidated_keys(keys))
+
+    def _bump_version(self, pipe: Pipeline, keys: Optional[List[KeyType]]) -> None:
+        pipe.incr(self._version_key)
+        if self._local_cache is not None:
+            pipe.publish(
+                self._invalidation_channel,
+                json.dumps(self._get_invalidated_keys(keys)),
+            )
+
+    def _get_invalidated_keys(
+        self, keys: Optional[List[KeyType]]
+    ) -> Optional[List[KeyType]]:
+        # The version changes along with any other key
+        return None if keys is None else [*keys, self._version_key]
+
+    def get_version(self) -> int:
+        """
+        Return the extension's version, which changes with every change to any of
+        its flags, samples, or switches.
+
+        It is read from the same source as their values, e.g. the snapshot or the
+        local cache, so it never announces changes that aren't visible yet.
+        """
+        return int(self._get(self._version_key) or 0)
+
+    def get_group_ids(self) -> Dict[str, Optional[str]]:
+        """
+        Return the object ID of the current request for each group.
+
+        The group functions are only called once per request. Use
+        `clear_group_ids()` when their results change within a request, e.g.
+        after a user logged in. Outside of requests, they are called every time.
+        """
+        if not has_request_context():
+            return self._call_group_funcs()
+        group_ids = g.get("pancake_group_ids", {}).get(self.name)
+        if group_ids is None:
+            group_ids = self._call_group_funcs()
+            g.setdefault("pancake_group_ids", {})[self.name] = group_ids
+        return dict(group_ids)
+
+    def _call_group_funcs(self) -> Dict[str, Optional[str]]:
+        return {group_id: func() for group_id, func in (self.group_funcs or {}).items()}
+
+    def clear_group_ids(self) -> None:
+        """
+        Forget the object IDs of the current request for all groups, as well as
+        all flag results that depend on them.
+        """
+        g.get("pancake_group_ids", {}).pop(self.name, None)
+        g.get("pancake_cache", {}).pop(self.name, None)
+
+    def _select(
+        self, names: Optional[Iterable[str]]
+    ) -> Tuple[Dict[str, Flag], Dict[str, Sample], Dict[str, Switch]]:
+        flags, samples, switches = self.flags, self.samples, self.switches
+        if names is not None:
+            names = set(names)
+            unknown = names - flags.keys() - samples.keys() - switches.keys()
+            if unknown:
+                raise ValueError(
+                    "Unknown flag, sample, or switch "
+                    + ", ".join(repr(name) for name in sorted(unknown))
+                    + f" in FlaskPancake extension '{self.name}'."
+                )
+            flags = {name: flag for name, flag in flags.items() if name in names}
+            samples = {name: flag for name, flag in samples.items() if name in names}
+            switches = {name: flag for name, flag in switches.items() if name in names}
+        return flags, samples, switches
+
+    @staticmethod
+    def _make_snapshot(
+        flags: Dict[str, Flag],
+        samples: Dict[str, Sample],
+        switches: Dict[str, Switch],
+        results: Dict[AbstractFlag, bool],
+    ) -> Snapshot:
+        return Snapshot(
+            flags=MappingProxyType({n: results[f] for n, f in flags.items()}),
+            samples=MappingProxyType({n: results[f] for n, f in samples.items()}),
+            switches=MappingProxyType({n: results[f] for n, f in switches.items()}),
+        )
+
+    def _load_results(
+        self, flags: Iterable[AbstractFlag]
+    ) -> Tuple[Dict[AbstractFlag, bool], List[AbstractFlag]]:
+        """
+        Return the results that are already known in the current request, and
+        the flags, samples, and switches that still need to be evaluated.
+        """
+        results: Dict[AbstractFlag, bool] = {}
+        pending: List[AbstractFlag] = []
+        for flag in flags:
+            result = flag._load_result(self)
+            if result is None:
+                pending.append(flag)
+            else:
+                results[flag] = result
+        return results, pending
+
+    def evaluate(self, names: Optional[Iterable[str]] = None) -> Snapshot:
+        """
+        Evaluate the flags, samples, and switches with the given names (or all of
+        them) for the current request.
+
+        All values that are not yet known in the current request are fetched from
+        Redis at once.
+        """
+        flags, samples, switches = self._select(names)
+        results, pending = self._load_results(
+            [*flags.values(), *samples.values(), *switches.values()]
+        )
+        if pending:
+            group_ids = self.get_group_ids() if flags else {}
+            keys = [flag._get_keys(self, group_ids) for flag in pending]
+            values = self._mget(chain.from_iterable(keys))
+            for flag, flag_keys in zip(pending, keys):
+                results[flag] = flag._from_values(
+                    self, group_ids, [values[key] for key in flag_keys]
+                )
+
+        return self._make_snapshot(flags, samples, switches, results)
+
+    def evaluate_all(self) -> Snapshot:
+        """
+        Evaluate all flags, samples, and switches for the current request.
+        """
+        return self.evaluate()
+
+    async def _evaluate_async(
+        self, flags: Iterable[AbstractFlag], group_ids: Dict[str, Optional[str]]
+    ) -> Dict[AbstractFlag, bool]:
+        results, pending = self._load_results(flags)
+        if pending:
+            keys = [flag._get_keys(self, group_ids) for flag in pending]
+            values = await self._mget_async(chain.from_iterable(keys))
+            # Persist missing default values up front, as doing so while
+            # evaluating the flags would block the event loop.
+            defaults = {
+                key: flag._raw_default()
+                for flag, key in ((flag, flag._get_key(self)) for flag in pending)
+                if values[key] is None
+            }
+            if defaults:
+                values.update(await self._run_sync(self._seed_many, defaults))
+            for flag, flag_keys in zip(pending, keys):
+                results[flag] = flag._from_values(
+                    self, group_ids, [values[key] for key in flag_keys]
+                )
+        return results
+
+    async def evaluate_async(self, names: Optional[Iterable[str]] = None) -> Snapshot:
+        """
+        Same as `evaluate()`, but doesn't block the event loop while reading from
+        Redis.
+        """
+        flags, samples, switches = self._select(names)
+        group_ids = self.get_group_ids() if flags else {}
+        results = await self._evaluate_async(
+            [*flags.values(), *samples.values(), *switches.values()], group_ids
+        )
+        return self._make_snapshot(flags, samples, switches, results)
+
+    async def evaluate_all_async(self) -> Snapshot:
+        """
+        Same as `evaluate_all()`, but doesn't block the event loop while reading
+        from Redis.
+        """
+        return await self.evaluate_async()
+
 
 class GroupFunc(abc.ABC):
     @abc.abstractmethod
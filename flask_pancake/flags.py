@@ -2,19 +2,54 @@ from __future__ import annotations
 
 import abc
 import random
-from typing import TYPE_CHECKING, Dict, Generic, Optional, Tuple, TypeVar
-
-from cached_property import cached_property
-from flask import current_app, g
-
-from .constants import EXTENSION_NAME, RAW_FALSE, RAW_TRUE
+from contextlib import contextmanager
+from itertools import chain
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Generic,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+from flask import current_app, g, has_request_context
+
+from .constants import (
+    EXTENSION_NAME,
+    GROUP_STORAGE_BITMAP,
+    GROUP_STORAGE_HASH,
+    GROUP_STORAGE_KEYS,
+    GROUP_STORAGES,
+    KEY_SCHEME_CLUSTER,
+    RAW_FALSE,
+    RAW_TRUE,
+)
 from .registry import registry
+from .utils import (
+    BitmapField,
+    HashField,
+    KeyType,
+    batched,
+    get_bucket,
+    is_bitmap_offset,
+    iter_bits,
+    load_sample_state,
+    update_sample_state,
+)
 
 if TYPE_CHECKING:
-    from flask_redis import FlaskRedis
+    from redis.client import Pipeline
 
     from .extension import FlaskPancake
-    from .utils import GroupFuncType
+    from .storage import Storage
 
 
 __all__ = ["Flag", "Sample", "Switch"]
@@ -23,6 +58,19 @@ __all__ = ["Flag", "Sample", "Switch"]
 DEFAULT_TYPE = TypeVar("DEFAULT_TYPE")
 
 
+class GroupKeys(NamedTuple):
+    # Prefix of the keys holding the overrides of individual objects
+    object_prefix: str
+    # Set of all object keys with an override
+    tracking: str
+    rollout: str
+    # Hash holding the overrides of all objects, keyed by object ID
+    hash: str
+    # Bitmaps of the objects the flag is enabled / disabled for
+    enabled: str
+    disabled: str
+
+
 class AbstractFlag(abc.ABC, Generic[DEFAULT_TYPE]):
     name: str
     default: DEFAULT_TYPE
@@ -34,6 +82,9 @@ class AbstractFlag(abc.ABC, Generic[DEFAULT_TYPE]):
         self.name = name
         self.set_default(default)
         self.extension = extension if extension is not None else EXTENSION_NAME
+        # The keys for each key scheme, as several apps can each have an
+        # extension with the same name but a different key scheme.
+        self._scheme_keys: Dict[str, str] = {}
 
         registry.register(self)
 
@@ -42,22 +93,113 @@ class AbstractFlag(abc.ABC, Generic[DEFAULT_TYPE]):
 
     @property
     def ext(self) -> "FlaskPancake":
+        # Several apps can each have their own extension with the same name.
         return current_app.extensions[self.extension]
 
     @property
-    def _redis_client(self) -> FlaskRedis:
-        return current_app.extensions[self.ext.redis_extension_name]
+    def _redis_client(self) -> Storage:
+        return self.ext._redis_client
 
-    @cached_property
+    @property
+    def _redis_read_client(self) -> Storage:
+        return self.ext._redis_read_client
+
+    @property
     def key(self) -> str:
-        return f"{self.__class__.__name__.upper()}:{self.extension}:{self.name.upper()}"
+        return self._get_key(self.ext)
+
+    def _get_key(self, ext: FlaskPancake) -> str:
+        key = self._scheme_keys.get(ext.key_scheme)
+        if key is None:
+            key = self._scheme_keys[ext.key_scheme] = self._make_key(ext.key_scheme)
+        return key
+
+    def _make_key(self, key_scheme: str) -> str:
+        kind, name = self.__class__.__name__.upper(), self.name.upper()
+        if key_scheme == KEY_SCHEME_CLUSTER:
+            # All flags, samples, and switches of an extension share a slot
+            return f"{kind}:{{{self.extension}}}:{name}"
+        return f"{kind}:{self.extension}:{name}"
 
     @abc.abstractmethod
     def is_active(self) -> bool:
         raise NotImplementedError  # pragma: no cover
 
+    # The methods evaluating the flag get the extension passed in, so it is only
+    # looked up on the current app once per evaluation.
+
+    def _load_result(self, ext: FlaskPancake) -> Optional[bool]:
+        """
+        Return the result of `is_active()` if it is already known for the
+        current request.
+        """
+        return self._load_from_cache(self._get_key(ext))
+
+    def _get_keys(
+        self, ext: FlaskPancake, group_ids: Dict[str, Optional[str]]
+    ) -> List[KeyType]:
+        """
+        Return the Redis keys whose values `_from_values()` needs to evaluate the
+        flag, given the current request's object ID for each group.
+        """
+        return [self._get_key(ext)]
+
+    def _from_values(
+        self,
+        ext: FlaskPancake,
+        group_ids: Dict[str, Optional[str]],
+        values: List[Optional[bytes]],
+    ) -> bool:
+        """
+        Evaluate the flag from the values of the keys returned by `_get_keys()`
+        and remember the result for the current request.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    async def is_active_async(self) -> bool:
+        """
+        Same as `is_active()`, but doesn't block the event loop while reading from
+        Redis.
+        """
+        results = await self.ext._evaluate_async([self], {})
+        return results[self]
+
+    def _raw_default(self) -> Any:
+        """
+        Return the default value as it is stored in Redis.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def _seed_default(self, ext: FlaskPancake) -> bytes:
+        return ext._seed(self._get_key(ext), self._raw_default())
+
+    def _load_from_cache(self, key: str) -> Optional[bool]:
+        # Outside of requests, `g` can live as long as the app context, e.g. in
+        # a worker, which must see changes made elsewhere.
+        if not has_request_context():
+            return None
+        return g.get("pancake_cache", {}).get(self.extension, {}).get(key)
+
+    def _store_in_cache(self, key: str, value: bool) -> bool:
+        if has_request_context():
+            g.setdefault("pancake_cache", {}).setdefault(self.extension, {})[
+                key
+            ] = value
+        return value
+
+    @contextmanager
+    def _transaction(self, *keys: KeyType) -> Iterator[Pipeline]:
+        """
+        Write changes to the given keys atomically. Without any keys, all cached
+        values of the extension are invalidated.
+        """
+        with self.ext._transaction(list(keys) or None) as pipe:
+            yield pipe
+        g.get("pancake_cache", {}).pop(self.extension, None)
+
     def clear(self) -> None:
-        self._redis_client.delete(self.key)
+        with self._transaction(self.key) as pipe:
+            pipe.delete(self.key)
 
 
 class BaseFlag(AbstractFlag[bool], abc.ABC):
@@ -70,14 +212,37 @@ class BaseFlag(AbstractFlag[bool], abc.ABC):
         super().set_default(default)
 
     def is_active(self) -> bool:
-        self._redis_client.setnx(self.key, int(self.default))
-        return self._redis_client.get(self.key) == RAW_TRUE
+        ext = self.ext
+        key = self._get_key(ext)
+        value = self._load_from_cache(key)
+        if value is not None:
+            return value
+        return self._from_global_value(ext, ext._get(key))
+
+    def _from_values(
+        self,
+        ext: FlaskPancake,
+        group_ids: Dict[str, Optional[str]],
+        values: List[Optional[bytes]],
+    ) -> bool:
+        (value,) = values
+        return self._from_global_value(ext, value)
+
+    def _from_global_value(self, ext: FlaskPancake, value: Optional[bytes]) -> bool:
+        if value is None:
+            value = self._seed_default(ext)
+        return self._store_in_cache(self._get_key(ext), value == RAW_TRUE)
+
+    def _raw_default(self) -> int:
+        return int(self.default)
 
     def disable(self) -> None:
-        self._redis_client.set(self.key, 0)
+        with self._transaction(self.key) as pipe:
+            pipe.set(self.key, 0)
 
     def enable(self) -> None:
-        self._redis_client.set(self.key, 1)
+        with self._transaction(self.key) as pipe:
+            pipe.set(self.key, 1)
 
 
 class Flag(BaseFlag):
@@ -85,57 +250,180 @@ class Flag(BaseFlag):
     A feature flag.
 
     Flags are active (or not) on a per-request / user basis.
+
+    Besides overrides for individual objects of a group, a flag can be rolled
+    out to a percentage of a group's objects. Objects are assigned to the
+    rollout by a hash of their ID, so the same objects stay in the rollout as
+    the percentage grows.
     """
 
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
-        self._keys: Dict[str, Tuple[str, str]] = {}
+        # Keyed by key scheme and group ID
+        self._keys: Dict[Tuple[str, str], GroupKeys] = {}
 
-    def _get_group_keys(self, group_id: str) -> Tuple[str, str]:
-        if group_id in self._keys:
-            return self._keys[group_id]
-        if self.ext.group_funcs is None:
+    def _get_group_keys(self, ext: FlaskPancake, group_id: str) -> GroupKeys:
+        if (ext.key_scheme, group_id) in self._keys:
+            return self._keys[ext.key_scheme, group_id]
+        if ext.group_funcs is None:
             raise RuntimeError(
                 f"No group_funcs defined on FlaskPancake extension '{self.extension}'. "
                 "If you don't have users or other types of groups in your application "
                 "and want a global flag to turn things on and off, use a `Switch` "
                 "instead."
             )
-        if group_id not in self.ext.group_funcs:
+        if group_id not in ext.group_funcs:
             raise RuntimeError(
                 f"Invalid group identifer '{group_id}'. This group doesn't seem to be "
                 f"registered in the FlaskPancake extension '{self.extension}'."
             )
 
-        object_key = f"FLAG:{self.extension}:k:{group_id}:{self.name.upper()}"
-        tracking_key = f"FLAG:{self.extension}:t:{group_id}:{self.name.upper()}"
-        r = self._keys[group_id] = (object_key, tracking_key)
+        r = self._keys[ext.key_scheme, group_id] = self._make_group_keys(
+            group_id, ext.key_scheme
+        )
         return r
 
-    def _get_object_key(
-        self, group_id: str, *, func: GroupFuncType = None, object_id: str = None
-    ):
-        object_key_prefix, _ = self._get_group_keys(group_id)
+    def _make_group_keys(self, group_id: str, key_scheme: str) -> GroupKeys:
+        if key_scheme == KEY_SCHEME_CLUSTER:
+            # All group keys of a flag share a slot, including the object keys
+            template = "FLAG:{{{ext}:{name}}}:{kind}:{group_id}"
+        else:
+            template = "FLAG:{ext}:{kind}:{group_id}:{name}"
+
+        def make_key(kind: str) -> str:
+            return template.format(
+                ext=self.extension, name=self.name.upper(), kind=kind, group_id=group_id
+            )
+
+        return GroupKeys(
+            object_prefix=make_key("k"),
+            tracking=make_key("t"),
+            rollout=make_key("p"),
+            hash=make_key("h"),
+            enabled=make_key("e"),
+            disabled=make_key("d"),
+        )
+
+    def _get_object_id(
+        self, ext: FlaskPancake, group_id: str, object_id: Optional[str]
+    ) -> str:
         if object_id is None:
-            if func is None:
-                func = self.ext.group_funcs[group_id]
-            object_id = func()
+            object_id = ext.get_group_ids()[group_id]
         if object_id is None:
+            raise RuntimeError(f"Cannot derive identifier for group '{group_id}'")
+        return object_id
+
+    def _get_object_key(
+        self, ext: FlaskPancake, group_id: str, *, object_id: str
+    ) -> Optional[KeyType]:
+        """
+        Return the key of the object's override for reading it, or `None` if the
+        group storage layout can't store an override for the object ID.
+        """
+        group_storage = ext.get_group_storage(group_id)
+        if group_storage == GROUP_STORAGE_BITMAP and not is_bitmap_offset(object_id):
             return None
-        return f"{object_key_prefix}:{object_id}"
+        return self._make_object_key(
+            self._get_group_keys(ext, group_id), object_id, group_storage
+        )
+
+    @staticmethod
+    def _make_object_key(
+        group_keys: GroupKeys, object_id: str, group_storage: str
+    ) -> KeyType:
+        if group_storage == GROUP_STORAGE_HASH:
+            return HashField(group_keys.hash, object_id)
+        if group_storage == GROUP_STORAGE_BITMAP:
+            if not is_bitmap_offset(object_id):
+                raise ValueError(
+                    f"Invalid object ID '{object_id}'. The bitmap group storage only "
+                    "supports integer object IDs in the range [0, 2^32)."
+                )
+            return BitmapField(group_keys.enabled, group_keys.disabled, int(object_id))
+        return f"{group_keys.object_prefix}:{object_id}"
+
+    def _get_result_key(self, ext: FlaskPancake) -> str:
+        return f"{self._get_key(ext)}:groups"
 
     def is_active(self) -> bool:
-        if self.ext.group_funcs:
-            for group_id, func in self.ext.group_funcs.items():
-                object_key = self._get_object_key(group_id, func=func)
-                if object_key is not None:
-                    value = self._redis_client.get(object_key)
-                    if value == RAW_TRUE:
-                        return True
-                    elif value == RAW_FALSE:
-                        return False
-
-        return self.is_active_globally()
+        ext = self.ext
+        value = self._load_result(ext)
+        if value is not None:
+            return value
+        # Fetch all group overrides and the global value at once.
+        group_ids = ext.get_group_ids()
+        keys = self._get_keys(ext, group_ids)
+        values = ext._mget(keys)
+        return self._from_values(ext, group_ids, [values[key] for key in keys])
+
+    async def is_active_async(self) -> bool:
+        ext = self.ext
+        results = await ext._evaluate_async([self], ext.get_group_ids())
+        return results[self]
+
+    def _load_result(self, ext: FlaskPancake) -> Optional[bool]:
+        return self._load_from_cache(self._get_result_key(ext))
+
+    def _get_keys(
+        self, ext: FlaskPancake, group_ids: Dict[str, Optional[str]]
+    ) -> List[KeyType]:
+        object_ids = [
+            (group_id, object_id)
+            for group_id, object_id in group_ids.items()
+            if object_id is not None
+        ]
+        keys: List[KeyType] = []
+        for group_id, object_id in object_ids:
+            object_key = self._get_object_key(ext, group_id, object_id=object_id)
+            if object_key is not None:
+                keys.append(object_key)
+        keys.extend(
+            self._get_group_keys(ext, group_id).rollout for group_id, _ in object_ids
+        )
+        keys.append(self._get_key(ext))
+        return keys
+
+    def _from_values(
+        self,
+        ext: FlaskPancake,
+        group_ids: Dict[str, Optional[str]],
+        values: List[Optional[bytes]],
+    ) -> bool:
+        *group_values, global_value = values
+        object_ids = [
+            (group_id, object_id)
+            for group_id, object_id in group_ids.items()
+            if object_id is not None
+        ]
+        # Objects whose ID the group storage can't store have no override value.
+        split = len(group_values) - len(object_ids)
+        overrides = group_values[:split]
+        rollouts = group_values[split:]
+        result_key = self._get_result_key(ext)
+        # The first group with an override wins.
+        for value in overrides:
+            if value == RAW_TRUE:
+                return self._store_in_cache(result_key, True)
+            elif value == RAW_FALSE:
+                return self._store_in_cache(result_key, False)
+
+        # Then, the flag is active if the object of any group is in its rollout.
+        if any(value is not None for value in rollouts):
+            for (group_id, object_id), value in zip(object_ids, rollouts):
+                if value is not None and self._in_rollout(
+                    ext, group_id, object_id, value
+                ):
+                    return self._store_in_cache(result_key, True)
+
+        return self._store_in_cache(
+            result_key, self._from_global_value(ext, global_value)
+        )
+
+    def _in_rollout(
+        self, ext: FlaskPancake, group_id: str, object_id: str, value: bytes
+    ) -> bool:
+        rollout_key = self._get_group_keys(ext, group_id).rollout
+        return get_bucket(rollout_key, object_id) < float(value)
 
     def is_active_globally(self) -> bool:
         return super().is_active()
@@ -143,11 +431,16 @@ class Flag(BaseFlag):
     def is_active_group(
         self, group_id: str, *, object_id: str = None
     ) -> Optional[bool]:
-        object_key = self._get_object_key(group_id, object_id=object_id)
+        ext = self.ext
+        object_key = self._get_object_key(
+            ext, group_id, object_id=self._get_object_id(ext, group_id, object_id)
+        )
         if object_key is None:
-            raise RuntimeError(f"Cannot derive identifier for group '{group_id}'")
-        value = self._redis_client.get(object_key)
+            return None
+        return self._from_override(ext._get(object_key))
 
+    @staticmethod
+    def _from_override(value: Optional[bytes]) -> Optional[bool]:
         if value == RAW_TRUE:
             return True
         elif value == RAW_FALSE:
@@ -155,36 +448,358 @@ class Flag(BaseFlag):
 
         return None
 
-    def _track_object(self, group_id: str, object_key: str):
-        self._redis_client.sadd(self._get_group_keys(group_id)[1], object_key)
+    def _set_override(
+        self, group_id: str, object_id: Optional[str], value: Optional[int]
+    ) -> None:
+        ext = self.ext
+        group_keys = self._get_group_keys(ext, group_id)
+        object_key = self._make_object_key(
+            group_keys,
+            self._get_object_id(ext, group_id, object_id),
+            ext.get_group_storage(group_id),
+        )
+        with self._transaction(object_key) as pipe:
+            self._write_override(pipe, group_keys, object_key, value)
+
+    @staticmethod
+    def _write_override(
+        pipe: Pipeline,
+        group_keys: GroupKeys,
+        object_key: KeyType,
+        value: Optional[int],
+    ) -> None:
+        if isinstance(object_key, HashField):
+            if value is None:
+                pipe.hdel(*object_key)
+            else:
+                pipe.hset(*object_key, value)
+        elif isinstance(object_key, BitmapField):
+            pipe.setbit(object_key.enabled, object_key.offset, value == 1)
+            pipe.setbit(object_key.disabled, object_key.offset, value == 0)
+        elif value is None:
+            pipe.delete(object_key)
+            pipe.srem(group_keys.tracking, object_key)
+        else:
+            pipe.sadd(group_keys.tracking, object_key)
+            pipe.set(object_key, value)
+
+    @classmethod
+    def _write_missing_override(
+        cls,
+        pipe: Pipeline,
+        group_keys: GroupKeys,
+        object_key: KeyType,
+        value: int,
+    ) -> None:
+        """
+        Same as `_write_override()`, but keeps an existing override of the object.
+        Bits can't be set conditionally, so existing overrides in bitmaps must be
+        skipped by the caller.
+        """
+        if isinstance(object_key, HashField):
+            pipe.hsetnx(*object_key, value)
+        elif isinstance(object_key, BitmapField):
+            cls._write_override(pipe, group_keys, object_key, value)
+        else:
+            pipe.sadd(group_keys.tracking, object_key)
+            pipe.setnx(object_key, value)
+
+    @classmethod
+    def _write_overrides(
+        cls,
+        pipe: Pipeline,
+        group_keys: GroupKeys,
+        object_keys: List[KeyType],
+        value: Optional[int],
+    ) -> None:
+        """
+        Same as `_write_override()`, but for many objects of the same group with a
+        constant number of commands for all but the bitmap layout.
+        """
+        if isinstance(object_keys[0], HashField):
+            fields = [key.field for key in object_keys if isinstance(key, HashField)]
+            if value is None:
+                pipe.hdel(group_keys.hash, *fields)
+            else:
+                pipe.hset(group_keys.hash, mapping=dict.fromkeys(fields, value))
+        elif isinstance(object_keys[0], BitmapField):
+            for object_key in object_keys:
+                cls._write_override(pipe, group_keys, object_key, value)
+        else:
+            keys = [key for key in object_keys if isinstance(key, str)]
+            if value is None:
+                pipe.unlink(*keys)
+                pipe.srem(group_keys.tracking, *keys)
+            else:
+                pipe.sadd(group_keys.tracking, *keys)
+                pipe.mset(dict.fromkeys(keys, value))
+
+    def _set_overrides(
+        self,
+        group_id: str,
+        object_ids: Iterable[str],
+        value: Optional[int],
+        batch_size: int,
+    ) -> None:
+        ext = self.ext
+        group_keys = self._get_group_keys(ext, group_id)
+        group_storage = ext.get_group_storage(group_id)
+        # Validate all object IDs before writing anything
+        object_keys = [
+            self._make_object_key(group_keys, object_id, group_storage)
+            for object_id in object_ids
+        ]
+        for batch in batched(object_keys, batch_size):
+            with self._transaction(*batch) as pipe:
+                self._write_overrides(pipe, group_keys, batch, value)
+
+    def _read_overrides(
+        self,
+        client: Storage,
+        group_keys: GroupKeys,
+        group_storage: str,
+        batch_size: int,
+    ) -> Iterator[List[Tuple[str, KeyType, Optional[bytes]]]]:
+        """
+        Yield batches of `(object ID, object key, value)` for all overrides stored
+        in the given group storage layout.
+        """
+        if group_storage == GROUP_STORAGE_HASH:
+            items = client.hscan_iter(group_keys.hash, count=batch_size)
+            for item_batch in batched(items, batch_size):
+                yield [
+                    (field.decode(), HashField(group_keys.hash, field.decode()), value)
+                    for field, value in item_batch
+                ]
+        elif group_storage == GROUP_STORAGE_BITMAP:
+            enabled, disabled = client.mget([group_keys.enabled, group_keys.disabled])
+            # Enabled wins over disabled, same as when reading a single bit
+            bits = chain(
+                ((offset, RAW_FALSE) for offset in iter_bits(disabled)),
+                ((offset, RAW_TRUE) for offset in iter_bits(enabled)),
+            )
+            for bit_batch in batched(bits, batch_size):
+                yield [
+                    (
+                        str(offset),
+                        BitmapField(group_keys.enabled, group_keys.disabled, offset),
+                        value,
+                    )
+                    for offset, value in bit_batch
+                ]
+        else:
+            prefix_length = len(group_keys.object_prefix) + 1
+            members = client.sscan_iter(group_keys.tracking, count=batch_size)
+            for member_batch in batched(members, batch_size):
+                object_keys = [key.decode() for key in member_batch]
+                values = client.mget(object_keys)
+                yield [
+                    (object_key[prefix_length:], object_key, value)
+                    for object_key, value in zip(object_keys, values)
+                ]
 
     def clear_group(self, group_id: str, *, object_id: str = None):
-        object_key = self._get_object_key(group_id, object_id=object_id)
-        if object_key is None:
-            raise RuntimeError(f"Cannot derive identifier for group '{group_id}'")
-        self._redis_client.delete(object_key)
-        self._redis_client.srem(self._get_group_keys(group_id)[1], object_key)
+        self._set_override(group_id, object_id, None)
 
-    def clear_all_group(self, group_id: str) -> None:
-        _, tracking_key = self._get_group_keys(group_id)
-        object_keys = self._redis_client.smembers(tracking_key)
-        if object_keys:
-            self._redis_client.delete(*object_keys)
-            self._redis_client.srem(tracking_key, *object_keys)
+    def clear_group_many(
+        self, group_id: str, object_ids: Iterable[str], *, batch_size: int = 1000
+    ) -> None:
+        """
+        Clear the overrides of the given objects in the group. Every batch of
+        `batch_size` objects is written atomically in a single round trip.
+        """
+        self._set_overrides(group_id, object_ids, None, batch_size)
+
+    def clear_all_group(
+        self,
+        group_id: str,
+        *,
+        batch_size: int = 1000,
+        progress: Optional[Callable[[int], None]] = None,
+    ) -> None:
+        """
+        Clear the overrides of all objects in the group.
+
+        Overrides stored as individual keys are cleared in batches of
+        `batch_size` keys, so Redis is never blocked for long. After each batch,
+        `progress` is called with the number of cleared overrides in that batch.
+        """
+        ext = self.ext
+        group_keys = self._get_group_keys(ext, group_id)
+        group_storage = ext.get_group_storage(group_id)
+        client = self._redis_client
+        if group_storage == GROUP_STORAGE_KEYS:
+            items = client.sscan_iter(group_keys.tracking, count=batch_size)
+            for object_keys in batched(items, batch_size):
+                with self._transaction(*(key.decode() for key in object_keys)) as pipe:
+                    pipe.unlink(*object_keys)
+                    pipe.srem(group_keys.tracking, *object_keys)
+                if progress is not None:
+                    progress(len(object_keys))
+            return
+
+        if group_storage == GROUP_STORAGE_HASH:
+            keys = [group_keys.hash]
+            count = client.hlen(group_keys.hash)
+        else:
+            keys = [group_keys.enabled, group_keys.disabled]
+            count = client.exists(*keys)
+            if count and progress is not None:
+                count = sum(self.count_group(group_id))
+        if count:
+            # Listing all objects only to invalidate them in the local caches
+            # would defeat the purpose of a single UNLINK.
+            with self._transaction() as pipe:
+                pipe.unlink(*keys)
+            if progress is not None:
+                progress(count)
 
     def disable_group(self, group_id: str, *, object_id: str = None) -> None:
-        object_key = self._get_object_key(group_id, object_id=object_id)
-        if object_key is None:
-            raise RuntimeError(f"Cannot derive identifier for group '{group_id}'")
-        self._track_object(group_id, object_key)
-        self._redis_client.set(object_key, 0)
+        self._set_override(group_id, object_id, 0)
 
     def enable_group(self, group_id: str, *, object_id: str = None) -> None:
-        object_key = self._get_object_key(group_id, object_id=object_id)
-        if object_key is None:
-            raise RuntimeError(f"Cannot derive identifier for group '{group_id}'")
-        self._track_object(group_id, object_key)
-        self._redis_client.set(object_key, 1)
+        self._set_override(group_id, object_id, 1)
+
+    def disable_group_many(
+        self, group_id: str, object_ids: Iterable[str], *, batch_size: int = 1000
+    ) -> None:
+        """
+        Disable the flag for the given objects in the group. Every batch of
+        `batch_size` objects is written atomically in a single round trip.
+        """
+        self._set_overrides(group_id, object_ids, 0, batch_size)
+
+    def enable_group_many(
+        self, group_id: str, object_ids: Iterable[str], *, batch_size: int = 1000
+    ) -> None:
+        """
+        Enable the flag for the given objects in the group. Every batch of
+        `batch_size` objects is written atomically in a single round trip.
+        """
+        self._set_overrides(group_id, object_ids, 1, batch_size)
+
+    def count_group(self, group_id: str) -> Tuple[int, int]:
+        """
+        Return the number of objects in the group the flag is enabled and
+        disabled for.
+
+        With the bitmap group storage these are two `BITCOUNT`s. The other
+        layouts need to read all overrides.
+        """
+        ext = self.ext
+        group_keys = self._get_group_keys(ext, group_id)
+        group_storage = ext.get_group_storage(group_id)
+        if group_storage == GROUP_STORAGE_BITMAP:
+            with self._redis_read_client.pipeline(transaction=False) as pipe:
+                pipe.bitcount(group_keys.enabled)
+                pipe.bitcount(group_keys.disabled)
+                enabled, disabled = pipe.execute()
+            return enabled, disabled
+
+        enabled = disabled = 0
+        overrides = self._read_overrides(
+            self._redis_read_client, group_keys, group_storage, 1000
+        )
+        for batch in overrides:
+            for _, _, value in batch:
+                enabled += value == RAW_TRUE
+                disabled += value == RAW_FALSE
+        return enabled, disabled
+
+    def migrate_group_storage(self, group_id: str, *, batch_size: int = 1000) -> int:
+        """
+        Move all overrides for the given group from any other group storage
+        layout into the extension's configured one, in batches of `batch_size`
+        overrides. Returns the number of moved overrides.
+
+        Overrides that were already written to the configured layout, e.g. by
+        changes made after switching it, are newer and kept.
+        """
+        ext = self.ext
+        group_keys = self._get_group_keys(ext, group_id)
+        group_storage = ext.get_group_storage(group_id)
+        count = 0
+        for source in GROUP_STORAGES:
+            if source != group_storage:
+                count += self._migrate_group_storage(
+                    group_keys, source, group_storage, batch_size
+                )
+        return count
+
+    def _migrate_group_storage(
+        self, group_keys: GroupKeys, source: str, target: str, batch_size: int
+    ) -> int:
+        count = 0
+        # Read from the primary, the replica might lag behind
+        overrides = self._read_overrides(
+            self._redis_client, group_keys, source, batch_size
+        )
+        for batch in overrides:
+            targets = [
+                self._make_object_key(group_keys, object_id, target)
+                for object_id, _, _ in batch
+            ]
+            sources = [object_key for _, object_key, _ in batch]
+            existing = self._get_existing_bits(targets)
+            with self._transaction(*sources, *targets) as pipe:
+                for (_, object_key, value), target_key in zip(batch, targets):
+                    self._write_override(pipe, group_keys, object_key, None)
+                    if value is not None and target_key not in existing:
+                        self._write_missing_override(
+                            pipe, group_keys, target_key, int(value)
+                        )
+            count += len(batch)
+        if source == GROUP_STORAGE_BITMAP:
+            # Clearing all bits leaves empty bitmaps behind
+            self._redis_client.delete(group_keys.enabled, group_keys.disabled)
+        return count
+
+    def _get_existing_bits(self, object_keys: List[KeyType]) -> Set[BitmapField]:
+        """
+        Return the bitmap fields among the given object keys that hold an
+        override, read from the primary.
+        """
+        bits = [key for key in object_keys if isinstance(key, BitmapField)]
+        if not bits:
+            return set()
+        with self._redis_client.pipeline(transaction=False) as pipe:
+            for bit in bits:
+                pipe.getbit(bit.enabled, bit.offset)
+                pipe.getbit(bit.disabled, bit.offset)
+            results = iter(pipe.execute())
+        existing = set()
+        for bit in bits:
+            enabled, disabled = next(results), next(results)
+            if enabled or disabled:
+                existing.add(bit)
+        return existing
+
+    def get_group_rollout(self, group_id: str) -> Optional[float]:
+        """
+        Return the percentage of the group's objects the flag is rolled out to, or
+        `None` if there is no rollout for the group.
+        """
+        ext = self.ext
+        value = ext._get(self._get_group_keys(ext, group_id).rollout)
+        return None if value is None else float(value)
+
+    def set_group_rollout(self, group_id: str, percentage: float) -> None:
+        """
+        Activate the flag for the given percentage of the group's objects.
+        Overrides for individual objects take precedence.
+        """
+        if not (0 <= percentage <= 100):
+            raise ValueError(
+                f"Rollout for flag {self.name} must be in the range [0, 100]."
+            )
+        rollout_key = self._get_group_keys(self.ext, group_id).rollout
+        with self._transaction(rollout_key) as pipe:
+            pipe.set(rollout_key, percentage)
+
+    def clear_group_rollout(self, group_id: str) -> None:
+        rollout_key = self._get_group_keys(self.ext, group_id).rollout
+        with self._transaction(rollout_key) as pipe:
+            pipe.delete(rollout_key)
 
 
 class Switch(BaseFlag):
@@ -201,8 +816,24 @@ class Sample(AbstractFlag[float]):
 
     A sample is active some percentage of the time, but is not connected to users
     or requests.
+
+    If a `group_id` is given, the object ID of that group is used as a stable
+    subject instead: the sample is then active for the same subjects on every
+    request without storing anything in a cookie. Requests without an object ID
+    for that group fall back to the random, cookie-based behavior.
     """
 
+    def __init__(
+        self,
+        name: str,
+        default: float,
+        extension: Optional[str] = None,
+        *,
+        group_id: Optional[str] = None,
+    ) -> None:
+        self.group_id = group_id
+        super().__init__(name, default, extension)
+
     def set_default(self, default: float) -> None:
         if not (0 <= default <= 100):
             raise ValueError(
@@ -210,28 +841,67 @@ class Sample(AbstractFlag[float]):
             )
         super().set_default(default)
 
-    def _load_from_request(self) -> Optional[bool]:
-        return g.get("pancakes", {}).get(self.extension, {}).get(self.name)
+    def _load_from_request(self, ext: FlaskPancake) -> Optional[bool]:
+        return load_sample_state(ext).get(self.name)
 
-    def _store_in_request(self, value: bool):
-        g.setdefault("pancakes", {}).setdefault(self.extension, {})[self.name] = value
+    def _store_in_request(self, ext: FlaskPancake, value: bool):
+        update_sample_state(ext, self.name, value)
 
     def is_active(self) -> bool:
-        value = self._load_from_request()
+        ext = self.ext
+        value = self._load_result(ext)
         if value is not None:
             return value
-        ret = random.uniform(0, 100) <= float(self.get())
-        self._store_in_request(ret)
+        return self._from_values(ext, {}, [ext._get(self._get_key(ext))])
+
+    def _get_subject_id(self, ext: FlaskPancake) -> Optional[str]:
+        if self.group_id is None:
+            return None
+        group_ids = ext.get_group_ids()
+        if self.group_id not in group_ids:
+            raise RuntimeError(
+                f"Invalid group identifer '{self.group_id}'. This group doesn't seem "
+                f"to be registered in the FlaskPancake extension '{self.extension}'."
+            )
+        return group_ids[self.group_id]
+
+    def _load_result(self, ext: FlaskPancake) -> Optional[bool]:
+        if self._get_subject_id(ext) is not None:
+            return None
+        return self._load_from_request(ext)
+
+    def _from_values(
+        self,
+        ext: FlaskPancake,
+        group_ids: Dict[str, Optional[str]],
+        values: List[Optional[bytes]],
+    ) -> bool:
+        (value,) = values
+        subject_id = self._get_subject_id(ext)
+        if subject_id is not None:
+            return get_bucket(self._get_key(ext), subject_id) < self._from_value(
+                ext, value
+            )
+        ret = random.uniform(0, 100) <= self._from_value(ext, value)
+        self._store_in_request(ext, ret)
         return ret
 
     def get(self) -> float:
-        self._redis_client.setnx(self.key, self.default)
-        value = self._redis_client.get(self.key)
+        ext = self.ext
+        return self._from_value(ext, ext._get(self._get_key(ext)))
+
+    def _from_value(self, ext: FlaskPancake, value: Optional[bytes]) -> float:
+        if value is None:
+            value = self._seed_default(ext)
         return float(value)
 
+    def _raw_default(self) -> float:
+        return self.default
+
     def set(self, value: float) -> None:
         if not (0 <= value <= 100):
             raise ValueError(
                 f"Value for sample {self.name} must be in the range [0, 100]."
             )
-        self._redis_client.set(self.key, value)
+        with self._transaction(self.key) as pipe:
+            pipe.set(self.key, value)
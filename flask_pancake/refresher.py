@@ -0,0 +1,302 @@
+from __future__ import annotations
+
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+from types import MappingProxyType
+from typing import IO, TYPE_CHECKING, Dict, Iterable, List, Mapping, Optional
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore
+
+from .utils import load_key
+
+if TYPE_CHECKING:
+    from flask import Flask
+
+    from .extension import FlaskPancake
+    from .utils import KeyType
+
+__all__ = ["SharedSnapshotRefresher", "SnapshotRefresher"]
+
+logger = logging.getLogger(__name__)
+
+# Sequence number and payload length of a shared snapshot
+HEADER = struct.Struct("<QQ")
+# How often to retry reading a shared snapshot that is being written
+READ_RETRIES = 100
+
+
+class SnapshotRefresher:
+    """
+    Periodically load the complete state of a FlaskPancake extension from Redis
+    in a background thread.
+
+    Every load replaces the current snapshot of raw values as a whole. Readers
+    thus never see a partially updated state and never wait for Redis.
+    """
+
+    def __init__(self, ext: FlaskPancake, app: Flask, interval: float) -> None:
+        self.ext = ext
+        self.app = app
+        self.interval = interval
+        self._values: Optional[Mapping[KeyType, Optional[bytes]]] = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def get_many(
+        self, keys: Iterable[KeyType]
+    ) -> Optional[Dict[KeyType, Optional[bytes]]]:
+        """
+        Return the values for the given keys from the current snapshot, or `None`
+        if no snapshot has been loaded yet.
+        """
+        self.start()
+        values = self._values
+        if values is None:
+            return None
+        return {key: values.get(key) for key in keys}
+
+    def refresh(self) -> None:
+        # Serialize loads, so an older state can never replace a newer one.
+        with self._refresh_lock:
+            with self.app.app_context():
+                values = self.ext._load_state()
+            self._values = MappingProxyType(values)
+
+    def update(self, keys: Optional[List[KeyType]]) -> None:
+        """
+        Make changes to the given keys, made by the current process, visible to
+        it right away by reading only these keys into the current snapshot. If
+        `keys` is `None`, the refresher thread loads the complete state instead.
+        """
+        if keys is None:
+            self._wake.set()
+            return
+        with self._refresh_lock:
+            if self._values is not None:
+                values = self.ext._fetch(keys)
+                self._values = MappingProxyType({**self._values, **values})
+
+    def start(self) -> None:
+        """
+        Start the refresher thread for the current process, unless it is already
+        running.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return  # pragma: no cover
+            # A snapshot inherited from before a fork is not refreshed anymore.
+            self._reset()
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="flask-pancake-refresher", daemon=True
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self._update()
+            except Exception:
+                logger.exception("Failed to refresh the flask-pancake snapshot.")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def close(self) -> None:
+        """
+        Stop the refresher thread and drop the current snapshot.
+        """
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._pid = None
+        self._reset()
+
+    def _update(self) -> None:
+        """
+        Called by the refresher thread every `interval` seconds.
+        """
+        self.refresh()
+
+    def _reset(self) -> None:
+        self._values = None
+
+
+def dump_snapshot(values: Mapping[KeyType, Optional[bytes]]) -> bytes:
+    return json.dumps(
+        [
+            [key, None if value is None else value.decode("latin-1")]
+            for key, value in values.items()
+        ],
+        separators=(",", ":"),
+    ).encode()
+
+
+def load_snapshot(data: bytes) -> Dict[KeyType, Optional[bytes]]:
+    return {
+        load_key(key): (None if value is None else value.encode("latin-1"))
+        for key, value in json.loads(data)
+    }
+
+
+class SharedSnapshotRefresher(SnapshotRefresher):
+    """
+    Share one snapshot between all processes on a host.
+
+    The process holding an exclusive lock on `<path>.lock` loads the state from
+    Redis every `interval` seconds and writes it to the memory-mapped file at
+    `path`. All other processes only read the snapshot from that file. If the
+    writing process exits, another one takes over within `interval` seconds.
+
+    Writes are protected by a sequence lock: the sequence number in the header
+    is odd while a write is in progress. Readers retry if the number was odd or
+    changed while they copied the payload, and only decode it again after it
+    changed.
+    """
+
+    def __init__(
+        self, ext: FlaskPancake, app: Flask, interval: float, path: str
+    ) -> None:
+        if fcntl is None:  # pragma: no cover
+            raise RuntimeError("Shared snapshots require fcntl.flock().")
+        super().__init__(ext, app, interval)
+        self.path = path
+        self._lock_file: Optional[IO[bytes]] = None
+        self._map: Optional[mmap.mmap] = None
+        self._sequence = 0
+        self._read_lock = threading.Lock()
+
+    @property
+    def is_writer(self) -> bool:
+        return self._lock_file is not None
+
+    def get_many(
+        self, keys: Iterable[KeyType]
+    ) -> Optional[Dict[KeyType, Optional[bytes]]]:
+        self.start()
+        if not self.is_writer:
+            self._read()
+        return super().get_many(keys)
+
+    def refresh(self) -> None:
+        super().refresh()
+        self._write_values()
+
+    def update(self, keys: Optional[List[KeyType]]) -> None:
+        super().update(keys)
+        if keys is not None:
+            self._write_values()
+
+    def _write_values(self) -> None:
+        if self.is_writer:
+            with self._refresh_lock:
+                if self._values is not None:
+                    self._write(dump_snapshot(self._values))
+
+    def _update(self) -> None:
+        if self._acquire():
+            self.refresh()
+        else:
+            self._read()
+
+    def _acquire(self) -> bool:
+        """
+        Try to become the process writing the snapshot.
+        """
+        if self._lock_file is None:
+            lock_file = open(f"{self.path}.lock", "ab")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+            # Replaced by a writable mapping on the first write
+            self._map = None
+        return True
+
+    def _write(self, payload: bytes) -> None:
+        size = HEADER.size + len(payload)
+        if self._map is None or len(self._map) < size:
+            self._close_map()
+            with open(self.path, "a+b") as f:
+                current = os.fstat(f.fileno()).st_size
+                if current < size:
+                    # Never shrink the file, readers might still map all of it.
+                    os.ftruncate(f.fileno(), max(size, current * 2, 4096))
+                self._map = mmap.mmap(f.fileno(), 0)
+        sequence, _ = HEADER.unpack_from(self._map)
+        # Continue after the last complete write of any previous writer.
+        sequence = (sequence | 1) + 1
+        HEADER.pack_into(self._map, 0, sequence - 1, len(payload))
+        self._map[HEADER.size : size] = payload
+        HEADER.pack_into(self._map, 0, sequence, len(payload))
+        self._sequence = sequence
+
+    def _read(self) -> None:
+        snapshot = self._map
+        if snapshot is None:
+            snapshot = self._open_map()
+            if snapshot is None:
+                return
+        if HEADER.unpack_from(snapshot)[0] == self._sequence:
+            return
+
+        with self._read_lock:
+            for _ in range(READ_RETRIES):
+                sequence, length = HEADER.unpack_from(snapshot)
+                if sequence == self._sequence:
+                    return
+                if sequence % 2:
+                    os.sched_yield()
+                    continue
+                if HEADER.size + length > len(snapshot):
+                    # The writer has grown the file. Other threads may still
+                    # use the old mapping, it is closed once it is unused.
+                    snapshot = self._open_map() or snapshot
+                    continue
+                payload = snapshot[HEADER.size : HEADER.size + length]
+                if HEADER.unpack_from(snapshot)[0] != sequence:
+                    continue
+                self._values = MappingProxyType(load_snapshot(payload))
+                self._sequence = sequence
+                return
+        logger.warning("Failed to read the shared flask-pancake snapshot.")
+
+    def _open_map(self) -> Optional[mmap.mmap]:
+        try:
+            with open(self.path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            # The file doesn't exist or is still empty
+            return None
+        return self._map
+
+    def _close_map(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _reset(self) -> None:
+        super()._reset()
+        self._close_map()
+        if self._lock_file is not None:
+            # After a fork, this only closes the child's copy of the file. The
+            # lock is held until the parent closes its copy as well.
+            self._lock_file.close()
+            self._lock_file = None
+        self._sequence = 0
@@ -0,0 +1,36 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any, Dict, List, Mapping
+
+__all__ = ["Snapshot"]
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """
+    The state of a FlaskPancake extension's flags, samples, and switches for the
+    current request.
+
+    A snapshot is created by `FlaskPancake.evaluate()` or
+    `FlaskPancake.evaluate_all()` and can be queried without talking to Redis.
+    """
+
+    flags: Mapping[str, bool]
+    samples: Mapping[str, bool]
+    switches: Mapping[str, bool]
+
+    def as_dict(self) -> Dict[str, List[Dict[str, Any]]]:
+        return {
+            "flags": [
+                {"name": name, "is_active": value} for name, value in self.flags.items()
+            ],
+            "samples": [
+                {"name": name, "is_active": value}
+                for name, value in self.samples.items()
+            ],
+            "switches": [
+                {"name": name, "is_active": value}
+                for name, value in self.switches.items()
+            ],
+        }
@@ -0,0 +1,335 @@
+from __future__ import annotations
+
+import sys
+import threading
+from functools import partial
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from redis.exceptions import DataError, ResponseError
+
+from .utils import batched
+
+if sys.version_info >= (3, 8):
+    from typing import Protocol
+else:  # pragma: no cover
+    from typing_extensions import Protocol
+
+__all__ = ["MemoryStorage", "Storage"]
+
+EncodableT = Union[bytes, str, int, float]
+ValueT = Union[bytes, Set[bytes], Dict[bytes, bytes]]
+
+
+class Storage(Protocol):
+    """
+    The subset of the redis-py client API that flask-pancake sends commands
+    with. Pipelines must additionally support `bitcount`, `getbit`, `hdel`,
+    `hgetall`, `hmget`, `hset`, `hsetnx`, `incr`, `mset`, `publish`, `sadd`,
+    `set`, `setbit`, `smembers`, `srem`, and `unlink`. With `cache_ttl`, the
+    storage must also support `pubsub()`.
+    """
+
+    def pipeline(self, transaction: bool = True) -> Any:
+        ...  # pragma: no cover
+
+    def get(self, __key: str) -> Any:
+        ...  # pragma: no cover
+
+    def mget(self, __keys: List[str]) -> Any:
+        ...  # pragma: no cover
+
+    def setnx(self, __key: str, __value: Any) -> Any:
+        ...  # pragma: no cover
+
+    def delete(self, *keys: str) -> Any:
+        ...  # pragma: no cover
+
+    def exists(self, *keys: str) -> Any:
+        ...  # pragma: no cover
+
+    def hlen(self, __key: str) -> Any:
+        ...  # pragma: no cover
+
+    def sscan_iter(
+        self, __key: str, *, count: Optional[int] = None
+    ) -> Iterator[Any]:
+        ...  # pragma: no cover
+
+    def hscan_iter(
+        self, __key: str, *, count: Optional[int] = None
+    ) -> Iterator[Any]:
+        ...  # pragma: no cover
+
+
+def _encode(value: EncodableT) -> bytes:
+    # The same conversion redis-py applies to keys and values
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise DataError(
+            f"Invalid input of type: '{type(value).__name__}'. Convert to a bytes, "
+            f"string, int or float first."
+        )
+    return repr(value).encode()
+
+
+class MemoryStorage:
+    """
+    A thread-safe, in-memory storage backend for a single process.
+
+    It implements the subset of the redis-py client API that flask-pancake uses,
+    and stores all values the same way Redis would. Every command, as well as
+    every pipeline as a whole, is executed atomically.
+    """
+
+    def __init__(self) -> None:
+        self._data: Dict[bytes, ValueT] = {}
+        self._lock = threading.RLock()
+
+    def _get_value(self, key: EncodableT, type_: type) -> Optional[Any]:
+        value = self._data.get(_encode(key))
+        if value is not None and not isinstance(value, type_):
+            raise ResponseError(
+                "WRONGTYPE Operation against a key holding the wrong kind of value"
+            )
+        return value
+
+    def pipeline(self, transaction: bool = True) -> MemoryPipeline:
+        return MemoryPipeline(self)
+
+    def flushall(self) -> bool:
+        with self._lock:
+            self._data.clear()
+        return True
+
+    def publish(self, channel: EncodableT, message: EncodableT) -> int:
+        # There are no other processes to notify
+        return 0
+
+    # Generic
+
+    def delete(self, *keys: EncodableT) -> int:
+        with self._lock:
+            return sum(self._data.pop(_encode(key), None) is not None for key in keys)
+
+    unlink = delete
+
+    def exists(self, *keys: EncodableT) -> int:
+        with self._lock:
+            return sum(_encode(key) in self._data for key in keys)
+
+    # Strings
+
+    def get(self, key: EncodableT) -> Optional[bytes]:
+        with self._lock:
+            return self._get_value(key, bytes)
+
+    def mget(
+        self, keys: Union[EncodableT, Iterable[EncodableT]], *args: EncodableT
+    ) -> List[Optional[bytes]]:
+        if isinstance(keys, (bytes, str, int, float)):
+            keys = [keys]
+        with self._lock:
+            values = [self._data.get(_encode(key)) for key in [*keys, *args]]
+        # Redis returns nil for keys that don't hold a string
+        return [value if isinstance(value, bytes) else None for value in values]
+
+    def set(self, key: EncodableT, value: EncodableT) -> bool:
+        with self._lock:
+            self._data[_encode(key)] = _encode(value)
+        return True
+
+    def setnx(self, key: EncodableT, value: EncodableT) -> bool:
+        with self._lock:
+            if _encode(key) in self._data:
+                return False
+            return self.set(key, value)
+
+    def mset(self, mapping: Dict[EncodableT, EncodableT]) -> bool:
+        with self._lock:
+            for key, value in mapping.items():
+                self.set(key, value)
+        return True
+
+    def incr(self, key: EncodableT, amount: int = 1) -> int:
+        with self._lock:
+            value = self._get_value(key, bytes)
+            try:
+                value = int(value or 0) + amount
+            except ValueError:
+                raise ResponseError("value is not an integer or out of range") from None
+            self._data[_encode(key)] = _encode(value)
+        return value
+
+    # Bitmaps
+
+    def getbit(self, key: EncodableT, offset: int) -> int:
+        with self._lock:
+            data = self._get_value(key, bytes) or b""
+        index, bit = divmod(offset, 8)
+        return int(index < len(data) and bool(data[index] & (0x80 >> bit)))
+
+    def setbit(self, key: EncodableT, offset: int, value: int) -> int:
+        index, bit = divmod(offset, 8)
+        with self._lock:
+            data = bytearray(self._get_value(key, bytes) or b"")
+            if index >= len(data):
+                data.extend(bytes(index + 1 - len(data)))
+            previous = int(bool(data[index] & (0x80 >> bit)))
+            if value:
+                data[index] |= 0x80 >> bit
+            else:
+                data[index] &= ~(0x80 >> bit) & 0xFF
+            self._data[_encode(key)] = bytes(data)
+        return previous
+
+    def bitcount(self, key: EncodableT) -> int:
+        with self._lock:
+            data = self._get_value(key, bytes) or b""
+        return sum(bin(byte).count("1") for byte in data)
+
+    # Sets
+
+    def sadd(self, key: EncodableT, *members: EncodableT) -> int:
+        with self._lock:
+            value = self._get_value(key, set)
+            if value is None:
+                value = self._data[_encode(key)] = set()
+            size = len(value)
+            value.update(_encode(member) for member in members)
+            return len(value) - size
+
+    def srem(self, key: EncodableT, *members: EncodableT) -> int:
+        with self._lock:
+            value = self._get_value(key, set)
+            if value is None:
+                return 0
+            size = len(value)
+            value.difference_update(_encode(member) for member in members)
+            if not value:
+                del self._data[_encode(key)]
+            return size - len(value)
+
+    def smembers(self, key: EncodableT) -> Set[bytes]:
+        with self._lock:
+            return set(self._get_value(key, set) or ())
+
+    def sscan_iter(
+        self, key: EncodableT, count: Optional[int] = None
+    ) -> Iterator[bytes]:
+        # Like SSCAN, members added or removed while iterating may be missed.
+        for batch in batched(self.smembers(key), count or 10):
+            yield from batch
+
+    # Hashes
+
+    def hset(
+        self,
+        key: EncodableT,
+        field: Optional[EncodableT] = None,
+        value: Optional[EncodableT] = None,
+        mapping: Optional[Dict[EncodableT, EncodableT]] = None,
+    ) -> int:
+        items: Dict[EncodableT, Any] = dict(mapping or {})
+        if field is not None:
+            items[field] = value
+        if not items:
+            raise DataError("'hset' with no key value pairs")
+        with self._lock:
+            data = self._get_value(key, dict)
+            if data is None:
+                data = self._data[_encode(key)] = {}
+            size = len(data)
+            data.update((_encode(f), _encode(v)) for f, v in items.items())
+            return len(data) - size
+
+    def hsetnx(self, key: EncodableT, field: EncodableT, value: EncodableT) -> bool:
+        with self._lock:
+            data = self._get_value(key, dict)
+            if data is not None and _encode(field) in data:
+                return False
+            return self.hset(key, field, value) == 1
+
+    def hdel(self, key: EncodableT, *fields: EncodableT) -> int:
+        with self._lock:
+            data = self._get_value(key, dict)
+            if data is None:
+                return 0
+            deleted = sum(
+                data.pop(_encode(field), None) is not None for field in fields
+            )
+            if not data:
+                del self._data[_encode(key)]
+            return deleted
+
+    def hmget(
+        self, key: EncodableT, fields: Union[EncodableT, List[EncodableT]], *args
+    ) -> List[Optional[bytes]]:
+        fields = [*fields, *args] if isinstance(fields, list) else [fields, *args]
+        with self._lock:
+            data = self._get_value(key, dict) or {}
+            return [data.get(_encode(field)) for field in fields]
+
+    def hlen(self, key: EncodableT) -> int:
+        with self._lock:
+            return len(self._get_value(key, dict) or ())
+
+    def hgetall(self, key: EncodableT) -> Dict[bytes, bytes]:
+        with self._lock:
+            return dict(self._get_value(key, dict) or {})
+
+    def hscan_iter(
+        self, key: EncodableT, count: Optional[int] = None
+    ) -> Iterator[Tuple[bytes, bytes]]:
+        for batch in batched(self.hgetall(key).items(), count or 10):
+            yield from batch
+
+
+class MemoryPipeline:
+    """
+    Queue commands and execute them atomically, like a Redis `MULTI` / `EXEC`.
+    """
+
+    def __init__(self, storage: MemoryStorage) -> None:
+        self._storage = storage
+        self._commands: List[Callable[[], Any]] = []
+
+    def __enter__(self) -> MemoryPipeline:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.reset()
+
+    def __getattr__(self, name: str) -> Callable[..., MemoryPipeline]:
+        if name.startswith("_") or name in {"pipeline", "sscan_iter", "hscan_iter"}:
+            raise AttributeError(name)
+        command = getattr(self._storage, name)
+
+        def queue(*args, **kwargs) -> MemoryPipeline:
+            self._commands.append(partial(command, *args, **kwargs))
+            return self
+
+        return queue
+
+    def reset(self) -> None:
+        self._commands = []
+
+    def execute(self) -> List[Any]:
+        with self._storage._lock:
+            try:
+                return [command() for command in self._commands]
+            finally:
+                self.reset()
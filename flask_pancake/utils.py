@@ -1,17 +1,105 @@
+import hashlib
 import importlib
-from typing import TYPE_CHECKING, Any, Callable, Optional, Union
+from functools import lru_cache
+from itertools import islice
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    TypeVar,
+    Union,
+)
 
 import click
-from flask import Response, current_app, g, request
+from flask import Response, current_app, g, has_request_context, request
 from itsdangerous import BadData, URLSafeSerializer
 
-from .constants import COOKIE_SALT
+from .constants import COOKIE_SALT, COOKIE_VERSION
 
 if TYPE_CHECKING:
     from .extension import FlaskPancake
 
 GroupFuncType = Callable[[], Optional[str]]
 
+T = TypeVar("T")
+
+
+class HashField(NamedTuple):
+    """
+    A field of a Redis hash, which is read and cached like a regular key.
+    """
+
+    key: str
+    field: str
+
+
+class BitmapField(NamedTuple):
+    """
+    The bit at `offset` in a pair of Redis bitmaps, which is read and cached like
+    a regular key. Its value is `RAW_TRUE` if the bit is set in the `enabled`
+    bitmap, `RAW_FALSE` if it is set in the `disabled` bitmap, and `None`
+    otherwise.
+    """
+
+    enabled: str
+    disabled: str
+    offset: int
+
+
+KeyType = Union[str, HashField, BitmapField]
+
+
+def is_bitmap_offset(object_id: str) -> bool:
+    """
+    Return whether the given object ID can be stored as an offset in a bitmap.
+    """
+    offset = str(object_id)
+    return offset.isascii() and offset.isdigit() and int(offset) < 1 << 32
+
+
+def load_key(key: Any) -> KeyType:
+    """
+    Return the key for a JSON-decoded key. Fields of hashes and bitmaps are
+    serialized as lists.
+    """
+    if isinstance(key, list):
+        return HashField(*key) if len(key) == 2 else BitmapField(*key)
+    return key
+
+
+def get_key_slot(key: str) -> int:
+    """
+    Return the Redis Cluster slot of the given key, honoring hash tags.
+    """
+    from redis.crc import key_slot
+
+    return key_slot(key.encode())
+
+
+def batched(iterable: Iterable[T], size: int) -> Iterator[List[T]]:
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+def iter_bits(data: Optional[bytes]) -> Iterator[int]:
+    """
+    Yield the offsets of all set bits in a Redis bitmap.
+    """
+    for i, byte in enumerate(data or b""):
+        if byte:
+            for bit in range(8):
+                if byte & (0x80 >> bit):
+                    yield i * 8 + bit
+
 
 def import_from_string(fqn: str) -> GroupFuncType:
     if fqn.count(":") != 1:
@@ -32,43 +120,107 @@ def format_flag_state_cli(value: Optional[bool]) -> str:
     return click.style("No", fg="red")
 
 
-def decode_sample_state(s: Union[str, bytes]) -> Any:
+def get_bucket(key: str, subject_id: str) -> float:
+    """
+    Map the given key and subject ID to a stable value in the range [0, 100).
+
+    The buckets of the same subject are independent for different keys, so the
+    rollouts of different samples or flags don't overlap more than by chance.
+    """
+    digest = hashlib.blake2b(f"{key}:{subject_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / (1 << 64) * 100
+
+
+@lru_cache(maxsize=8)
+def _get_serializer(secret_key: Union[str, bytes]) -> URLSafeSerializer:
+    return URLSafeSerializer(secret_key, COOKIE_SALT)
+
+
+@lru_cache(maxsize=1024)
+def _get_sample_id(name: str) -> int:
+    """
+    Return the ID of the sample with the given name in the cookie. It only
+    depends on the name, so adding or removing other samples doesn't change it.
+    """
+    digest = hashlib.blake2b(name.encode(), digest_size=4).digest()
+    return int.from_bytes(digest, "big")
+
+
+def decode_sample_state(
+    s: Union[str, bytes], ext: Optional["FlaskPancake"] = None
+) -> Any:
     if current_app.secret_key is None:
         raise RuntimeError(
             "Cannot load sample flags cookie since app.SECRET_KEY is not set."
         )
-    serializer = URLSafeSerializer(current_app.secret_key, COOKIE_SALT)
-    return serializer.loads(s)
-
-
-def encode_sample_state(o: Any) -> str:
+    data = _get_serializer(current_app.secret_key).loads(s)
+    if ext is None or isinstance(data, dict):
+        # Cookies written before the compact encoding are plain dicts
+        return data
+    version, *payload = data
+    if version == COOKIE_VERSION:
+        # Samples that are unknown, e.g. removed ones, are dropped
+        names = {_get_sample_id(name): name for name in ext.samples}
+        active, inactive = payload
+        state = {names[i]: False for i in inactive if i in names}
+        state.update((names[i], True) for i in active if i in names)
+        return state
+    return {}
+
+
+def encode_sample_state(o: Any, ext: Optional["FlaskPancake"] = None) -> str:
+    """
+    Sign and serialize the given sample state.
+
+    If an extension is given, the state is encoded as two lists of sample IDs:
+    one of the active samples and one of the inactive samples.
+    """
     if current_app.secret_key is None:
         raise RuntimeError(
             "Cannot store sample flags cookie since app.SECRET_KEY is not set."
         )
-    serializer = URLSafeSerializer(current_app.secret_key, COOKIE_SALT)
-    return serializer.dumps(o)
-
-
-def load_cookies(ext: "FlaskPancake") -> Callable[[], Optional[Any]]:
-    def _wrapper():
-        data = request.cookies.get(ext.cookie_name)
+    if ext is not None:
+        active: List[int] = []
+        inactive: List[int] = []
+        for name, value in o.items():
+            if name in ext.samples:
+                (active if value else inactive).append(_get_sample_id(name))
+        o = [COOKIE_VERSION, active, inactive]
+    return _get_serializer(current_app.secret_key).dumps(o)
+
+
+def load_sample_state(ext: "FlaskPancake") -> Dict[str, bool]:
+    """
+    Return the sample state of the current request for the given extension.
+
+    The sample cookie is only decoded on first access within a request.
+    """
+    pancakes = g.setdefault("pancakes", {})
+    state = pancakes.get(ext.name)
+    if state is None:
+        state = pancakes[ext.name] = {}
+        data = request.cookies.get(ext.cookie_name) if has_request_context() else None
         if data is not None:
             try:
-                g.setdefault("pancakes", {})[ext.name] = decode_sample_state(data)
+                state.update(decode_sample_state(data, ext))
             except BadData:
                 pass
+    return state
 
-    return _wrapper
+
+def update_sample_state(ext: "FlaskPancake", name: str, value: bool) -> None:
+    load_sample_state(ext)[name] = value
+    g.setdefault("pancakes_changed", set()).add(ext.name)
 
 
 def store_cookies(ext: "FlaskPancake") -> Callable[[Response], Response]:
     def _wrapper(response: Response) -> Response:
-        data = g.get("pancakes", {}).get(ext.name)
-        if data:
-            response.set_cookie(
-                ext.cookie_name, value=encode_sample_state(data), **ext.cookie_options
-            )
+        # Only write the cookie back if a sample was evaluated in this request
+        changed = g.get("pancakes_changed", set())
+        if ext.name in changed:
+            changed.discard(ext.name)
+            data = encode_sample_state(load_sample_state(ext), ext)
+            response.set_cookie(ext.cookie_name, value=data, **ext.cookie_options)
         return response
 
     return _wrapper
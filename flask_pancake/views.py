@@ -1,4 +1,17 @@
-from flask import Blueprint, abort, current_app, render_template, request
+import hashlib
+import json
+from itertools import chain
+from typing import Any, Dict, List, Optional
+
+from flask import (
+    Blueprint,
+    Response,
+    abort,
+    current_app,
+    make_response,
+    render_template,
+    request,
+)
 from flask.json import jsonify
 from jinja2 import TemplateNotFound
 
@@ -8,54 +21,80 @@ from .extension import FlaskPancake
 bp = Blueprint("pancake", __name__, template_folder="templates")
 
 
-def aggregate_data(ext: FlaskPancake):
-    if ext.group_funcs:
-        group_ids = list(ext.group_funcs.keys())
-        flags = [
-            {
-                "name": flag.name,
-                "default": flag.default,
-                "is_active": flag.is_active_globally(),
-                "groups": {
-                    group_id: {
-                        object_id: flag.is_active_group(
-                            group_id=group_id, object_id=object_id
-                        )
-                        for object_id in func.get_candidate_ids()
-                    }
-                    for group_id, func in ext.group_funcs.items()
-                },
-            }
-            for flag in ext.flags.values()
-        ]
-    else:
-        group_ids = []
-        flags = [
-            {
-                "name": flag.name,
-                "default": flag.default,
-                "is_active": flag.is_active_globally(),
-                "groups": {},
+def aggregate_data(
+    ext: FlaskPancake, *, candidate_ids: Optional[Dict[str, List[str]]] = None
+):
+    group_funcs = ext.group_funcs or {}
+    if candidate_ids is None:
+        candidate_ids = {
+            group_id: func.get_candidate_ids() for group_id, func in group_funcs.items()
+        }
+
+    # Collect all keys first and fetch them at once
+    object_keys = {
+        flag.name: {
+            group_id: {
+                object_id: flag._get_object_key(ext, group_id, object_id=object_id)
+                for object_id in object_ids
             }
-            for flag in ext.flags.values()
-        ]
+            for group_id, object_ids in candidate_ids.items()
+        }
+        for flag in ext.flags.values()
+    }
+    values = ext._mget(
+        chain(
+            (flag._get_key(ext) for flag in ext.flags.values()),
+            (
+                object_key
+                for groups in object_keys.values()
+                for keys in groups.values()
+                for object_key in keys.values()
+                if object_key is not None
+            ),
+            (sample._get_key(ext) for sample in ext.samples.values()),
+            (switch._get_key(ext) for switch in ext.switches.values()),
+        )
+    )
 
+    flags = [
+        {
+            "name": flag.name,
+            "default": flag.default,
+            "is_active": flag._from_global_value(ext, values[flag._get_key(ext)]),
+            "groups": {
+                group_id: {
+                    object_id: (
+                        None
+                        if object_key is None
+                        else flag._from_override(values[object_key])
+                    )
+                    for object_id, object_key in keys.items()
+                }
+                for group_id, keys in object_keys[flag.name].items()
+            },
+        }
+        for flag in ext.flags.values()
+    ]
     samples = [
-        {"name": sample.name, "default": sample.default, "value": sample.get()}
+        {
+            "name": sample.name,
+            "default": sample.default,
+            "value": sample._from_value(ext, values[sample._get_key(ext)]),
+        }
         for sample in ext.samples.values()
     ]
     switches = [
         {
             "name": switch.name,
             "default": switch.default,
-            "is_active": switch.is_active(),
+            "is_active": switch._from_global_value(ext, values[switch._get_key(ext)]),
         }
         for switch in ext.switches.values()
     ]
 
     return {
         "name": ext.name,
-        "group_ids": group_ids,
+        "group_ids": list(group_funcs.keys()),
         "flags": flags,
         "samples": samples,
         "switches": switches,
@@ -63,25 +102,32 @@ def aggregate_data(ext: FlaskPancake):
 
 
 def aggregate_is_active_data(ext: FlaskPancake):
-    flags = [
-        {"name": flag.name, "is_active": flag.is_active()}
-        for flag in ext.flags.values()
-    ]
+    return ext.evaluate_all().as_dict()
+
+
+def make_etag(ext: FlaskPancake, *parts: Any) -> str:
+    """
+    Derive an ETag from the extension's version, its registered flags, samples,
+    and switches, and any additional request specific parts.
+    """
+    registered = {
+        kind: [[name, flag.default] for name, flag in flags.items()]
+        for kind, flags in (
+            ("flags", ext.flags),
+            ("samples", ext.samples),
+            ("switches", ext.switches),
+        )
+    }
+    data = json.dumps([ext.name, ext.get_version(), registered, *parts], default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
 
-    samples = [
-        {"name": sample.name, "is_active": sample.is_active()}
-        for sample in ext.samples.values()
-    ]
-    switches = [
-        {"name": switch.name, "is_active": switch.is_active()}
-        for switch in ext.switches.values()
-    ]
 
-    return {
-        "flags": flags,
-        "samples": samples,
-        "switches": switches,
-    }
+def not_modified(etag: str) -> Optional[Response]:
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    return response
 
 
 @bp.route("/overview", defaults={"pancake": EXTENSION_NAME})
@@ -91,15 +137,29 @@ def overview(pancake):
     if ext is None or not isinstance(ext, FlaskPancake):
         return "Unknown", 404
 
-    context = aggregate_data(ext)
+    accept_html = request.accept_mimetypes.accept_html
+    candidate_ids = {
+        group_id: func.get_candidate_ids()
+        for group_id, func in (ext.group_funcs or {}).items()
+    }
+    etag = make_etag(ext, candidate_ids, accept_html)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    context = aggregate_data(ext, candidate_ids=candidate_ids)
 
-    if request.accept_mimetypes.accept_html:
+    if accept_html:
         try:
-            return render_template("flask_pancake/overview.html", **context)
+            response = make_response(
+                render_template("flask_pancake/overview.html", **context)
+            )
         except TemplateNotFound:  # pragma: no cover
             abort(404)
     else:
-        return jsonify(context)
+        response = jsonify(context)
+    response.set_etag(etag)
+    return response
 
 
 @bp.route("/status", defaults={"pancake": EXTENSION_NAME})
@@ -108,5 +168,13 @@ def status(pancake):
     ext = current_app.extensions.get(pancake)
     if ext is None or not isinstance(ext, FlaskPancake):
         return "Unknown", 404
+    # Samples are sticky per user, through the cookie
+    etag = make_etag(ext, ext.get_group_ids(), request.cookies.get(ext.cookie_name))
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
     context = aggregate_is_active_data(ext)
-    return jsonify(context)
+    response = jsonify(context)
+    response.set_etag(etag)
+    return response
@@ -1,3 +1,5 @@
+import time
+
 import pytest
 from flask import Flask
 from flask_redis import FlaskRedis
@@ -6,6 +8,13 @@ from flask_pancake import FlaskPancake
 from flask_pancake.registry import registry
 
 
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Condition not met in time"
+        time.sleep(0.01)
+
+
 @pytest.fixture
 def _app():
     app = Flask(__name__)
@@ -17,14 +26,15 @@ def _app():
 
 @pytest.fixture
 def app(_app):
-    with _app.app_context():
+    # Flags are usually evaluated while handling a request
+    with _app.test_request_context():
         yield _app
 
 
 @pytest.fixture(autouse=True)
-def flask_pancake_cleanup(app: Flask):
-    app.extensions["redis"].flushall()
+def flask_pancake_cleanup(_app: Flask):
+    _app.extensions["redis"].flushall()
     registry.__clear__()
     yield
-    app.extensions["redis"].flushall()
+    _app.extensions["redis"].flushall()
     registry.__clear__()
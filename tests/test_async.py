@@ -0,0 +1,172 @@
+import asyncio
+import threading
+from unittest import mock
+
+import pytest
+from flask import Flask, g
+from redis.exceptions import ConnectionError
+
+from flask_pancake import Flag, FlaskPancake, Sample, Snapshot, Switch
+from flask_pancake.constants import EXTENSION_NAME, RAW_FALSE, RAW_TRUE
+
+run = asyncio.run
+
+
+@pytest.fixture
+def fetch_threads(app: Flask):
+    # The asyncio API must not read from Redis in the event loop's thread
+    ext = app.extensions[EXTENSION_NAME]
+    threads = []
+    fetch = ext._fetch
+
+    def record_thread(keys):
+        threads.append(threading.get_ident())
+        return fetch(keys)
+
+    with mock.patch.object(ext, "_fetch", record_thread):
+        yield threads
+    assert threads
+    assert threading.get_ident() not in threads
+
+
+def test_is_active_async(app: Flask, fetch_threads):
+    ext = app.extensions[EXTENSION_NAME]
+    ext._group_funcs = {"user": lambda: "1"}
+    flag = Flag("my-flag", False)
+    flag.enable_group("user")
+    sample = Sample("my-sample", 100)
+    switch = Switch("my-switch", True)
+
+    assert run(flag.is_active_async()) is True
+    assert run(sample.is_active_async()) is True
+    assert run(switch.is_active_async()) is True
+
+    g.pop("pancake_cache")
+    switch.disable()
+    assert run(switch.is_active_async()) is False
+    # Results are remembered for the current request
+    app.extensions["redis"].set(switch.key, 1)
+    assert run(switch.is_active_async()) is False
+
+
+def test_seed_defaults(app: Flask, fetch_threads):
+    Sample("my-sample", 42)
+    Switch("my-switch", True)
+    run(app.extensions[EXTENSION_NAME].evaluate_all_async())
+    redis = app.extensions["redis"]
+    assert redis.get("SAMPLE:pancake:MY-SAMPLE") == b"42"
+    assert redis.get("SWITCH:pancake:MY-SWITCH") == RAW_TRUE
+
+
+def test_evaluate_all_async(app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    ext._group_funcs = {"user": lambda: "1", "admin": lambda: None}
+    Flag("Flag1", False).enable_group("user")
+    Flag("Flag2", True)
+    Sample("Sample1", 42)
+    Switch("Switch1", False).enable()
+
+    with mock.patch("random.uniform", return_value=42):
+        snapshot = run(ext.evaluate_all_async())
+    assert snapshot == Snapshot(
+        flags={"Flag1": True, "Flag2": True},
+        samples={"Sample1": True},
+        switches={"Switch1": True},
+    )
+    assert ext.evaluate_all() == snapshot
+    assert run(ext.evaluate_async(["Switch1"])) == Snapshot(
+        flags={}, samples={}, switches={"Switch1": True}
+    )
+
+
+@pytest.mark.parametrize("group_storage", ["hash", "bitmap"])
+def test_group_storage(app: Flask, group_storage):
+    ext = FlaskPancake(
+        app, name="other", group_funcs={"user": lambda: "1"}, cache_ttl=60
+    )
+    ext.group_storage = group_storage
+    flag = Flag("my-flag", True, extension="other")
+    flag.disable_group("user")
+
+    assert run(flag.is_active_async()) is False
+    g.pop("pancake_cache")
+    assert ext._local_cache is not None
+    ext._local_cache.close()
+    assert run(flag.is_active_async()) is False
+
+
+def test_concurrent(app: Flask):
+    switches = [Switch(f"switch-{i}", i % 2 == 0) for i in range(20)]
+
+    async def check_all():
+        return await asyncio.gather(*(switch.is_active_async() for switch in switches))
+
+    assert run(check_all()) == [i % 2 == 0 for i in range(20)]
+
+
+def test_connection_pool(app: Flask):
+    # Every call runs in a new event loop, like Flask's async views
+    switch = Switch("my-switch", True)
+    pool = app.extensions["redis"].connection_pool
+    for _ in range(10):
+        assert run(switch.is_active_async()) is True
+        g.pop("pancake_cache")
+    assert pool._created_connections == 1
+
+
+def test_local_cache(app: Flask):
+    ext = FlaskPancake(app, name="cached", cache_ttl=60)
+    cache = ext._local_cache
+    assert cache is not None
+    switch = Switch("my-switch", False, extension="cached")
+    assert run(switch.is_active_async()) is False
+    g.pop("pancake_cache")
+
+    with mock.patch.object(ext, "_fetch") as fetch:
+        assert run(switch.is_active_async()) is False
+    fetch.assert_not_called()
+    g.pop("pancake_cache")
+
+    cache.invalidate()
+    with mock.patch.object(
+        ext, "_fetch", side_effect=ConnectionError("fail")
+    ), mock.patch.object(cache, "release") as release:
+        with pytest.raises(ConnectionError):
+            run(switch.is_active_async())
+    release.assert_called_once_with([switch.key])
+    cache.close()
+
+
+def test_refresher(app: Flask):
+    ext = FlaskPancake(app, name="refreshed", refresh_interval=60)
+    refresher = ext._refresher
+    assert refresher is not None
+    switch = Switch("my-switch", True, extension="refreshed")
+    refresher.refresh()
+    # Without the refresher thread, which would load the state concurrently
+    with mock.patch.object(refresher, "start"), mock.patch.object(
+        ext, "_fetch"
+    ) as fetch:
+        assert run(switch.is_active_async()) is True
+    fetch.assert_not_called()
+    g.pop("pancake_cache")
+
+    # Without a snapshot, values are read from Redis
+    app.extensions["redis"].set(switch.key, 0)
+    refresher._values = None
+    with mock.patch.object(refresher, "start"):
+        assert run(switch.is_active_async()) is False
+    refresher.close()
+
+
+def test_mget_async_raw(app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    redis = app.extensions["redis"]
+    redis.set("a", 1)
+    redis.set("b", 0)
+    assert run(ext._mget_async(["a", "b", "c", "a"])) == {
+        "a": RAW_TRUE,
+        "b": RAW_FALSE,
+        "c": None,
+    }
+    assert run(ext._mget_async([])) == {}
@@ -0,0 +1,221 @@
+import time
+from unittest import mock
+
+import pytest
+from flask import Flask, g
+from redis.client import Pipeline
+from redis.exceptions import ConnectionError
+
+from flask_pancake import FlaskPancake, Sample, Switch
+from flask_pancake.cache import LocalCache
+from flask_pancake.utils import HashField
+from tests.conftest import wait_for
+
+
+@pytest.fixture
+def ext(app: Flask):
+    ext = FlaskPancake(app, name="cached", cache_ttl=60, cache_stale_ttl=10)
+    cache = ext._local_cache
+    assert cache is not None
+    cache.listen(app.extensions["redis"], ext._invalidation_channel)
+    wait_for(cache._subscribed.is_set)
+    yield ext
+    cache.close()
+
+
+@pytest.fixture
+def cache(ext: FlaskPancake) -> LocalCache:
+    assert ext._local_cache is not None
+    return ext._local_cache
+
+
+def test_get_set_many():
+    cache = LocalCache(ttl=60)
+    assert cache.get_many(["a", "b"]) == ({}, ["a", "b"])
+
+    cache.set_many({"a": b"1", "b": None}, cache.generation)
+    assert cache.get_many(["a", "b", "c"]) == ({"a": b"1", "b": None}, ["c"])
+
+
+def test_ttl():
+    cache = LocalCache(ttl=60)
+    cache.set_many({"a": b"1"}, cache.generation)
+    with mock.patch("time.monotonic", return_value=time.monotonic() + 61):
+        assert cache.get_many(["a"]) == ({}, ["a"])
+
+
+def test_jitter():
+    cache = LocalCache(ttl=100, jitter=0.2)
+    now = time.monotonic()
+    with mock.patch("time.monotonic", return_value=now), mock.patch(
+        "random.uniform", return_value=0.2
+    ) as uniform:
+        cache.set_many({"a": b"1"}, cache.generation)
+    uniform.assert_called_once_with(0, 0.2)
+    assert cache._data["a"] == (now + 80, now + 80, b"1")
+
+
+def test_stale_while_revalidate():
+    cache = LocalCache(ttl=60, stale_ttl=30, jitter=0)
+    now = time.monotonic()
+    with mock.patch("time.monotonic", return_value=now):
+        cache.set_many({"a": b"1", "b": b"2"}, cache.generation)
+
+    with mock.patch("time.monotonic", return_value=now + 61):
+        # The first thread refreshes the stale value ...
+        assert cache.get_many(["a", "b"]) == ({}, ["a", "b"])
+        # ... while all others keep using it.
+        assert cache.get_many(["a", "b"]) == ({"a": b"1", "b": b"2"}, [])
+
+        cache.set_many({"a": b"3"}, cache.generation)
+        cache.release(["b"])
+        assert cache.get_many(["a", "b"]) == ({"a": b"3"}, ["b"])
+
+    with mock.patch("time.monotonic", return_value=now + 91):
+        # Values are not used anymore after the stale period
+        assert cache.get_many(["b"]) == ({}, ["b"])
+        assert cache.get_many(["b"]) == ({}, ["b"])
+
+
+def test_fetch_error_releases(ext: FlaskPancake, cache: LocalCache, app: Flask):
+    redis = app.extensions["redis"]
+    with mock.patch.object(redis, "mget", side_effect=ConnectionError("fail")):
+        with mock.patch.object(cache, "release", wraps=cache.release) as release:
+            with pytest.raises(ConnectionError):
+                ext._mget(["a"])
+    release.assert_called_once_with(["a"])
+
+
+def test_invalidate():
+    cache = LocalCache(ttl=60)
+    cache.set_many({"a": b"1", "b": b"2", "c": b"3"}, cache.generation)
+
+    cache.invalidate(["a", "d"])
+    assert cache.get_many(["a", "b", "c"]) == ({"b": b"2", "c": b"3"}, ["a"])
+
+    cache.invalidate()
+    assert cache.get_many(["a", "b", "c"]) == ({}, ["a", "b", "c"])
+
+
+def test_close_not_listening():
+    cache = LocalCache(ttl=60)
+    cache.set_many({"a": b"1"}, cache.generation)
+    cache.close()
+    assert cache.get_many(["a"]) == ({}, ["a"])
+
+
+def test_set_many_outdated_generation():
+    cache = LocalCache(ttl=60)
+    generation = cache.generation
+    cache.invalidate(["a"])
+    cache.set_many({"a": b"1"}, generation)
+    assert cache.get_many(["a"]) == ({}, ["a"])
+
+
+def test_cached_reads(ext: FlaskPancake, app: Flask):
+    switch = Switch("my-switch", False, extension="cached")
+    sample = Sample("my-sample", 42, extension="cached")
+    redis = app.extensions["redis"]
+
+    assert switch.is_active() is False
+    assert sample.get() == 42
+    g.pop("pancake_cache")
+
+    with mock.patch.object(redis, "get") as get, mock.patch.object(
+        redis, "mget"
+    ) as mget:
+        assert switch.is_active() is False
+        assert sample.get() == 42
+    get.assert_not_called()
+    mget.assert_not_called()
+
+    # Writes through the flags' API invalidate the cache immediately
+    switch.enable()
+    sample.set(13)
+    assert switch.is_active() is True
+    assert sample.get() == 13
+
+
+def test_cached_version(ext: FlaskPancake, app: Flask):
+    switch = Switch("my-switch", False, extension="cached")
+    redis = app.extensions["redis"]
+    assert ext.get_version() == 0
+    with mock.patch.object(redis, "mget") as mget:
+        assert ext.get_version() == 0
+    mget.assert_not_called()
+
+    # Other processes drop the version along with the changed keys
+    with mock.patch.object(
+        Pipeline, "publish", autospec=True, side_effect=Pipeline.publish
+    ) as publish:
+        switch.enable()
+    publish.assert_called_once_with(
+        mock.ANY,
+        "PANCAKE:cached:invalidate",
+        '["SWITCH:cached:MY-SWITCH", "PANCAKE:cached:version"]',
+    )
+    assert ext.get_version() == 1
+
+
+def test_invalidation_message(cache: LocalCache, app: Flask):
+    switch = Switch("my-switch", False, extension="cached")
+    redis = app.extensions["redis"]
+    assert switch.is_active() is False
+    g.pop("pancake_cache")
+
+    # Simulate a write from another process
+    redis.set(switch.key, 1)
+    assert switch.is_active() is False
+    g.pop("pancake_cache")
+
+    redis.publish("PANCAKE:cached:invalidate", '["SWITCH:cached:MY-SWITCH"]')
+    wait_for(lambda: cache.get_many([switch.key])[1])
+    assert switch.is_active() is True
+    g.pop("pancake_cache")
+
+    redis.set(switch.key, 0)
+    redis.publish("PANCAKE:cached:invalidate", "null")
+    wait_for(lambda: cache.get_many([switch.key])[1])
+    assert switch.is_active() is False
+
+
+def test_invalidation_message_hash_field(cache: LocalCache, app: Flask):
+    key = HashField("FLAG:cached:h:user:MY-FLAG", "1")
+    cache.set_many({key: b"1"}, cache.generation)
+    app.extensions["redis"].publish(
+        "PANCAKE:cached:invalidate", '[["FLAG:cached:h:user:MY-FLAG", "1"]]'
+    )
+    wait_for(lambda: cache.get_many([key])[1])
+
+
+def test_listen_once_per_process(cache: LocalCache, app: Flask):
+    thread = cache._thread
+    assert thread is not None and thread.is_alive()
+
+    cache.listen(app.extensions["redis"], "PANCAKE:cached:invalidate")
+    assert cache._thread is thread
+
+    # A forked process starts its own listener and drops any inherited values
+    cache.set_many({"a": b"1"}, cache.generation)
+    with mock.patch("os.getpid", return_value=-1):
+        cache.listen(app.extensions["redis"], "PANCAKE:cached:invalidate")
+    assert cache._thread is not thread
+    assert cache.get_many(["a"]) == ({}, ["a"])
+
+
+def test_listen_connection_error(app: Flask):
+    cache = LocalCache(ttl=60)
+    client = mock.Mock()
+    client.pubsub.side_effect = ConnectionError("fail")
+
+    cache.set_many({"a": b"1"}, cache.generation)
+    with mock.patch.object(
+        cache._stop, "wait", side_effect=lambda timeout: cache._stop.set()
+    ):
+        cache.listen(client, "channel")
+        thread = cache._thread
+        assert thread is not None
+        thread.join(2)
+    assert not thread.is_alive()
+    assert cache.get_many(["a"]) == ({}, ["a"])
+    cache.close()
@@ -0,0 +1,206 @@
+import asyncio
+from unittest import mock
+
+import pytest
+from flask import Flask, g
+from redis.client import Pipeline, Redis
+from redis.crc import key_slot
+from redis.exceptions import RedisClusterException
+
+from flask_pancake import Flag, FlaskPancake, Sample, Snapshot, Switch
+from flask_pancake.utils import BitmapField, HashField, get_key_slot
+
+# Commands with more than one key, and the step between the keys in the arguments
+MULTI_KEY_COMMANDS = {"MGET": 1, "DEL": 1, "UNLINK": 1, "EXISTS": 1, "MSET": 2}
+
+
+def get_slots(keys):
+    return {key_slot(key if isinstance(key, bytes) else key.encode()) for key in keys}
+
+
+@pytest.fixture
+def ext(app: Flask):
+    return FlaskPancake(
+        app, name="cluster", key_scheme="cluster", group_funcs={"user": lambda: "1"}
+    )
+
+
+@pytest.fixture
+def commands():
+    # A Redis Cluster rejects multi-key commands with keys of different slots
+    commands = []
+    execute_command = Redis.execute_command
+    pipeline_execute_command = Pipeline.pipeline_execute_command
+    pipeline_execute = Pipeline.execute
+
+    def check(args):
+        commands.append(args)
+        step = MULTI_KEY_COMMANDS.get(args[0])
+        if step:
+            assert len(get_slots(args[1::step])) == 1, args
+
+    def check_execute_command(self, *args, **options):
+        check(args)
+        return execute_command(self, *args, **options)
+
+    def check_pipeline_execute_command(self, *args, **options):
+        check(args)
+        return pipeline_execute_command(self, *args, **options)
+
+    def check_pipeline_execute(self, *args, **kwargs):
+        # ... as well as transactions with keys of different slots
+        if self.transaction:
+            keys = [
+                command[0][1]
+                for command in self.command_stack
+                if command[0][0] != "PUBLISH"
+            ]
+            assert len(get_slots(keys)) <= 1, keys
+        return pipeline_execute(self, *args, **kwargs)
+
+    with mock.patch.object(
+        Redis, "execute_command", check_execute_command
+    ), mock.patch.object(
+        Pipeline, "pipeline_execute_command", check_pipeline_execute_command
+    ), mock.patch.object(
+        Pipeline, "execute", check_pipeline_execute
+    ):
+        yield commands
+
+
+def test_invalid_key_scheme():
+    msg = r"Invalid key scheme 'foo'\. Must be one of 'default', 'cluster'\."
+    with pytest.raises(ValueError, match=msg):
+        FlaskPancake(key_scheme="foo")
+
+
+def test_keys(ext: FlaskPancake):
+    flag = Flag("my-flag", False, extension="cluster")
+    sample = Sample("my-sample", 42, extension="cluster")
+    switch = Switch("my-switch", True, extension="cluster")
+    assert flag.key == "FLAG:{cluster}:MY-FLAG"
+    assert sample.key == "SAMPLE:{cluster}:MY-SAMPLE"
+    assert switch.key == "SWITCH:{cluster}:MY-SWITCH"
+    assert ext._version_key == "PANCAKE:{cluster}:version"
+    assert len(get_slots([flag.key, sample.key, switch.key, ext._version_key])) == 1
+
+    group_keys = flag._get_group_keys(ext, "user")
+    assert group_keys.object_prefix == "FLAG:{cluster:MY-FLAG}:k:user"
+    assert group_keys.rollout == "FLAG:{cluster:MY-FLAG}:p:user"
+    assert (
+        flag._get_object_key(ext, "user", object_id="1")
+        == "FLAG:{cluster:MY-FLAG}:k:user:1"
+    )
+    ext.group_storage = "hash"
+    assert flag._get_object_key(ext, "user", object_id="1") == HashField(
+        "FLAG:{cluster:MY-FLAG}:h:user", "1"
+    )
+    ext.group_storage = "bitmap"
+    assert flag._get_object_key(ext, "user", object_id="1") == BitmapField(
+        "FLAG:{cluster:MY-FLAG}:e:user", "FLAG:{cluster:MY-FLAG}:d:user", 1
+    )
+    assert len(get_slots(group_keys)) == 1
+
+
+def test_chunk_keys(ext: FlaskPancake):
+    keys = [f"{{tag-{i % 3}}}:{i}" for i in range(8)]
+    with mock.patch("flask_pancake.extension.MGET_CHUNK_SIZE", 2):
+        assert ext._chunk_keys(keys) == [
+            ["{tag-0}:0", "{tag-0}:3"],
+            ["{tag-0}:6"],
+            ["{tag-1}:1", "{tag-1}:4"],
+            ["{tag-1}:7"],
+            ["{tag-2}:2", "{tag-2}:5"],
+        ]
+        ext.key_scheme = "default"
+        assert ext._chunk_keys(keys[:5]) == [keys[:2], keys[2:4], keys[4:5]]
+
+
+def test_fetch(app: Flask, ext: FlaskPancake):
+    redis = app.extensions["redis"]
+    redis.mset({"{a}:1": 1, "{b}:1": 0})
+    assert get_key_slot("{a}:1") == get_key_slot("{a}:2")
+
+    with mock.patch.object(redis, "pipeline") as pipeline:
+        assert ext._fetch(["{a}:1", "{a}:2"]) == {"{a}:1": b"1", "{a}:2": None}
+    pipeline.assert_not_called()
+
+    assert ext._fetch(["{a}:1", "{b}:1", "{a}:2"]) == {
+        "{a}:1": b"1",
+        "{a}:2": None,
+        "{b}:1": b"0",
+    }
+    assert asyncio.run(ext._mget_async(["{a}:1", "{b}:1"])) == {
+        "{a}:1": b"1",
+        "{b}:1": b"0",
+    }
+
+
+def test_transaction(ext: FlaskPancake):
+    version = ext.get_version()
+    with mock.patch.object(
+        Pipeline, "execute", autospec=True, side_effect=Pipeline.execute
+    ) as execute:
+        with ext._transaction(None) as pipe:
+            assert pipe.transaction is True
+            pipe.set("FLAG:{cluster}:MY-FLAG", 1)
+    assert [call.args[0].transaction for call in execute.call_args_list] == [
+        True,
+        False,
+    ]
+    assert ext.get_version() == version + 1
+
+
+def test_transaction_unsupported(app: Flask, ext: FlaskPancake):
+    redis = app.extensions["redis"]
+    pipeline = redis.pipeline
+
+    def cluster_pipeline(transaction=None):
+        # Like `RedisCluster.pipeline()` of redis-py before 6.1
+        if transaction:
+            raise RedisClusterException("transaction is deprecated in cluster mode")
+        return pipeline(transaction=transaction)
+
+    version = ext.get_version()
+    with mock.patch.object(redis, "pipeline", cluster_pipeline):
+        with ext._transaction(None) as pipe:
+            assert pipe.transaction is False
+            pipe.set("FLAG:{cluster}:MY-FLAG", 1)
+    assert redis.get("FLAG:{cluster}:MY-FLAG") == b"1"
+    assert ext.get_version() == version + 1
+
+
+@pytest.mark.parametrize("group_storage", ["keys", "hash", "bitmap"])
+def test_flags(app: Flask, ext: FlaskPancake, commands, group_storage):
+    ext.group_storage = group_storage
+    flags = [Flag(f"flag-{i}", False, extension="cluster") for i in range(3)]
+    Sample("my-sample", 100, extension="cluster")
+    Switch("my-switch", True, extension="cluster")
+
+    for flag in flags:
+        flag.enable_group("user")
+        flag.enable_group_many("user", ["2", "3"])
+        flag.disable_group("user", object_id="4")
+        flag.set_group_rollout("user", 50)
+        assert flag.count_group("user") == (3, 1)
+
+    snapshot = Snapshot(
+        flags=dict.fromkeys(["flag-0", "flag-1", "flag-2"], True),
+        samples={"my-sample": True},
+        switches={"my-switch": True},
+    )
+    assert ext.evaluate_all() == snapshot
+    g.pop("pancake_cache")
+    assert asyncio.run(ext.evaluate_all_async()) == snapshot
+    assert ext.get_version() > 0
+    assert any(command[0] == "MGET" for command in commands)
+
+    for flag in flags[1:]:
+        flag.clear_all_group("user", batch_size=2)
+    ext.group_storage = "keys" if group_storage != "keys" else "hash"
+    assert flags[0].migrate_group_storage("user", batch_size=2) == 4
+    assert flags[0].count_group("user") == (3, 1)
+    flags[0].clear_all_group("user", batch_size=2)
+    assert sorted(app.extensions["redis"].keys("FLAG:{cluster:*")) == [
+        f"FLAG:{{cluster:FLAG-{i}}}:p:user".encode() for i in range(3)
+    ]
@@ -6,6 +6,7 @@ from flask import Flask, g
 from flask_pancake import Flag, Sample, Switch
 from flask_pancake.commands import (
     flag_clear,
+    flag_clear_all_group,
     flag_clear_group,
     flag_disable,
     flag_disable_group,
@@ -13,6 +14,7 @@ from flask_pancake.commands import (
     flag_enable_group,
     flag_list,
     flag_list_group,
+    flag_migrate_storage,
     sample_clear,
     sample_list,
     sample_set,
@@ -21,7 +23,11 @@ from flask_pancake.commands import (
     switch_enable,
     switch_list,
 )
-from flask_pancake.constants import EXTENSION_NAME
+from flask_pancake.constants import EXTENSION_NAME, RAW_FALSE, RAW_TRUE
+
+
+def noop():
+    pass  # pragma: no cover
 
 
 def test_flags(app: Flask):
@@ -42,6 +48,7 @@ def test_flags(app: Flask):
     result = runner.invoke(flag_clear, args=["FEATURE"])
     assert feature.is_active() is False
     assert "Flag 'FEATURE' cleared." in result.output
+    assert app.extensions[EXTENSION_NAME].get_version() == 4
 
 
 def test_flags_group(app: Flask):
@@ -78,6 +85,81 @@ def test_flags_group(app: Flask):
     assert result.output == "FEATURE: N/A (default: No)\n"
 
 
+def test_flags_clear_all_group(app: Flask):
+    runner = app.test_cli_runner()
+    app.extensions[EXTENSION_NAME]._group_funcs = {"user": noop}
+    feature = Flag("FEATURE", default=False)
+    for uid in ("1", "2", "3"):
+        feature.enable_group("user", object_id=uid)
+
+    result = runner.invoke(
+        flag_clear_all_group, ["--batch-size", "2", "FEATURE", "user"]
+    )
+    assert result.output.splitlines()[-1] == (
+        "All objects in group 'user' for flag 'FEATURE' cleared."
+    )
+    assert result.output.splitlines()[-2] == "Cleared 3 objects ..."
+    assert feature.count_group("user") == (0, 0)
+
+
+def test_flags_migrate_storage(app: Flask):
+    runner = app.test_cli_runner()
+    ext = app.extensions[EXTENSION_NAME]
+    ext._group_funcs = {"user": noop, "team": noop}
+    feature = Flag("FEATURE", default=False)
+    for uid in ("1", "2", "3"):
+        feature.enable_group("user", object_id=uid)
+    feature.disable_group("user", object_id="4")
+    redis = app.extensions["redis"]
+    # A stale entry in the tracking set is dropped
+    redis.sadd("FLAG:pancake:t:user:FEATURE", "FLAG:pancake:k:user:FEATURE:5")
+
+    ext.group_storage = "hash"
+    result = runner.invoke(flag_migrate_storage, ["--batch-size", "2"])
+    assert result.output == (
+        "Migrated 5 objects in group 'user' for flag 'FEATURE' to hash storage.\n"
+        "Migrated 0 objects in group 'team' for flag 'FEATURE' to hash storage.\n"
+    )
+    assert redis.keys("FLAG:pancake:*") == [b"FLAG:pancake:h:user:FEATURE"]
+    assert redis.hgetall("FLAG:pancake:h:user:FEATURE") == {
+        b"1": RAW_TRUE,
+        b"2": RAW_TRUE,
+        b"3": RAW_TRUE,
+        b"4": RAW_FALSE,
+    }
+    assert feature.is_active_group("user", object_id="1") is True
+    assert feature.is_active_group("user", object_id="4") is False
+
+    ext.group_storage = "keys"
+    result = runner.invoke(flag_migrate_storage, ["--batch-size", "3"])
+    assert "Migrated 4 objects in group 'user'" in result.output
+    assert sorted(redis.keys("FLAG:pancake:*")) == [
+        b"FLAG:pancake:k:user:FEATURE:1",
+        b"FLAG:pancake:k:user:FEATURE:2",
+        b"FLAG:pancake:k:user:FEATURE:3",
+        b"FLAG:pancake:k:user:FEATURE:4",
+        b"FLAG:pancake:t:user:FEATURE",
+    ]
+    assert feature.is_active_group("user", object_id="1") is True
+    assert feature.is_active_group("user", object_id="4") is False
+    assert redis.scard("FLAG:pancake:t:user:FEATURE") == 4
+
+    ext.group_storage = "bitmap"
+    result = runner.invoke(flag_migrate_storage)
+    assert "Migrated 4 objects in group 'user'" in result.output
+    assert sorted(redis.keys("FLAG:pancake:*")) == [
+        b"FLAG:pancake:d:user:FEATURE",
+        b"FLAG:pancake:e:user:FEATURE",
+    ]
+    assert feature.count_group("user") == (3, 1)
+
+    ext.group_storage = "hash"
+    result = runner.invoke(flag_migrate_storage)
+    assert "Migrated 4 objects in group 'user'" in result.output
+    assert redis.keys("FLAG:pancake:*") == [b"FLAG:pancake:h:user:FEATURE"]
+    assert feature.count_group("user") == (3, 1)
+
+
 def test_flag_list(app: Flask):
     runner = app.test_cli_runner()
     Flag("FEATURE1", default=False)
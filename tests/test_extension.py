@@ -1,9 +1,15 @@
+import asyncio
+from dataclasses import FrozenInstanceError
+from unittest import mock
+
 import pytest
-from flask import Flask
+from flask import Flask, g
+from flask_redis import FlaskRedis
 
-from flask_pancake import Flag, FlaskPancake, GroupFunc, Sample, Switch
-from flask_pancake.constants import EXTENSION_NAME
+from flask_pancake import Flag, FlaskPancake, GroupFunc, Sample, Snapshot, Switch
+from flask_pancake.constants import EXTENSION_NAME, RAW_FALSE, RAW_TRUE
 from flask_pancake.extension import FunctionGroupFunc
+from flask_pancake.utils import BitmapField, HashField
 
 
 def test_late_init():
@@ -115,3 +121,457 @@ def test_function_group_func():
 
     f.get_candidate_ids = lambda: vals
     assert fgf.get_candidate_ids() == vals
+
+
+def test_get_group_ids(app: Flask):
+    assert FlaskPancake(name="other").get_group_ids() == {}
+    ext = app.extensions[EXTENSION_NAME]
+    ext._group_funcs = {"user": lambda: "1", "admin": lambda: None}
+    assert ext.get_group_ids() == {"user": "1", "admin": None}
+
+
+def test_get_group_ids_memoized(app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    user = mock.Mock(return_value="1")
+    ext._group_funcs = {"user": user}
+    flag1 = Flag("Flag1", False)
+    flag2 = Flag("Flag2", False)
+    flag2.enable_group("user", object_id="2")
+
+    assert flag1.is_active() is False
+    assert flag2.is_active() is False
+    assert flag1.is_active_group("user") is None
+    assert ext.get_group_ids() == {"user": "1"}
+    user.assert_called_once_with()
+
+    # E.g. after a login
+    user.return_value = "2"
+    ext.clear_group_ids()
+    assert flag2.is_active() is True
+    assert ext.get_group_ids() == {"user": "2"}
+    assert user.call_count == 2
+
+
+def test_get_group_ids_no_request(_app: Flask):
+    # E.g. a worker evaluating flags for one subject after another
+    ext = _app.extensions[EXTENSION_NAME]
+    user = mock.Mock(return_value="1")
+    ext._group_funcs = {"user": user}
+    with _app.app_context():
+        assert ext.get_group_ids() == {"user": "1"}
+        user.return_value = "2"
+        assert ext.get_group_ids() == {"user": "2"}
+        assert "pancake_group_ids" not in g
+
+
+def test_evaluate_all(app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    ext._group_funcs = {"user": lambda: "1", "admin": lambda: None}
+    flag1 = Flag("Flag1", False)
+    flag1.enable_group("user")
+    Flag("Flag2", True)
+    Sample("Sample1", 42)
+    Switch("Switch1", False).enable()
+    Switch("Switch2", True)
+    redis = app.extensions["redis"]
+
+    with mock.patch("random.uniform", return_value=42), mock.patch.object(
+        redis, "mget", wraps=redis.mget
+    ) as mget:
+        snapshot = ext.evaluate_all()
+    mget.assert_called_once_with(
+        [
+            "FLAG:pancake:k:user:FLAG1:1",
+            "FLAG:pancake:p:user:FLAG1",
+            "FLAG:pancake:FLAG1",
+            "FLAG:pancake:k:user:FLAG2:1",
+            "FLAG:pancake:p:user:FLAG2",
+            "FLAG:pancake:FLAG2",
+            "SAMPLE:pancake:SAMPLE1",
+            "SWITCH:pancake:SWITCH1",
+            "SWITCH:pancake:SWITCH2",
+        ]
+    )
+
+    assert snapshot == Snapshot(
+        flags={"Flag1": True, "Flag2": True},
+        samples={"Sample1": True},
+        switches={"Switch1": True, "Switch2": True},
+    )
+    assert snapshot.as_dict() == {
+        "flags": [
+            {"name": "Flag1", "is_active": True},
+            {"name": "Flag2", "is_active": True},
+        ],
+        "samples": [{"name": "Sample1", "is_active": True}],
+        "switches": [
+            {"name": "Switch1", "is_active": True},
+            {"name": "Switch2", "is_active": True},
+        ],
+    }
+    with pytest.raises(FrozenInstanceError):
+        snapshot.flags = {}  # type: ignore
+    with pytest.raises(TypeError):
+        snapshot.flags["Flag1"] = False  # type: ignore
+
+    # All results are known for the current request now.
+    with mock.patch.object(redis, "mget") as mget:
+        assert ext.evaluate_all() == snapshot
+    mget.assert_not_called()
+
+
+def test_evaluate(app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    Flag("Flag1", False)
+    Sample("Sample1", 42)
+    Switch("Switch1", True)
+    Switch("Flag1", True)
+    redis = app.extensions["redis"]
+
+    with mock.patch.object(redis, "mget", wraps=redis.mget) as mget:
+        snapshot = ext.evaluate(["Flag1"])
+    mget.assert_called_once_with(["FLAG:pancake:FLAG1", "SWITCH:pancake:FLAG1"])
+    assert snapshot == Snapshot(
+        flags={"Flag1": False}, samples={}, switches={"Flag1": True}
+    )
+
+    with mock.patch.object(redis, "mget") as mget:
+        assert ext.evaluate([]) == Snapshot(flags={}, samples={}, switches={})
+    mget.assert_not_called()
+
+
+def test_evaluate_unknown(app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    Flag("Flag1", False)
+    msg = (
+        r"Unknown flag, sample, or switch 'Bar', 'Foo' in FlaskPancake extension "
+        r"'pancake'\."
+    )
+    with pytest.raises(ValueError, match=msg):
+        ext.evaluate(["Flag1", "Foo", "Bar"])
+
+
+def test_mget_chunked(app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    redis = app.extensions["redis"]
+    redis.set("a", 1)
+    redis.set("c", 3)
+
+    assert ext._mget([]) == {}
+    with mock.patch("flask_pancake.extension.MGET_CHUNK_SIZE", 2), mock.patch.object(
+        redis, "pipeline", wraps=redis.pipeline
+    ) as pipeline:
+        assert ext._mget(["a", "b", "a", "c", "d"]) == {
+            "a": b"1",
+            "b": None,
+            "c": b"3",
+            "d": None,
+        }
+    pipeline.assert_called_once_with(transaction=False)
+
+
+def test_mget_hash_fields(app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    redis = app.extensions["redis"]
+    redis.set("a", 1)
+    redis.hset("h", mapping={"x": 2, "y": 3})
+    redis.hset("i", "x", 4)
+    keys = ["a", HashField("h", "x"), "b", HashField("h", "z"), HashField("i", "x")]
+
+    with mock.patch.object(redis, "pipeline", wraps=redis.pipeline) as pipeline:
+        assert ext._mget(keys) == {
+            "a": b"1",
+            "b": None,
+            HashField("h", "x"): b"2",
+            HashField("h", "z"): None,
+            HashField("i", "x"): b"4",
+        }
+    pipeline.assert_called_once_with(transaction=False)
+
+    assert ext._get(HashField("h", "y")) == b"3"
+    assert ext._mget([HashField("h", "y")]) == {HashField("h", "y"): b"3"}
+
+
+def test_mget_bitmap_fields(app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    redis = app.extensions["redis"]
+    redis.setbit("e", 3, 1)
+    redis.setbit("d", 5, 1)
+    # Enabled wins
+    redis.setbit("e", 7, 1)
+    redis.setbit("d", 7, 1)
+
+    assert ext._mget(
+        ["a"] + [BitmapField("e", "d", offset) for offset in (3, 5, 7, 9)]
+    ) == {
+        "a": None,
+        BitmapField("e", "d", 3): RAW_TRUE,
+        BitmapField("e", "d", 5): RAW_FALSE,
+        BitmapField("e", "d", 7): RAW_TRUE,
+        BitmapField("e", "d", 9): None,
+    }
+    assert ext._get(BitmapField("e", "d", 5)) == RAW_FALSE
+
+
+def test_invalid_group_storage():
+    msg = r"Invalid group storage 'foo'\. Must be one of 'keys', 'hash', 'bitmap'\."
+    with pytest.raises(ValueError, match=msg):
+        FlaskPancake(group_storage="foo")
+    with pytest.raises(ValueError, match=msg):
+        FlaskPancake(group_storage={"user": "hash", "team": "foo"})
+
+
+def test_group_storage_per_group(app: Flask):
+    ext = FlaskPancake(
+        app,
+        name="mixed",
+        group_funcs={"user": lambda: "42", "team": lambda: "a", "org": lambda: "b"},
+        group_storage={"user": "bitmap", "team": "hash"},
+    )
+    assert ext.get_group_storage("user") == "bitmap"
+    assert ext.get_group_storage("team") == "hash"
+    assert ext.get_group_storage("org") == "keys"
+
+    flag = Flag("Flag1", False, extension="mixed")
+    flag.disable_group("user")
+    flag.enable_group("team")
+    flag.enable_group("org")
+    redis = app.extensions["redis"]
+    assert redis.getbit("FLAG:mixed:d:user:FLAG1", 42) == 1
+    assert redis.hget("FLAG:mixed:h:team:FLAG1", "a") == RAW_TRUE
+    assert redis.get("FLAG:mixed:k:org:FLAG1:b") == RAW_TRUE
+    assert flag.is_active() is False
+    assert ext._load_state() == {
+        "PANCAKE:mixed:version": b"3",
+        "FLAG:mixed:FLAG1": RAW_FALSE,
+        "FLAG:mixed:p:user:FLAG1": None,
+        "FLAG:mixed:p:team:FLAG1": None,
+        "FLAG:mixed:p:org:FLAG1": None,
+        "FLAG:mixed:k:org:FLAG1:b": RAW_TRUE,
+        HashField("FLAG:mixed:h:team:FLAG1", "a"): RAW_TRUE,
+        BitmapField(
+            "FLAG:mixed:e:user:FLAG1", "FLAG:mixed:d:user:FLAG1", 42
+        ): RAW_FALSE,
+    }
+
+
+def test_version(app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    ext._group_funcs = {"user": lambda: "1"}
+    flag = Flag("Flag1", False)
+    sample = Sample("Sample1", 42)
+    switch = Switch("Switch1", False)
+
+    assert ext.get_version() == 0
+    # Reads don't change the version
+    ext.evaluate_all()
+    assert ext.get_version() == 0
+
+    flag.enable()
+    flag.disable()
+    flag.enable_group("user")
+    flag.disable_group("user")
+    flag.clear_group("user")
+    flag.enable_group("user")
+    flag.clear_all_group("user")
+    flag.clear()
+    sample.set(12)
+    sample.clear()
+    switch.enable()
+    switch.disable()
+    switch.clear()
+    assert ext.get_version() == 13
+
+    # Nothing changes
+    flag.clear_all_group("user")
+    assert ext.get_version() == 13
+
+
+def test_transaction(app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    switch = Switch("Switch1", False)
+    redis = app.extensions["redis"]
+
+    with pytest.raises(ZeroDivisionError):
+        with ext._transaction([switch.key]) as pipe:
+            pipe.set(switch.key, 1)
+            1 / 0
+    assert redis.get(switch.key) is None
+    assert ext.get_version() == 0
+
+    with mock.patch.object(redis, "pipeline", wraps=redis.pipeline) as pipeline:
+        switch.enable()
+    pipeline.assert_called_once_with(transaction=True)
+    assert redis.get(switch.key) == b"1"
+    assert ext.get_version() == 1
+
+
+def test_bind_uninitialized(app: Flask):
+    flag = Flag("Flag1", False, extension="unknown")
+    with pytest.raises(KeyError):
+        flag.ext
+
+
+def test_redis_client_late_init():
+    app = Flask(__name__)
+    ext = FlaskPancake(app, name="late")
+    redis = FlaskRedis(app)
+    with app.app_context():
+        assert ext._redis_client is redis
+
+
+@pytest.fixture
+def other_app(app: Flask):
+    other_app = Flask(__name__)
+    other_app.config["REDIS_URL"] = "redis://localhost:6379/1"
+    other_redis = FlaskRedis(other_app)
+    other_redis.flushdb()
+    yield other_app
+    other_redis.flushdb()
+
+
+def test_multiple_apps(app: Flask, other_app: Flask):
+    FlaskPancake(other_app)
+    redis, other_redis = app.extensions["redis"], other_app.extensions["redis"]
+    switch = Switch("Switch1", False)
+
+    # Flags use the extension and Redis client of the current app
+    with other_app.app_context():
+        switch.enable()
+        assert switch.ext is other_app.extensions[EXTENSION_NAME]
+    assert other_redis.get(switch.key) == b"1"
+    assert other_redis.get("PANCAKE:pancake:version") == b"1"
+    assert redis.get(switch.key) is None
+    assert redis.get("PANCAKE:pancake:version") is None
+
+    switch.disable()
+    assert switch.ext is app.extensions[EXTENSION_NAME]
+    assert redis.get(switch.key) == b"0"
+    assert other_redis.get(switch.key) == b"1"
+
+
+def test_multiple_apps_key_schemes(app: Flask, other_app: Flask):
+    app.extensions[EXTENSION_NAME]._group_funcs = {"user": lambda: "1"}
+    FlaskPancake(other_app, key_scheme="cluster", group_funcs={"user": lambda: "1"})
+    redis, other_redis = app.extensions["redis"], other_app.extensions["redis"]
+    flag = Flag("Flag1", False)
+    switch = Switch("Switch1", False)
+
+    # The keys follow the key scheme of the current app's extension
+    with other_app.app_context():
+        flag.enable_group("user")
+        switch.enable()
+        assert flag.is_active() is True
+        assert flag.key == "FLAG:{pancake}:FLAG1"
+    assert other_redis.get("FLAG:{pancake:FLAG1}:k:user:1") == b"1"
+    assert other_redis.get("SWITCH:{pancake}:SWITCH1") == b"1"
+
+    flag.enable_group("user")
+    switch.enable()
+    assert flag.is_active() is True
+    assert flag.key == "FLAG:pancake:FLAG1"
+    assert redis.get("FLAG:pancake:k:user:FLAG1:1") == b"1"
+    assert redis.get("SWITCH:pancake:SWITCH1") == b"1"
+    assert redis.get("FLAG:{pancake:FLAG1}:k:user:1") is None
+
+
+def test_one_extension_multiple_apps(app: Flask, other_app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    ext.init_app(other_app)
+    switch = Switch("Switch1", False)
+
+    with other_app.app_context():
+        assert ext._redis_client is other_app.extensions["redis"]
+        switch.enable()
+    assert ext._redis_client is app.extensions["redis"]
+    assert app.extensions["redis"].get(switch.key) is None
+    assert other_app.extensions["redis"].get(switch.key) == b"1"
+
+
+@pytest.fixture
+def replica(app: Flask):
+    # A separate database stands in for a replica
+    app.config["REDIS_REPLICA_URL"] = "redis://localhost:6379/1"
+    replica = FlaskRedis(app, config_prefix="REDIS_REPLICA")
+    FlaskPancake(
+        app,
+        name="replicated",
+        read_redis_extension_name="redis_replica",
+        group_funcs={"user": lambda: "1"},
+    )
+    with mock.patch.object(replica, "pipeline", wraps=replica.pipeline) as pipeline:
+        yield replica
+    for call in pipeline.mock_calls:
+        assert call == mock.call(transaction=False)
+
+
+def test_read_replica(app: Flask, replica: FlaskRedis):
+    ext = app.extensions["replicated"]
+    primary = app.extensions["redis"]
+    flag = Flag("Flag1", False, extension="replicated")
+    switch = Switch("Switch1", True, extension="replicated")
+
+    # Writes go to the primary ...
+    flag.enable_group("user")
+    assert primary.get("FLAG:replicated:k:user:FLAG1:1") == RAW_TRUE
+    assert replica.get("FLAG:replicated:k:user:FLAG1:1") is None
+    assert flag.is_active() is False
+    assert flag.count_group("user") == (0, 0)
+    assert ext.get_version() == 0
+
+    # ... and reads from the replica
+    replica.set("FLAG:replicated:k:user:FLAG1:1", 1)
+    replica.set("PANCAKE:replicated:version", 1)
+    ext.clear_group_ids()
+    assert flag.is_active() is True
+    assert flag.is_active_group("user", object_id="1") is True
+    assert flag.count_group("user") == (0, 0)
+    assert ext.get_version() == 1
+
+    # Default values are only written to the primary
+    with mock.patch.object(replica, "setnx") as setnx:
+        assert switch.is_active() is True
+    setnx.assert_not_called()
+    assert primary.get(switch.key) == RAW_TRUE
+    assert replica.get(switch.key) is None
+
+
+def test_read_replica_group_storage(app: Flask, replica: FlaskRedis):
+    ext = app.extensions["replicated"]
+    ext.group_storage = "bitmap"
+    flag = Flag("Flag1", False, extension="replicated")
+    flag.enable_group("user")
+    assert flag.count_group("user") == (0, 0)
+    assert flag.is_active_group("user", object_id="1") is None
+    replica.setbit("FLAG:replicated:e:user:FLAG1", 1, 1)
+    assert flag.count_group("user") == (1, 0)
+    assert flag.is_active_group("user", object_id="1") is True
+
+    # Migrations read from the primary
+    ext.group_storage = "hash"
+    assert flag.migrate_group_storage("user") == 1
+    assert app.extensions["redis"].hgetall("FLAG:replicated:h:user:FLAG1") == {
+        b"1": RAW_TRUE
+    }
+
+
+def test_read_replica_async(app: Flask, replica: FlaskRedis):
+    switch = Switch("Switch1", True, extension="replicated")
+    replica.set(switch.key, 0)
+
+    assert asyncio.run(switch.is_active_async()) is False
+
+    replica.delete(switch.key)
+    app.extensions["redis"].set(switch.key, 0)
+    g.pop("pancake_cache")
+    # Missing values are seeded through the primary
+    with mock.patch.object(switch, "_raw_default", return_value=1):
+        assert asyncio.run(switch.is_active_async()) is False
+
+
+def test_read_client_late_init():
+    app = Flask(__name__)
+    ext = FlaskPancake(app, name="late", read_redis_extension_name="replica")
+    replica = FlaskRedis(app, config_prefix="REPLICA")
+    with app.app_context():
+        assert ext._redis_read_client is replica
@@ -2,9 +2,10 @@ from __future__ import annotations
 
 import uuid
 from typing import Dict
+from unittest import mock
 
 import pytest
-from flask import Flask
+from flask import Flask, g
 
 from flask_pancake import Flag
 from flask_pancake.constants import EXTENSION_NAME, RAW_FALSE, RAW_TRUE
@@ -140,6 +141,7 @@ def test_clear_all_group(app: Flask):
     feature.enable_group("user")
 
     context["uid"] = uid2
+    app.extensions[EXTENSION_NAME].clear_group_ids()
     feature.enable_group("user")
 
     assert app.extensions["redis"].get(object_key1) == RAW_TRUE
@@ -156,6 +158,41 @@ def test_clear_all_group(app: Flask):
     assert app.extensions["redis"].smembers(tracking_key) == set()
 
 
+def test_clear_all_group_batched(app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    ext._group_funcs = {"user": noop}
+    feature = Flag("FEATURE", True)
+    for uid in range(25):
+        feature.disable_group("user", object_id=str(uid))
+    redis = app.extensions["redis"]
+    version = ext.get_version()
+
+    progress = mock.Mock()
+    with mock.patch.object(redis, "smembers") as smembers:
+        feature.clear_all_group("user", batch_size=10, progress=progress)
+    smembers.assert_not_called()
+    assert sum(c.args[0] for c in progress.call_args_list) == 25
+    assert all(c.args[0] <= 10 for c in progress.call_args_list)
+    assert ext.get_version() == version + progress.call_count
+    assert redis.keys("FLAG:pancake:*:user:*") == []
+
+
+@pytest.mark.parametrize("group_storage", ["hash", "bitmap"])
+def test_clear_all_group_progress(app: Flask, group_storage):
+    ext = app.extensions[EXTENSION_NAME]
+    ext.group_storage = group_storage
+    ext._group_funcs = {"user": noop}
+    feature = Flag("FEATURE", True)
+    for uid in range(25):
+        feature.disable_group("user", object_id=str(uid))
+
+    progress = mock.Mock()
+    feature.clear_all_group("user", batch_size=10, progress=progress)
+    progress.assert_called_once_with(25)
+    feature.clear_all_group("user", progress=progress)
+    progress.assert_called_once_with(25)
+
+
 def test_disable_group(app: Flask):
     uid = str(uuid.uuid4())
     app.extensions[EXTENSION_NAME]._group_funcs = {"user": lambda: uid}
@@ -323,6 +360,72 @@ def test_flag_multiple_groups_fallback(app: Flask):
     assert feature.is_active() is True
 
 
+def test_request_cache(app: Flask):
+    uid = str(uuid.uuid4())
+    app.extensions[EXTENSION_NAME]._group_funcs = {"user": lambda: uid}
+    feature = Flag("FEATURE", False)
+    object_key = f"FLAG:pancake:k:user:FEATURE:{uid}"
+
+    assert feature.is_active() is False
+    assert g.pancake_cache == {
+        "pancake": {"FLAG:pancake:FEATURE": False, "FLAG:pancake:FEATURE:groups": False}
+    }
+
+    # Changes made outside of the flag's API are not seen within the same request
+    app.extensions["redis"].set(object_key, 1)
+    assert feature.is_active() is False
+
+    feature.enable_group("user")
+    assert "pancake" not in g.pancake_cache
+    assert feature.is_active() is True
+
+    app.extensions["redis"].set(object_key, 0)
+    assert feature.is_active() is True
+
+    feature.clear_group("user")
+    assert feature.is_active() is False
+
+    feature.enable()
+    assert feature.is_active() is True
+
+    feature.disable_group("user")
+    assert feature.is_active() is False
+
+    feature.clear_all_group("user")
+    assert feature.is_active() is True
+
+    feature.clear()
+    assert feature.is_active() is False
+
+
+def test_is_active_single_round_trip(app: Flask):
+    app.extensions[EXTENSION_NAME]._group_funcs = {
+        "user": lambda: "u1",
+        "anonymous": lambda: None,
+        "group": lambda: "g1",
+    }
+    feature = Flag("FEATURE", False)
+    feature.enable()
+    feature.disable_group("group")
+    redis = app.extensions["redis"]
+
+    with mock.patch.object(redis, "mget", wraps=redis.mget) as mget, mock.patch.object(
+        redis, "get"
+    ) as get:
+        assert feature.is_active() is False
+    mget.assert_called_once_with(
+        [
+            "FLAG:pancake:k:user:FEATURE:u1",
+            "FLAG:pancake:k:group:FEATURE:g1",
+            "FLAG:pancake:p:user:FEATURE",
+            "FLAG:pancake:p:group:FEATURE",
+            "FLAG:pancake:FEATURE",
+        ]
+    )
+    get.assert_not_called()
+    assert g.pancake_cache["pancake"] == {"FLAG:pancake:FEATURE:groups": False}
+
+
 def test_out_of_bounds_default():
     with pytest.raises(
         ValueError,
@@ -340,7 +443,7 @@ def test_get_group_keys_no_groups(app: Flask):
         "instead."
     )
     with pytest.raises(RuntimeError, match=msg):
-        feature._get_group_keys("user")
+        feature._get_group_keys(app.extensions[EXTENSION_NAME], "user")
 
 
 def test_get_group_keys_group_not_defined(app: Flask):
@@ -351,4 +454,257 @@ def test_get_group_keys_group_not_defined(app: Flask):
         "registered in the FlaskPancake extension 'pancake'."
     )
     with pytest.raises(RuntimeError, match=msg):
-        feature._get_group_keys("user")
+        feature._get_group_keys(app.extensions[EXTENSION_NAME], "user")
+
+
+def test_group_rollout(app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    ids = {"user": "u23", "group": None}
+    ext._group_funcs = {"user": lambda: ids["user"], "group": lambda: ids["group"]}
+    feature = Flag("FEATURE", False)
+    redis = app.extensions["redis"]
+
+    assert feature.get_group_rollout("user") is None
+    feature.set_group_rollout("user", 10)
+    assert redis.get("FLAG:pancake:p:user:FEATURE") == b"10"
+    assert feature.get_group_rollout("user") == 10
+    assert feature.is_active() is False
+
+    feature.set_group_rollout("user", 20)
+    assert feature.is_active() is True
+    assert ext.evaluate(["FEATURE"]).flags == {"FEATURE": True}
+
+    # Objects in any group's rollout activate the flag
+    ids.update(user="u2", group="g5")
+    ext.clear_group_ids()
+    assert feature.is_active() is False
+    feature.set_group_rollout("group", 20)
+    assert feature.is_active() is True
+
+    # Overrides for individual objects win
+    feature.disable_group("group")
+    assert feature.is_active() is False
+    feature.clear_group("group")
+
+    feature.clear_group_rollout("group")
+    assert feature.get_group_rollout("group") is None
+    assert feature.is_active() is False
+    # The rollout does not deactivate a globally active flag
+    feature.enable()
+    assert feature.is_active() is True
+
+
+@pytest.mark.parametrize(
+    "names, percentage",
+    [(("NEW_UI", "NEW_UX"), 50), (("CHECKOUT", "CHECKIN_"), 10)],
+)
+def test_group_rollout_independent(app: Flask, names, percentage):
+    # Flags with similar names must not be rolled out to the same objects
+    ext = app.extensions[EXTENSION_NAME]
+    ext._group_funcs = {"user": noop}
+    flags = [Flag(name, False) for name in names]
+    value = str(percentage).encode()
+    object_ids = [str(i) for i in range(20000)]
+    active = [
+        {i for i in object_ids if flag._in_rollout(ext, "user", i, value)}
+        for flag in flags
+    ]
+    expected = len(object_ids) * (percentage / 100) ** 2
+    assert len(active[0] & active[1]) == pytest.approx(expected, rel=0.15)
+
+
+@pytest.mark.parametrize("value", [-0.000001, 100.00001])
+def test_group_rollout_out_of_bounds(app: Flask, value):
+    app.extensions[EXTENSION_NAME]._group_funcs = {"user": noop}
+    feature = Flag("X", False)
+    with pytest.raises(
+        ValueError,
+        match=r"Rollout for flag X must be in the range \[0, 100\]\.",
+    ):
+        feature.set_group_rollout("user", value)
+
+
+def test_group_storage_hash(app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    ext.group_storage = "hash"
+    uid = "u1"
+    ext._group_funcs = {"user": lambda: uid}
+    feature = Flag("FEATURE", False)
+    redis = app.extensions["redis"]
+
+    feature.enable_group("user")
+    feature.disable_group("user", object_id="u2")
+    feature.enable_group("user", object_id="u3")
+    assert redis.keys("FLAG:pancake:*:user:*") == [b"FLAG:pancake:h:user:FEATURE"]
+    assert redis.hgetall("FLAG:pancake:h:user:FEATURE") == {
+        b"u1": RAW_TRUE,
+        b"u2": RAW_FALSE,
+        b"u3": RAW_TRUE,
+    }
+
+    # The override and the global value are fetched in a single round trip
+    with mock.patch.object(redis, "pipeline", wraps=redis.pipeline) as pipeline:
+        assert feature.is_active() is True
+    pipeline.assert_called_once_with(transaction=False)
+    assert feature.is_active_group("user", object_id="u2") is False
+    assert feature.is_active_group("user", object_id="u4") is None
+
+    feature.clear_group("user", object_id="u3")
+    assert redis.hgetall("FLAG:pancake:h:user:FEATURE") == {
+        b"u1": RAW_TRUE,
+        b"u2": RAW_FALSE,
+    }
+
+    version = ext.get_version()
+    feature.clear_all_group("user")
+    assert redis.exists("FLAG:pancake:h:user:FEATURE") == 0
+    assert feature.is_active() is False
+    assert ext.get_version() == version + 1
+
+    # Nothing changes
+    feature.clear_all_group("user")
+    assert ext.get_version() == version + 1
+
+
+def test_group_storage_bitmap(app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    ext.group_storage = "bitmap"
+    uid = "1"
+    ext._group_funcs = {"user": lambda: uid}
+    feature = Flag("FEATURE", False)
+    redis = app.extensions["redis"]
+
+    feature.enable_group("user")
+    feature.disable_group("user", object_id="2")
+    feature.enable_group("user", object_id="9")
+    assert sorted(redis.keys("FLAG:pancake:*:user:*")) == [
+        b"FLAG:pancake:d:user:FEATURE",
+        b"FLAG:pancake:e:user:FEATURE",
+    ]
+    assert redis.get("FLAG:pancake:e:user:FEATURE") == b"\x40\x40"
+    assert redis.get("FLAG:pancake:d:user:FEATURE") == b"\x20\x00"
+    assert feature.count_group("user") == (2, 1)
+
+    assert feature.is_active() is True
+    assert feature.is_active_group("user", object_id="2") is False
+    assert feature.is_active_group("user", object_id="3") is None
+
+    feature.enable_group("user", object_id="2")
+    assert feature.is_active_group("user", object_id="2") is True
+    feature.clear_group("user", object_id="2")
+    assert feature.is_active_group("user", object_id="2") is None
+    assert feature.count_group("user") == (2, 0)
+
+    version = ext.get_version()
+    feature.clear_all_group("user")
+    assert redis.keys("FLAG:pancake:*:user:*") == []
+    assert feature.is_active() is False
+    assert ext.get_version() == version + 1
+
+    # Nothing changes
+    feature.clear_all_group("user")
+    assert ext.get_version() == version + 1
+
+
+@pytest.mark.parametrize("object_id", ["a", "-1", "1.0", "4294967296", "\u00b2"])
+def test_group_storage_bitmap_invalid_id(app: Flask, object_id):
+    ext = app.extensions[EXTENSION_NAME]
+    ext.group_storage = "bitmap"
+    ext._group_funcs = {"user": noop}
+    feature = Flag("FEATURE", False)
+    msg = (
+        rf"Invalid object ID '{object_id}'\. The bitmap group storage only supports "
+        r"integer object IDs in the range \[0, 2\^32\)\."
+    )
+    with pytest.raises(ValueError, match=msg):
+        feature.enable_group("user", object_id=object_id)
+
+
+def test_group_storage_bitmap_read_invalid_id(app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    ext.group_storage = {"user": "bitmap", "team": "keys"}
+    ext._group_funcs = {"user": lambda: "anon-session-abc", "team": lambda: "t1"}
+    feature = Flag("FEATURE", False)
+
+    # Objects with IDs the bitmap can't store never have an override
+    assert feature.is_active_group("user") is None
+    assert feature.is_active() is False
+    feature.set_group_rollout("user", 100)
+    assert feature.is_active() is True
+    feature.disable_group("team")
+    assert feature.is_active() is False
+    assert ext.evaluate(["FEATURE"]).flags == {"FEATURE": False}
+    with pytest.raises(ValueError, match=r"Invalid object ID 'anon-session-abc'\."):
+        feature.enable_group("user")
+
+
+@pytest.mark.parametrize(
+    "source, target", [("keys", "hash"), ("hash", "bitmap"), ("bitmap", "keys")]
+)
+def test_migrate_group_storage_keeps_newer(app: Flask, source, target):
+    ext = app.extensions[EXTENSION_NAME]
+    ext.group_storage = source
+    ext._group_funcs = {"user": noop}
+    feature = Flag("FEATURE", False)
+    feature.enable_group_many("user", ["1", "2", "3"])
+
+    # Changes made after switching the layout are newer than the migrated ones
+    ext.group_storage = target
+    feature.disable_group("user", object_id="1")
+    feature.clear_group("user", object_id="2")
+    feature.enable_group("user", object_id="4")
+    assert feature.migrate_group_storage("user", batch_size=2) == 3
+
+    assert feature.is_active_group("user", object_id="1") is False
+    assert feature.is_active_group("user", object_id="2") is True
+    assert feature.is_active_group("user", object_id="3") is True
+    assert feature.is_active_group("user", object_id="4") is True
+    assert feature.count_group("user") == (3, 1)
+
+
+@pytest.mark.parametrize("group_storage", ["keys", "hash"])
+def test_count_group(app: Flask, group_storage):
+    ext = app.extensions[EXTENSION_NAME]
+    ext.group_storage = group_storage
+    ext._group_funcs = {"user": noop}
+    feature = Flag("FEATURE", False)
+    assert feature.count_group("user") == (0, 0)
+    feature.enable_group("user", object_id="a")
+    feature.enable_group("user", object_id="b")
+    feature.disable_group("user", object_id="c")
+    assert feature.count_group("user") == (2, 1)
+
+
+@pytest.mark.parametrize("group_storage", ["keys", "hash", "bitmap"])
+def test_group_many(app: Flask, group_storage):
+    ext = app.extensions[EXTENSION_NAME]
+    ext.group_storage = group_storage
+    ext._group_funcs = {"user": noop}
+    feature = Flag("FEATURE", False)
+    version = ext.get_version()
+
+    feature.enable_group_many("user", (str(uid) for uid in range(25)), batch_size=10)
+    assert ext.get_version() == version + 3
+    feature.disable_group_many("user", ["20", "21", "30"])
+    assert ext.get_version() == version + 4
+    assert feature.count_group("user") == (23, 3)
+    assert feature.is_active_group("user", object_id="1") is True
+    assert feature.is_active_group("user", object_id="21") is False
+
+    feature.clear_group_many("user", [str(uid) for uid in range(21)])
+    assert feature.count_group("user") == (3, 2)
+    assert feature.is_active_group("user", object_id="1") is None
+    assert feature.is_active_group("user", object_id="30") is False
+
+    feature.clear_group_many("user", [])
+    assert ext.get_version() == version + 5
+
+
+def test_group_many_invalid_id(app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    ext.group_storage = "bitmap"
+    ext._group_funcs = {"user": noop}
+    feature = Flag("FEATURE", False)
+    with pytest.raises(ValueError, match=r"Invalid object ID 'x'\."):
+        feature.enable_group_many("user", ["1", "x"], batch_size=1)
+    assert feature.count_group("user") == (0, 0)
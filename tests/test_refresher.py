@@ -0,0 +1,406 @@
+from typing import Dict, Optional
+from unittest import mock
+
+import pytest
+from flask import Flask, g
+
+from flask_pancake import Flag, FlaskPancake, Sample, Switch
+from flask_pancake.constants import RAW_FALSE, RAW_TRUE
+from flask_pancake.refresher import (
+    HEADER,
+    SharedSnapshotRefresher,
+    SnapshotRefresher,
+    dump_snapshot,
+    load_snapshot,
+)
+from flask_pancake.utils import BitmapField, HashField, KeyType
+from tests.conftest import wait_for
+
+
+@pytest.fixture
+def ext(app: Flask):
+    ext = FlaskPancake(
+        app,
+        name="refreshed",
+        refresh_interval=60,
+        group_funcs={"user": lambda: "uid"},
+    )
+    refresher = ext._refresher
+    assert refresher is not None
+    # Wait for the initial load of the refresher thread
+    wait_for(lambda: refresher._values is not None)
+    yield ext
+    refresher.close()
+
+
+@pytest.fixture
+def refresher(ext: FlaskPancake) -> SnapshotRefresher:
+    assert ext._refresher is not None
+    return ext._refresher
+
+
+def test_mutually_exclusive():
+    msg = r"The arguments `cache_ttl` and `refresh_interval` are mutually exclusive\."
+    with pytest.raises(ValueError, match=msg):
+        FlaskPancake(cache_ttl=1, refresh_interval=1)
+
+
+def test_load_state(ext: FlaskPancake, app: Flask):
+    flag = Flag("my-flag", False, extension="refreshed")
+    Sample("my-sample", 42, extension="refreshed")
+    Switch("my-switch", True, extension="refreshed")
+    flag.enable_group("user", object_id="1")
+    flag.disable_group("user", object_id="2")
+
+    assert ext._load_state() == {
+        "PANCAKE:refreshed:version": b"2",
+        "FLAG:refreshed:MY-FLAG": RAW_FALSE,
+        "SAMPLE:refreshed:MY-SAMPLE": b"42",
+        "SWITCH:refreshed:MY-SWITCH": RAW_TRUE,
+        "FLAG:refreshed:p:user:MY-FLAG": None,
+        "FLAG:refreshed:k:user:MY-FLAG:1": RAW_TRUE,
+        "FLAG:refreshed:k:user:MY-FLAG:2": RAW_FALSE,
+    }
+    # Default values are persisted while loading the state
+    assert app.extensions["redis"].get("SWITCH:refreshed:MY-SWITCH") == RAW_TRUE
+
+
+def test_load_state_hash(ext: FlaskPancake, refresher: SnapshotRefresher):
+    ext.group_storage = "hash"
+    flag = Flag("my-flag", False, extension="refreshed")
+    flag.enable_group("user", object_id="1")
+    flag.disable_group("user", object_id="2")
+
+    assert ext._load_state() == {
+        "PANCAKE:refreshed:version": b"2",
+        "FLAG:refreshed:MY-FLAG": RAW_FALSE,
+        "FLAG:refreshed:p:user:MY-FLAG": None,
+        HashField("FLAG:refreshed:h:user:MY-FLAG", "1"): RAW_TRUE,
+        HashField("FLAG:refreshed:h:user:MY-FLAG", "2"): RAW_FALSE,
+    }
+    g.pop("pancake_cache", None)
+    assert flag.is_active() is False
+    refresher.refresh()
+    with mock.patch.object(ext, "_fetch") as fetch:
+        assert flag.is_active_group("user", object_id="1") is True
+        assert flag.is_active_group("user", object_id="3") is None
+    fetch.assert_not_called()
+
+
+def test_load_state_bitmap(ext: FlaskPancake):
+    ext.group_storage = "bitmap"
+    flag = Flag("my-flag", False, extension="refreshed")
+    flag.enable_group("user", object_id="1")
+    flag.disable_group("user", object_id="10")
+
+    enabled, disabled = "FLAG:refreshed:e:user:MY-FLAG", "FLAG:refreshed:d:user:MY-FLAG"
+    assert ext._load_state() == {
+        "PANCAKE:refreshed:version": b"2",
+        "FLAG:refreshed:MY-FLAG": RAW_FALSE,
+        "FLAG:refreshed:p:user:MY-FLAG": None,
+        BitmapField(enabled, disabled, 1): RAW_TRUE,
+        BitmapField(enabled, disabled, 10): RAW_FALSE,
+    }
+
+
+def test_snapshot_reads(refresher: SnapshotRefresher, app: Flask):
+    flag = Flag("my-flag", False, extension="refreshed")
+    sample = Sample("my-sample", 42, extension="refreshed")
+    switch = Switch("my-switch", True, extension="refreshed")
+    flag.enable_group("user")
+    redis = app.extensions["redis"]
+    # Load the flags registered after the initial load
+    refresher.refresh()
+
+    with mock.patch.object(redis, "get") as get, mock.patch.object(
+        redis, "mget"
+    ) as mget:
+        assert flag.is_active() is True
+        assert flag.is_active_globally() is False
+        assert sample.get() == 42
+        assert switch.is_active() is True
+    get.assert_not_called()
+    mget.assert_not_called()
+    g.pop("pancake_cache")
+
+    # Changes made to Redis directly are only visible after the next refresh
+    redis.set(switch.key, 0)
+    assert switch.is_active() is True
+    g.pop("pancake_cache")
+    refresher.refresh()
+    assert switch.is_active() is False
+
+    # Changes through the API are visible right away
+    switch.enable()
+    assert switch.is_active() is True
+    flag.clear_group("user")
+    assert flag.is_active() is False
+
+
+@pytest.mark.parametrize("group_storage", ["keys", "hash"])
+def test_writes_update_snapshot(
+    ext: FlaskPancake, refresher: SnapshotRefresher, group_storage
+):
+    flag = Flag("my-flag", False, extension="refreshed")
+    refresher.refresh()
+    object_ids = [str(i) for i in range(10)]
+    # Writes only read the changed keys into the snapshot
+    with mock.patch.object(ext, "_load_state") as load_state:
+        flag.enable_group_many("user", object_ids, batch_size=2)
+        assert flag.is_active_group("user", object_id="1") is True
+        ext.group_storage = group_storage
+        assert flag.migrate_group_storage("user", batch_size=2) == (
+            0 if group_storage == "keys" else 10
+        )
+        assert flag.is_active_group("user", object_id="1") is True
+        flag.disable_group("user", object_id="1")
+        assert flag.is_active_group("user", object_id="1") is False
+    load_state.assert_not_called()
+
+    # Clearing a whole hash doesn't tell which keys changed, the refresher thread
+    # loads the complete state instead.
+    flag.clear_all_group("user", batch_size=2)
+    wait_for(lambda: flag.is_active_group("user", object_id="1") is None)
+    assert flag.count_group("user") == (0, 0)
+
+
+def test_update_no_snapshot_yet(refresher: SnapshotRefresher):
+    refresher._values = None
+    refresher.update(["a"])
+    assert refresher._values is None
+
+
+def test_no_snapshot_yet(refresher: SnapshotRefresher, app: Flask):
+    switch = Switch("my-switch", True, extension="refreshed")
+    redis = app.extensions["redis"]
+    redis.set(switch.key, 0)
+
+    refresher._values = None
+    with mock.patch.object(refresher, "start"):
+        assert switch.is_active() is False
+
+
+def test_refresh_interval(app: Flask):
+    ext = FlaskPancake(app, name="refreshed", refresh_interval=0.01)
+    switch = Switch("my-switch", True, extension="refreshed")
+    refresher = ext._refresher
+    assert refresher is not None
+    app.extensions["redis"].set(switch.key, 0)
+    wait_for(lambda: refresher.get_many([switch.key]) == {switch.key: RAW_FALSE})
+    refresher.close()
+
+
+def test_refresh_error(app: Flask):
+    ext = FlaskPancake(name="refreshed", refresh_interval=60)
+    with mock.patch.object(
+        ext, "_load_state", side_effect=Exception("fail")
+    ) as load_state:
+        ext.init_app(app)
+        refresher = ext._refresher
+        assert refresher is not None
+        wait_for(lambda: load_state.called)
+        refresher.close()
+    assert refresher._values is None
+
+
+def test_start_once_per_process(ext: FlaskPancake, refresher: SnapshotRefresher):
+    thread = refresher._thread
+    refresher.start()
+    assert refresher._thread is thread
+
+    # A forked process starts its own refresher and drops the inherited snapshot
+    with mock.patch.object(ext, "_load_state", return_value={}), mock.patch(
+        "os.getpid", return_value=-1
+    ):
+        refresher.start()
+        assert refresher._thread is not thread
+
+
+def test_close_not_started(app: Flask):
+    refresher = SnapshotRefresher(FlaskPancake(), app, 60)
+    refresher.close()
+    assert refresher._thread is None
+    assert refresher._values is None
+
+
+@pytest.fixture
+def shared(app: Flask, tmp_path):
+    ext = FlaskPancake(
+        app,
+        name="shared",
+        refresh_interval=60,
+        snapshot_path=str(tmp_path / "snapshot"),
+        group_funcs={"user": lambda: "uid"},
+    )
+    refresher = ext._refresher
+    assert refresher is not None
+    wait_for(lambda: refresher._values is not None)
+    yield ext
+    refresher.close()
+
+
+@pytest.fixture
+def writer(shared: FlaskPancake) -> SharedSnapshotRefresher:
+    assert isinstance(shared._refresher, SharedSnapshotRefresher)
+    return shared._refresher
+
+
+@pytest.fixture
+def reader(shared: FlaskPancake, app: Flask):
+    # Locks of separately opened files conflict like those of other processes
+    # The tests update the reader instead of a background thread
+    assert shared.snapshot_path is not None
+    reader = SharedSnapshotRefresher(shared, app, 60, shared.snapshot_path)
+    with mock.patch.object(reader, "start"):
+        yield reader
+    reader.close()
+
+
+def test_snapshot_path_requires_refresh_interval():
+    msg = r"The argument `snapshot_path` requires `refresh_interval`\."
+    with pytest.raises(ValueError, match=msg):
+        FlaskPancake(snapshot_path="/tmp/snapshot")
+
+
+def test_dump_load_snapshot():
+    values = {
+        "FLAG:shared:MY-FLAG": RAW_TRUE,
+        "FLAG:shared:p:user:MY-FLAG": None,
+        HashField("FLAG:shared:h:user:MY-FLAG", "1"): RAW_FALSE,
+        BitmapField("e", "d", 10): b"\xff",
+    }
+    assert load_snapshot(dump_snapshot(values)) == values
+
+
+def test_shared_snapshot(
+    app: Flask,
+    shared: FlaskPancake,
+    writer: SharedSnapshotRefresher,
+    reader: SharedSnapshotRefresher,
+):
+    switch = Switch("my-switch", True, extension="shared")
+    assert writer.is_writer
+    writer.refresh()
+
+    with mock.patch.object(shared, "_load_state") as load_state:
+        assert reader.get_many([switch.key]) == {switch.key: RAW_TRUE}
+        reader._update()
+        assert not reader.is_writer
+    load_state.assert_not_called()
+
+    # Changes by the writer are visible right away
+    switch.disable()
+    assert reader.get_many([switch.key]) == {switch.key: RAW_FALSE}
+
+    # Changes made in a reading process are visible to it right away, too
+    sequence = reader._sequence
+    app.extensions["redis"].set(switch.key, 1)
+    reader.refresh()
+    assert reader.get_many([switch.key]) == {switch.key: RAW_TRUE}
+    assert reader._sequence == sequence
+
+
+def test_shared_snapshot_update(writer: SharedSnapshotRefresher):
+    writer.refresh()
+    sequence = writer._sequence
+    with mock.patch.object(writer, "_wake") as wake:
+        writer.update(None)
+    wake.set.assert_called_once_with()
+    assert writer._sequence == sequence
+
+    writer._values = None
+    writer.update(["a"])
+    assert writer._sequence == sequence
+
+
+def test_shared_snapshot_takeover(
+    writer: SharedSnapshotRefresher, reader: SharedSnapshotRefresher
+):
+    switch = Switch("my-switch", True, extension="shared")
+    writer._update()
+    assert reader.get_many([switch.key]) == {switch.key: RAW_TRUE}
+    sequence = reader._sequence
+
+    writer.close()
+    reader._update()
+    assert reader.is_writer
+    assert reader._sequence == sequence + 2
+    assert reader.get_many([switch.key]) == {switch.key: RAW_TRUE}
+
+
+def test_shared_snapshot_grow(
+    writer: SharedSnapshotRefresher, reader: SharedSnapshotRefresher
+):
+    assert reader.get_many(["a"]) == {"a": None}
+    values: Dict[KeyType, Optional[bytes]] = {f"key-{i}": b"1" for i in range(1000)}
+    writer._write(dump_snapshot(values))
+    assert reader.get_many(["key-999"]) == {"key-999": b"1"}
+
+
+def test_shared_snapshot_write_in_progress(
+    writer: SharedSnapshotRefresher, reader: SharedSnapshotRefresher, caplog
+):
+    assert reader.get_many(["a"]) == {"a": None}
+    writer_map = writer._map
+    assert writer_map is not None
+    sequence, length = HEADER.unpack_from(writer_map)
+    HEADER.pack_into(writer_map, 0, sequence + 1, length)
+    with mock.patch("os.sched_yield") as sched_yield:
+        assert reader.get_many(["a"]) == {"a": None}
+    assert sched_yield.call_count == 100
+    assert "Failed to read the shared flask-pancake snapshot." in caplog.text
+
+
+def test_shared_snapshot_torn_read(
+    writer: SharedSnapshotRefresher, reader: SharedSnapshotRefresher
+):
+    writer_map = writer._map
+    assert writer_map is not None
+    switch = Switch("my-switch", True, extension="shared")
+
+    class ConcurrentWrite(bytearray):
+        written = False
+
+        def __getitem__(self, index):
+            value = super().__getitem__(index)
+            if isinstance(index, slice) and not self.written:
+                # The writer finishes a write while the payload is copied
+                self.written = True
+                switch.disable()
+                self[:] = writer_map[: len(self)]
+            return value
+
+    with mock.patch.object(reader, "_map", ConcurrentWrite(writer_map[:])):
+        assert reader.get_many([switch.key]) == {switch.key: RAW_FALSE}
+
+
+def test_shared_snapshot_missing(app: Flask, tmp_path):
+    path = tmp_path / "snapshot"
+    reader = SharedSnapshotRefresher(FlaskPancake(), app, 60, str(path))
+    with mock.patch.object(reader, "start"):
+        assert reader.get_many(["a"]) is None
+        path.touch()
+        assert reader.get_many(["a"]) is None
+
+
+def test_shared_snapshot_read_by_other_thread(
+    writer: SharedSnapshotRefresher, reader: SharedSnapshotRefresher
+):
+    reader._read()
+    writer.refresh()
+    writer_map = writer._map
+    assert writer_map is not None
+
+    class OtherThreadReads:
+        # Another thread reads the snapshot while this one waits for the lock
+        def __enter__(self):
+            reader._sequence = HEADER.unpack_from(writer_map)[0]
+
+        def __exit__(self, *exc_info):
+            pass
+
+    with mock.patch.object(reader, "_read_lock", OtherThreadReads()), mock.patch(
+        "flask_pancake.refresher.load_snapshot"
+    ) as load_snapshot:
+        reader._read()
+    load_snapshot.assert_not_called()
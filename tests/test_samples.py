@@ -1,11 +1,13 @@
 from __future__ import annotations
 
+from typing import Optional
 from unittest import mock
 
 import pytest
 from flask import Flask, g
 
 from flask_pancake import FlaskPancake, Sample
+from flask_pancake.utils import get_bucket
 
 
 def test_sample(app: Flask):
@@ -55,6 +57,23 @@ def test_store_load(app: Flask):
     assert g.pancakes["pancake"]["feature"] is False
 
 
+def test_get_existing_value(app: Flask):
+    sample = Sample("my-sample", 42)
+    key = "SAMPLE:pancake:MY-SAMPLE"
+    redis = app.extensions["redis"]
+
+    with mock.patch.object(redis, "setnx", wraps=redis.setnx) as setnx:
+        assert sample.get() == 42
+    setnx.assert_called_once_with(key, 42)
+
+    with mock.patch.object(redis, "setnx") as setnx, mock.patch.object(
+        redis, "get", wraps=redis.get
+    ) as get:
+        assert sample.get() == 42
+    setnx.assert_not_called()
+    get.assert_called_once_with(key)
+
+
 def test_key(app: Flask):
     sample = Sample("my-sample", True)
     assert sample.key == "SAMPLE:pancake:MY-SAMPLE"
@@ -83,3 +102,54 @@ def test_sample_out_of_bounds_set(value):
         match=r"Value for sample X must be in the range \[0, 100\]\.",
     ):
         sample.set(value)
+
+
+def test_group_id(app: Flask):
+    ext = app.extensions["pancake"]
+    uid: Optional[str] = "user-3"
+    ext._group_funcs = {"user": lambda: uid}
+    feature = Sample("feature", 42, group_id="user")
+    assert get_bucket(feature.key, "user-3") == pytest.approx(0.39, abs=0.01)
+    assert get_bucket(feature.key, "user-2") == pytest.approx(72.27, abs=0.01)
+
+    with mock.patch("random.uniform") as uniform:
+        assert feature.is_active() is True
+        assert ext.evaluate(["feature"]).samples == {"feature": True}
+        uid = "user-2"
+        ext.clear_group_ids()
+        assert feature.is_active() is False
+    uniform.assert_not_called()
+    assert g.get("pancakes", {}).get("pancake", {}) == {}
+
+    # Requests without a subject fall back to the cookie
+    uid = None
+    ext.clear_group_ids()
+    with mock.patch("random.uniform", return_value=1):
+        assert feature.is_active() is True
+    assert g.pancakes["pancake"] == {"feature": True}
+
+
+def test_group_id_unknown(app: Flask):
+    feature = Sample("feature", 42, group_id="user")
+    msg = (
+        r"Invalid group identifer 'user'\. This group doesn't seem to be registered "
+        r"in the FlaskPancake extension 'pancake'\."
+    )
+    with pytest.raises(RuntimeError, match=msg):
+        feature.is_active()
+
+
+@pytest.mark.parametrize(
+    "names, percentage",
+    [(("new_ui", "new_ux"), 50), (("checkout", "checkin_"), 10)],
+)
+def test_group_id_independent(app: Flask, names, percentage):
+    # Samples with similar names must not be rolled out to the same subjects
+    samples = [Sample(name, percentage, group_id="user") for name in names]
+    subject_ids = [str(i) for i in range(20000)]
+    active = [
+        {i for i in subject_ids if get_bucket(sample.key, i) < percentage}
+        for sample in samples
+    ]
+    expected = len(subject_ids) * (percentage / 100) ** 2
+    assert len(active[0] & active[1]) == pytest.approx(expected, rel=0.15)
@@ -0,0 +1,256 @@
+import asyncio
+import threading
+from unittest import mock
+
+import pytest
+from flask import Flask, g
+from redis import Redis
+from redis.exceptions import DataError, ResponseError
+
+from flask_pancake import Flag, FlaskPancake, MemoryStorage, Sample, Snapshot, Switch
+from flask_pancake.views import aggregate_data
+
+
+@pytest.fixture
+def storage():
+    return MemoryStorage()
+
+
+@pytest.fixture
+def ext(app: Flask, storage: MemoryStorage):
+    return FlaskPancake(
+        app, name="memory", storage=storage, group_funcs={"user": lambda: "1"}
+    )
+
+
+def test_strings(storage: MemoryStorage):
+    assert storage.get("a") is None
+    assert storage.set("a", 1) is True
+    assert storage.setnx("a", 2) is False
+    assert storage.setnx(b"b", 4.2) is True
+    assert storage.mset({"c": "x", "d": b"y"}) is True
+    assert storage.mget(["a", "b", "c", "d", "e"]) == [b"1", b"4.2", b"x", b"y", None]
+    assert storage.mget("a", "b") == [b"1", b"4.2"]
+    assert storage.incr("a") == 2
+    assert storage.incr("new", 5) == 5
+    with pytest.raises(ResponseError, match="not an integer"):
+        storage.incr("c")
+    assert storage.exists("a", "b", "x") == 2
+    assert storage.delete("a", "x") == 1
+    assert storage.unlink("b") == 1
+    assert storage.get("a") is None
+
+
+@pytest.mark.parametrize("value", [True, None, [1]])
+def test_invalid_value(storage: MemoryStorage, value):
+    with pytest.raises(DataError, match="Invalid input of type"):
+        storage.set("a", value)
+
+
+def test_wrong_type(storage: MemoryStorage):
+    storage.sadd("s", "a")
+    msg = "WRONGTYPE Operation against a key holding the wrong kind of value"
+    with pytest.raises(ResponseError, match=msg):
+        storage.get("s")
+    with pytest.raises(ResponseError, match=msg):
+        storage.hset("s", "a", 1)
+    # Like Redis, MGET returns nil for keys that don't hold a string
+    assert storage.mget(["s"]) == [None]
+
+
+def test_bitmaps(storage: MemoryStorage):
+    assert storage.getbit("b", 100) == 0
+    assert storage.setbit("b", 1, 1) == 0
+    assert storage.setbit("b", 10, True) == 0
+    assert storage.setbit("b", 10, 1) == 1
+    assert storage.get("b") == b"\x40\x20"
+    assert storage.getbit("b", 10) == 1
+    assert storage.bitcount("b") == 2
+    assert storage.setbit("b", 10, 0) == 1
+    assert storage.get("b") == b"\x40\x00"
+    assert storage.bitcount("missing") == 0
+
+
+def test_sets(storage: MemoryStorage):
+    assert storage.sadd("s", "a", "b", b"a") == 2
+    assert storage.sadd("s", "a", "c") == 1
+    assert storage.smembers("s") == {b"a", b"b", b"c"}
+    assert sorted(storage.sscan_iter("s", count=2)) == [b"a", b"b", b"c"]
+    assert storage.srem("s", "a", "x") == 1
+    assert storage.srem("missing", "a") == 0
+    assert storage.srem("s", "b", "c") == 2
+    # Empty sets are removed
+    assert storage.exists("s") == 0
+    assert storage.smembers("s") == set()
+
+
+def test_hashes(storage: MemoryStorage):
+    assert storage.hset("h", "a", 1) == 1
+    assert storage.hset("h", mapping={"a": 2, "b": 0}) == 1
+    assert storage.hsetnx("h", "a", 3) is False
+    assert storage.hsetnx("h", "c", 3) is True
+    assert storage.hdel("h", "c") == 1
+    assert storage.hgetall("h") == {b"a": b"2", b"b": b"0"}
+    assert storage.hmget("h", ["a", "c"]) == [b"2", None]
+    assert storage.hmget("h", "a", "b") == [b"2", b"0"]
+    assert storage.hmget("missing", ["a"]) == [None]
+    assert storage.hlen("h") == 2
+    assert sorted(storage.hscan_iter("h")) == [(b"a", b"2"), (b"b", b"0")]
+    with pytest.raises(DataError):
+        storage.hset("h")
+    assert storage.hdel("h", "a", "c") == 1
+    assert storage.hdel("missing", "a") == 0
+    assert storage.hdel("h", "b") == 1
+    assert storage.exists("h") == 0
+
+
+def test_pipeline(storage: MemoryStorage):
+    storage.set("a", 1)
+    with storage.pipeline() as pipe:
+        pipe.incr("a").get("a")
+        pipe.sadd("s", "x")
+        assert pipe.execute() == [2, b"2", 1]
+        assert pipe.execute() == []
+
+        pipe.set("b", 1)
+        pipe.reset()
+        assert pipe.execute() == []
+    assert storage.get("b") is None
+
+    with pytest.raises(AttributeError):
+        pipe._data
+    with pytest.raises(AttributeError):
+        pipe.sscan_iter
+
+
+def test_flushall_publish(storage: MemoryStorage):
+    storage.set("a", 1)
+    assert storage.publish("channel", "message") == 0
+    assert storage.flushall() is True
+    assert storage.get("a") is None
+
+
+def test_thread_safety(storage: MemoryStorage):
+    barrier = threading.Barrier(4)
+
+    def incr(index):
+        barrier.wait()
+        for _ in range(1000):
+            with storage.pipeline() as pipe:
+                pipe.incr("counter")
+                pipe.sadd("members", index)
+                pipe.execute()
+
+    threads = [threading.Thread(target=incr, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert storage.get("counter") == b"4000"
+    assert len(storage.smembers("members")) == 4
+
+
+def test_cache_ttl(storage: MemoryStorage):
+    msg = r"The argument `cache_ttl` cannot be used with the in-memory storage\."
+    with pytest.raises(ValueError, match=msg):
+        FlaskPancake(storage=storage, cache_ttl=60)
+
+
+def test_read_redis_extension_name(storage: MemoryStorage):
+    msg = (
+        r"The arguments `storage` and `read_redis_extension_name` are mutually "
+        r"exclusive\."
+    )
+    with pytest.raises(ValueError, match=msg):
+        FlaskPancake(storage=storage, read_redis_extension_name="replica")
+
+
+def test_redis_storage(app: Flask):
+    # Any client with the redis-py API works, not just Flask-Redis extensions
+    client = Redis.from_url("redis://localhost:6379/1")
+    client.flushdb()
+    ext = FlaskPancake(app, name="client", storage=client, cache_ttl=60)
+    switch = Switch("my-switch", True, extension="client")
+    switch.disable()
+    assert switch.is_active() is False
+    g.pop("pancake_cache")
+    assert asyncio.run(switch.is_active_async()) is False
+    assert asyncio.run(ext.evaluate_all_async()).switches == {"my-switch": False}
+    assert app.extensions["redis"].keys("*") == []
+    assert ext._local_cache is not None
+    ext._local_cache.close()
+    client.flushdb()
+    client.close()
+
+
+@pytest.mark.parametrize("group_storage", ["keys", "hash", "bitmap"])
+def test_flags(app: Flask, ext: FlaskPancake, storage: MemoryStorage, group_storage):
+    ext.group_storage = group_storage
+    flag = Flag("my-flag", False, extension="memory")
+    sample = Sample("my-sample", 100, extension="memory")
+    switch = Switch("my-switch", True, extension="memory")
+
+    assert flag.is_active() is False
+    assert sample.is_active() is True
+    assert switch.is_active() is True
+    assert storage.get("SWITCH:memory:MY-SWITCH") == b"1"
+
+    flag.enable_group("user")
+    flag.enable_group_many("user", ["2", "3"])
+    flag.disable_group("user", object_id="4")
+    assert flag.is_active() is True
+    assert flag.count_group("user") == (3, 1)
+    assert ext.evaluate_all() == Snapshot(
+        flags={"my-flag": True},
+        samples={"my-sample": True},
+        switches={"my-switch": True},
+    )
+    g.pop("pancake_cache")
+    assert asyncio.run(flag.is_active_async()) is True
+    assert asyncio.run(ext.evaluate_all_async()) == ext.evaluate_all()
+
+    data = aggregate_data(ext, candidate_ids={"user": ["1", "4", "5"]})
+    assert data["flags"][0]["groups"] == {"user": {"1": True, "4": False, "5": None}}
+
+    flag.set_group_rollout("user", 100)
+    assert flag.get_group_rollout("user") == 100
+    flag.clear_all_group("user", batch_size=2)
+    assert flag.count_group("user") == (0, 0)
+    assert flag.is_active() is True
+
+    # Redis isn't used at all
+    assert app.extensions["redis"].keys("*") == []
+
+
+def test_migrate_group_storage(ext: FlaskPancake):
+    flag = Flag("my-flag", False, extension="memory")
+    flag.enable_group_many("user", ["1", "2"])
+    flag.disable_group("user", object_id="3")
+    for group_storage in ("hash", "bitmap", "keys"):
+        ext.group_storage = group_storage
+        assert flag.migrate_group_storage("user", batch_size=2) == 3
+        assert flag.count_group("user") == (2, 1)
+
+
+def test_seed_async(ext: FlaskPancake, storage: MemoryStorage):
+    Sample("my-sample", 42, extension="memory")
+    with mock.patch("random.uniform", return_value=42):
+        snapshot = asyncio.run(ext.evaluate_async(["my-sample"]))
+    assert snapshot.samples == {"my-sample": True}
+    assert storage.get("SAMPLE:memory:MY-SAMPLE") == b"42"
+
+
+def test_refresher(app: Flask, storage: MemoryStorage):
+    ext = FlaskPancake(
+        app,
+        name="memory",
+        storage=storage,
+        group_funcs={"user": lambda: "1"},
+        refresh_interval=60,
+    )
+    flag = Flag("my-flag", False, extension="memory")
+    flag.enable_group("user")
+    assert ext._load_state()["FLAG:memory:k:user:MY-FLAG:1"] == b"1"
+    assert flag.is_active() is True
+    assert ext._refresher is not None
+    ext._refresher.close()
@@ -1,7 +1,9 @@
 from __future__ import annotations
 
+from unittest import mock
+
 import pytest
-from flask import Flask
+from flask import Flask, g
 
 from flask_pancake import FlaskPancake, Switch
 from flask_pancake.constants import RAW_FALSE, RAW_TRUE
@@ -33,6 +35,56 @@ def test_switch(app: Flask):
     assert app.extensions["redis"].get("SWITCH:pancake:DEFAULT_OFF") is None
 
 
+def test_request_cache(app: Flask):
+    switch = Switch("my-switch", False)
+    key = "SWITCH:pancake:MY-SWITCH"
+
+    assert switch.is_active() is False
+    assert g.pancake_cache == {"pancake": {key: False}}
+
+    # Changes made outside of the switch's API are not seen within the same request
+    app.extensions["redis"].set(key, 1)
+    assert switch.is_active() is False
+
+    switch.enable()
+    assert "pancake" not in g.pancake_cache
+    assert switch.is_active() is True
+
+    switch.disable()
+    assert switch.is_active() is False
+
+    switch.clear()
+    assert "pancake" not in g.pancake_cache
+
+
+def test_no_request_cache(_app: Flask):
+    # E.g. a worker or CLI command running in a single long-lived app context
+    switch = Switch("my-switch", False)
+    with _app.app_context():
+        assert switch.is_active() is False
+        _app.extensions["redis"].set(switch.key, 1)
+        assert switch.is_active() is True
+        assert "pancake_cache" not in g
+
+
+def test_read_existing_value(app: Flask):
+    switch = Switch("my-switch", True)
+    key = "SWITCH:pancake:MY-SWITCH"
+    redis = app.extensions["redis"]
+
+    with mock.patch.object(redis, "setnx", wraps=redis.setnx) as setnx:
+        assert switch.is_active() is True
+    setnx.assert_called_once_with(key, 1)
+    g.pop("pancake_cache")
+
+    with mock.patch.object(redis, "setnx") as setnx, mock.patch.object(
+        redis, "get", wraps=redis.get
+    ) as get:
+        assert switch.is_active() is True
+    setnx.assert_not_called()
+    get.assert_called_once_with(key)
+
+
 def test_key(app: Flask):
     switch = Switch("my-switch", True)
     assert switch.key == "SWITCH:pancake:MY-SWITCH"
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import hashlib
 from unittest import mock
 
 import pytest
@@ -7,7 +8,10 @@ from flask import Flask, g, jsonify, request
 from itsdangerous import BadData
 
 from flask_pancake import FlaskPancake, Sample
+from flask_pancake.registry import registry
 from flask_pancake.utils import (
+    _get_sample_id,
+    _get_serializer,
     decode_sample_state,
     encode_sample_state,
     import_from_string,
@@ -61,36 +65,36 @@ def test_load_store_cookie(app: Flask):
 
     @app.route("/")
     def view():
+        state = {"sample1": sample1.is_active(), "sample2": sample2.is_active()}
         return jsonify(
-            {
-                "cookies": request.cookies,
-                "request_state": g.get("pancakes"),
-                "sample1": sample1.is_active(),
-                "sample2": sample2.is_active(),
-            }
+            {"cookies": request.cookies, "request_state": g.get("pancakes"), **state}
         )
 
+    cookies = {
+        "other": "WzIsW10sWzQwOTIyNjcwMzRdXQ.IQ8lNAl_x45cIah3MuUWi0cgzaE",
+        "pancake": "WzIsWzE5ODc1ODczMjRdLFtdXQ.14hRVy935JTkqFlMIV8RdJ6qbA4",
+    }
     with app.test_client() as client:
         with mock.patch("random.uniform", return_value=41.999):
             resp = client.get("/")
             assert resp.json == {
                 "cookies": {},
-                "request_state": None,
+                "request_state": {"other": {"s2": False}, "pancake": {"s1": True}},
                 "sample1": True,
                 "sample2": False,
             }
+            assert len(resp.headers.getlist("Set-Cookie")) == 2
         g.pop("pancakes")
         with mock.patch("random.uniform", return_value=12.99):
             resp = client.get("/")
             assert resp.json == {
-                "cookies": {
-                    "other": "eyJzMiI6ZmFsc2V9.MUaGnFYuUZPDFdQOTsK--NNHX-w",
-                    "pancake": "eyJzMSI6dHJ1ZX0.dOXBnEqzY3GMDtreJMU-BRduDq8",
-                },
+                "cookies": cookies,
                 "request_state": {"other": {"s2": False}, "pancake": {"s1": True}},
                 "sample1": True,
                 "sample2": False,
             }
+            # Nothing changed, so the cookies aren't written again
+            assert "Set-Cookie" not in resp.headers
         g.pop("pancakes")
         with mock.patch("random.uniform", return_value=12.99):
             with mock.patch(
@@ -98,11 +102,94 @@ def test_load_store_cookie(app: Flask):
             ):
                 resp = client.get("/")
                 assert resp.json == {
-                    "cookies": {
-                        "other": "eyJzMiI6ZmFsc2V9.MUaGnFYuUZPDFdQOTsK--NNHX-w",
-                        "pancake": "eyJzMSI6dHJ1ZX0.dOXBnEqzY3GMDtreJMU-BRduDq8",
-                    },
-                    "request_state": None,
+                    "cookies": cookies,
+                    "request_state": {"other": {"s2": True}, "pancake": {"s1": True}},
                     "sample1": True,
                     "sample2": True,
                 }
+                assert len(resp.headers.getlist("Set-Cookie")) == 2
+
+
+def test_load_cookie_lazily(app: Flask):
+    app.secret_key = "s3cr!t"
+    sample = Sample("s1", 42)
+
+    @app.route("/")
+    def index():
+        return "index"
+
+    @app.route("/sample")
+    def view():
+        return jsonify(sample.is_active())
+
+    with app.test_client() as client:
+        client.get("/sample")
+        g.pop("pancakes")
+        with mock.patch(
+            "flask_pancake.utils.decode_sample_state", wraps=decode_sample_state
+        ) as decode:
+            resp = client.get("/")
+            assert "Set-Cookie" not in resp.headers
+            decode.assert_not_called()
+
+            client.get("/sample")
+            decode.assert_called_once()
+
+
+def test_serializer_cached(app: Flask):
+    app.secret_key = "s3cr!t"
+    serializer = _get_serializer(app.secret_key)
+    assert _get_serializer("s3cr!t") is serializer
+    assert _get_serializer("other") is not serializer
+
+
+def test_encode_decode_sample_state_compact(app: Flask):
+    app.secret_key = "s3cr!t"
+    ext = app.extensions["pancake"]
+    names = [hashlib.sha1(str(i).encode()).hexdigest()[:12] for i in range(40)]
+    for name in names:
+        Sample(name, 50)
+    d = {name: i % 3 == 0 for i, name in enumerate(names) if i % 2 == 0}
+
+    encoded = encode_sample_state(d, ext)
+    assert decode_sample_state(encoded, ext) == d
+    assert len(encoded) < len(encode_sample_state(d))
+
+    # Names of unknown samples are dropped
+    assert decode_sample_state(encode_sample_state({"foo": True}, ext), ext) == {}
+
+
+def test_decode_sample_state_legacy(app: Flask):
+    app.secret_key = "s3cr!t"
+    ext = app.extensions["pancake"]
+    Sample("s1", 42)
+    assert decode_sample_state("eyJzMSI6dHJ1ZX0.dOXBnEqzY3GMDtreJMU-BRduDq8", ext) == {
+        "s1": True
+    }
+
+
+def test_decode_sample_state_changed_samples(app: Flask):
+    app.secret_key = "s3cr!t"
+    ext = app.extensions["pancake"]
+    Sample("s1", 42)
+    Sample("s2", 42)
+    encoded = encode_sample_state({"s1": True, "s2": False}, ext)
+
+    # Adding a sample keeps the state of all others
+    Sample("s0", 42)
+    assert decode_sample_state(encoded, ext) == {"s1": True, "s2": False}
+
+    # Only the state of removed samples is dropped
+    registry.__clear__()
+    Sample("s2", 42)
+    assert decode_sample_state(encoded, ext) == {"s2": False}
+
+    with mock.patch("flask_pancake.utils.COOKIE_VERSION", 3):
+        encoded = encode_sample_state({"s2": True}, ext)
+    assert decode_sample_state(encoded, ext) == {}
+
+
+def test_sample_id():
+    assert _get_sample_id("s1") == _get_sample_id("s1")
+    assert _get_sample_id("s1") != _get_sample_id("s2")
+    assert 0 <= _get_sample_id("s1") < 1 << 32
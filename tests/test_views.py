@@ -3,7 +3,7 @@ from unittest import mock
 import pytest
 from flask.app import Flask
 
-from flask_pancake import Flag, GroupFunc, Sample, Switch, blueprint
+from flask_pancake import Flag, FlaskPancake, GroupFunc, Sample, Switch, blueprint
 from flask_pancake.constants import EXTENSION_NAME
 from flask_pancake.views import aggregate_data, aggregate_is_active_data
 
@@ -113,6 +113,41 @@ def test_aggregate_data_groups(sample_data_groups, app: Flask):
     }
 
 
+def test_aggregate_data_bitmap_invalid_id(sample_data, app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    ext.group_storage = "bitmap"
+    ext._group_funcs = {"user": noop}
+    flag1, *_ = sample_data
+    flag1.enable_group("user", object_id="1")
+    data = aggregate_data(ext, candidate_ids={"user": ["1", "anon-session-abc"]})
+    assert data["flags"][0]["groups"] == {"user": {"1": True, "anon-session-abc": None}}
+
+
+def test_aggregate_data_batched(sample_data_groups, app: Flask):
+    ext = app.extensions[EXTENSION_NAME]
+    redis = app.extensions["redis"]
+    # Persist the default values first
+    aggregate_data(ext)
+
+    with mock.patch.object(
+        ext.group_funcs["admin"],
+        "get_candidate_ids",
+        wraps=ext.group_funcs["admin"].get_candidate_ids,
+    ) as get_candidate_ids, mock.patch.object(
+        redis, "mget", wraps=redis.mget
+    ) as mget, mock.patch.object(
+        redis, "get"
+    ) as get:
+        data = aggregate_data(ext)
+    get_candidate_ids.assert_called_once_with()
+    mget.assert_called_once()
+    get.assert_not_called()
+    assert data["flags"][0]["groups"] == {
+        "user": {},
+        "admin": {"yes": False, "no": None},
+    }
+
+
 def test_aggregate_is_active_data_empty(app: Flask):
     assert aggregate_is_active_data(app.extensions[EXTENSION_NAME]) == {
         "flags": [],
@@ -304,3 +339,103 @@ def test_status_ext_not_found(app: Flask):
     with app.test_client() as client:
         resp = client.get("/p/status/foo")
     assert resp.status_code == 404
+
+
+def test_status_etag(sample_data_groups, app: Flask):
+    app.register_blueprint(blueprint, url_prefix="/p")
+    app.secret_key = "s3cr!t"
+    ext = app.extensions[EXTENSION_NAME]
+    flag1, *_ = ext.flags.values()
+    with app.test_client() as client:
+        # The first response sets the sample cookie, which changes the ETag
+        first_etag = client.get("/p/status").headers["ETag"]
+        resp = client.get("/p/status", headers={"If-None-Match": first_etag})
+        assert resp.status_code == 200
+        etag = resp.headers["ETag"]
+        assert etag != first_etag
+
+        with mock.patch.object(ext, "evaluate_all") as evaluate_all:
+            resp = client.get("/p/status", headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == etag
+        assert resp.data == b""
+        evaluate_all.assert_not_called()
+
+        flag1.enable()
+        resp = client.get("/p/status", headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+
+
+def test_status_etag_write_elsewhere(_app: Flask):
+    # Every request gets its own app context and thus its own `g`
+    _app.register_blueprint(blueprint, url_prefix="/p")
+    ext = FlaskPancake(_app, name="refreshed", refresh_interval=60)
+    refresher = ext._refresher
+    assert refresher is not None
+    switch = Switch("my-switch", False, extension="refreshed")
+    redis = _app.extensions["redis"]
+    refresher.refresh()
+    with _app.test_client() as client:
+        resp = client.get("/p/status/refreshed")
+        etag = resp.headers["ETag"]
+        assert resp.json == {
+            "flags": [],
+            "samples": [],
+            "switches": [{"is_active": False, "name": "my-switch"}],
+        }
+
+        # Another process enables the switch. Until the next refresh, neither the
+        # state nor the ETag change.
+        redis.set(switch.key, 1)
+        redis.incr(ext._version_key)
+        resp = client.get("/p/status/refreshed", headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+
+        refresher.refresh()
+        resp = client.get("/p/status/refreshed", headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+        assert resp.json == {
+            "flags": [],
+            "samples": [],
+            "switches": [{"is_active": True, "name": "my-switch"}],
+        }
+    refresher.close()
+
+
+def test_status_etag_group_ids(sample_data_groups, app: Flask):
+    app.register_blueprint(blueprint, url_prefix="/p")
+    app.secret_key = "s3cr!t"
+    ext = app.extensions[EXTENSION_NAME]
+    with app.test_client() as client:
+        etag = client.get("/p/status").headers["ETag"]
+        with mock.patch.object(ext, "get_group_ids", return_value={"user": "1"}):
+            resp = client.get("/p/status", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
+
+
+def test_overview_etag(sample_data_groups, app: Flask):
+    app.register_blueprint(blueprint, url_prefix="/p")
+    with app.test_client() as client:
+        json_etag = client.get("/p/overview").headers["ETag"]
+        html_etag = client.get("/p/overview", headers={"Accept": "text/html"}).headers[
+            "ETag"
+        ]
+        assert json_etag != html_etag
+
+        with mock.patch("flask_pancake.views.aggregate_data") as aggregate:
+            resp = client.get(
+                "/p/overview",
+                headers={"Accept": "text/html", "If-None-Match": html_etag},
+            )
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == html_etag
+        aggregate.assert_not_called()
+
+        # Registering new flags changes the ETag
+        Flag("Flag4", default=False)
+        resp = client.get("/p/overview", headers={"If-None-Match": json_etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != json_etag